@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Compares utils.toLower() against the old chain of str.replace() calls it
+replaced, for a typical mix of channel names and nicks.
+
+Run from the PyLink directory: python3 benchmarks/casemapping.py
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import functools
+import timeit
+
+import classes
+import utils
+
+def oldToLower(irc, text):
+    if irc.proto.casemapping == 'rfc1459':
+        text = text.replace('{', '[')
+        text = text.replace('}', ']')
+        text = text.replace('|', '\\')
+        text = text.replace('~', '^')
+    return text.lower()
+
+def main():
+    irc = classes.FakeIRC('bench', classes.FakeProto)
+    # A handful of busy channels, and many different nicks.
+    names = ['#Lobby', '#PyLink', '#help{dev}', '#Off-Topic'] * 50
+    names += ['Nick|%s' % n for n in range(200)]
+    casemap = utils.Casemapping('rfc1459')
+
+    def bench(name, func):
+        # Every path is called the same way (func(text), with no extra
+        # wrapper), so that call overhead doesn't skew the comparison.
+        t = min(timeit.repeat(lambda: [func(text) for text in names],
+                              number=200, repeat=5))
+        print('%-35s %8.1f ns/call' % (name, t / (200 * len(names)) * 1e9))
+
+    bench('old str.replace() chain', functools.partial(oldToLower, irc))
+    bench('translation table, uncached', functools.partial(utils.Casemapping.fold, casemap))
+    bench('utils.toLower() (cached)', functools.partial(utils.toLower, irc))
+
+if __name__ == '__main__':
+    main()
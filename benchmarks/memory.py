@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Reports the memory used per user and per channel in PyLink's state classes
+(IrcUser, IrcChannel, and the indexes kept around them), for synthetic
+networks of increasing size.
+
+Run from the PyLink directory: python3 benchmarks/memory.py [sizes...]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import random
+import tracemalloc
+
+import classes
+
+def buildUsers(irc, count):
+    irc.servers['10X'] = classes.IrcServer(irc.sid, 'users.server')
+    for n in range(count):
+        uid = '10X%06d' % n
+        user = classes.IrcUser('user%s' % n, 1234567890, uid, 'ident%s' % n,
+                               'host%s.example.com' % n, 'Real name %s' % n,
+                               'host%s.example.com' % n, '127.0.0.1')
+        user.modes.add(('i', None))
+        irc.proto.addClient(user, '10X')
+
+def buildChannels(irc, count, members=10):
+    uids = list(irc.users)
+    random.seed(1)
+    for n in range(count):
+        name = '#channel%s' % n
+        channel = irc.channels.getOrCreate(name)
+        for uid in random.sample(uids, min(members, len(uids))):
+            channel.users.add(uid)
+            irc.users[uid].channels.add(name)
+
+def measure(func, *args):
+    """Returns the number of bytes allocated by func(*args)."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    func(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    print('%10s %16s %16s' % ('users', 'bytes/user', 'bytes/channel'))
+    for size in sizes:
+        irc = classes.FakeIRC('bench', classes.FakeProto)
+        userbytes = measure(buildUsers, irc, size)
+        # One channel for every 10 users, with 10 members each.
+        chancount = max(size // 10, 1)
+        chanbytes = measure(buildChannels, irc, chancount)
+        print('%10s %16.0f %16.0f' % (size, userbytes / size, chanbytes / chancount))
+
+if __name__ == '__main__':
+    main()
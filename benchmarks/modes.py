@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Times utils.parseModes(), applyModes() and reverseModes() on realistic mode
+strings, on an InspIRCd network with the modes from a real CAPAB negotiation.
+
+Run from the PyLink directory: python3 benchmarks/modes.py [iterations]
+"""
+import sys
+import os
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+             os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'protocols')]
+import timeit
+
+import world
+world.testing = True
+import classes
+import utils
+import inspircd
+
+CAPAB = [
+    'CAPAB CHANMODES :admin=&a allowinvite=A autoop=w ban=b banexception=e blockcolor=c '
+    'c_registered=r exemptchanops=X filter=g flood=f halfop=%h history=H invex=I '
+    'inviteonly=i joinflood=j key=k kicknorejoin=J limit=l moderated=m nickflood=F '
+    'noctcp=C noextmsg=n nokick=Q noknock=K nonick=N nonotice=T official-join=!Y op=@o '
+    'operonly=O opmoderated=U owner=~q permanent=P private=p redirect=L reginvite=R '
+    'regmoderated=M secret=s sslonly=z stripcolor=S topiclock=t voice=+v',
+    'CAPAB USERMODES :bot=B callerid=g cloak=x deaf_commonchan=c helpop=h hidechans=I '
+    'hideoper=H invisible=i oper=o regdeaf=R servprotect=k showwhois=W snomask=s '
+    'u_registered=r u_stripcolor=S wallops=w',
+    'CAPAB CAPABILITIES :NICKMAX=21 CHANMAX=64 MAXMODES=20 IDENTMAX=11 MAXQUIT=255 '
+    'MAXTOPIC=307 MAXKICK=255 MAXGECOS=128 MAXAWAY=200 IP6SUPPORT=1 PROTOCOL=1202 '
+    'PREFIX=(Yqaohv)!~&@%+ CHANMODES=IXbegw,k,FHJLfjl,ACKMNOPQRSTUcimnprstz '
+    'USERMODES=,,s,BHIRSWcghikorwx GLOBOPS=1 SVSPART=1',
+]
+
+def setup():
+    irc = classes.FakeIRC('bench', inspircd)
+    irc.connect()
+    for line in CAPAB:
+        irc.run(line)
+    irc.servers['10X'] = classes.IrcServer(irc.sid, 'users.server')
+    for n in range(5):
+        irc.proto.addClient(classes.IrcUser('user%s' % n, 1, '10XAAAAA%s' % n), '10X')
+    channel = irc.channels.getOrCreate('#bench')
+    channel.users.update(irc.users)
+    # A channel with a good-sized ban list.
+    utils.applyModes(irc, '#bench', [('+b', '*!*@host%s.example.com' % n) for n in range(500)])
+    return irc
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    irc = setup()
+    modestrings = [
+        ['+nt'],
+        ['+ooo-v', 'user0', 'user1', 'user2', 'user3'],
+        ['+lkj-m', '50', 'secret', '5:10'],
+        ['+bbb', '*!*@a.example', '*!*@b.example', 'troll!*@*'],
+        ['+CKNOPQRSTUcimnprstz-Hf'],
+    ]
+    parsed = [utils.parseModes(irc, '#bench', m) for m in modestrings]
+
+    def parse():
+        for m in modestrings:
+            utils.parseModes(irc, '#bench', m)
+
+    def apply():
+        for m in parsed:
+            utils.applyModes(irc, '#bench', m)
+
+    def reverse():
+        for m in parsed:
+            utils.reverseModes(irc, '#bench', m)
+
+    print('%s mode strings, %s iterations, on a channel with 500 bans' %
+          (len(modestrings), number))
+    for func in (parse, apply, reverse):
+        elapsed = timeit.timeit(func, number=number)
+        print('%-10s %10.2f us per mode string' %
+              (func.__name__, elapsed / number / len(modestrings) * 1e6))
+
+if __name__ == '__main__':
+    main()
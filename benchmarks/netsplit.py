@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Times a netsplit of 10,000 users on a network with 20,000 channels, using
+Protocol.removeClient() (which only visits each user's own channels) and the
+old approach of checking every channel on the network for every user.
+
+The old approach is far too slow to run in full, so it is timed on a sample
+of users and extrapolated.
+
+Run from the PyLink directory: python3 benchmarks/netsplit.py [users] [channels]
+"""
+import sys
+import os
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+             os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'protocols')]
+import random
+import time
+
+import world
+world.testing = True
+import classes
+import inspircd
+
+SAMPLE = 50
+
+def build(users, channels):
+    """Creates a network with <users> users on server 10X, each in a few of
+    <channels> channels."""
+    irc = classes.FakeIRC('bench', inspircd)
+    irc.connect()
+    irc.servers['10X'] = classes.IrcServer(irc.sid, 'split.server')
+    chans = ['#chan%s' % n for n in range(channels)]
+    for chan in chans:
+        irc.channels.getOrCreate(chan)
+    random.seed(1)
+    for n in range(users):
+        uid = '10X%06d' % n
+        irc.proto.addClient(classes.IrcUser('user%s' % n, 1, uid), '10X')
+        for chan in random.sample(chans, 3):
+            irc.channels[chan].users.add(uid)
+            irc.users[uid].channels.add(chan)
+    return irc
+
+def oldRemoveClient(irc, numeric):
+    """removeClient() as it was: scans every channel on the network."""
+    for c, v in irc.channels.copy().items():
+        v.removeuser(numeric)
+        if not (irc.channels[c].users or ((irc.cmodes.get('permanent'), None) in irc.channels[c].modes)):
+            del irc.channels[c]
+    del irc.users[numeric]
+    irc.servers[numeric[:3]].users.discard(numeric)
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    channels = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    print('Netsplit of %s users, %s channels' % (users, channels))
+
+    irc = build(users, channels)
+    start = time.perf_counter()
+    irc.proto.handle_squit(irc.uplink or irc.sid, 'SQUIT', ['10X', 'bench'])
+    elapsed = time.perf_counter() - start
+    assert not irc.users.keys() & {'10X%06d' % n for n in range(users)}
+    print('%-40s %10.3f s' % ('SQUIT handler', elapsed))
+
+    irc = build(users, channels)
+    sample = ['10X%06d' % n for n in range(SAMPLE)]
+    start = time.perf_counter()
+    for uid in sample:
+        oldRemoveClient(irc, uid)
+    elapsed = (time.perf_counter() - start) / SAMPLE * users
+    print('%-40s %10.3f s' % ('old scan over all channels (estimated)', elapsed))
+
+if __name__ == '__main__':
+    main()
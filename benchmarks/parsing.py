@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Times splitting incoming lines with Protocol.tokenize() against the old
+data.split(" ") + parseTS6Args() path, on InspIRCd burst data.
+
+By default, this uses a synthetic burst built from lines captured from an
+InspIRCd 2.0 uplink. A file of captured lines (one per line, as received)
+can be given instead.
+
+Run from the PyLink directory: python3 benchmarks/parsing.py [capture file]
+"""
+import sys
+import os
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+             os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'protocols')]
+import timeit
+
+import world
+world.testing = True
+import classes
+import inspircd
+
+def burst(users=2000):
+    """Returns a list of lines resembling an InspIRCd burst of <users> users,
+    spread over a tenth as many channels."""
+    lines = [':70M BURST 1433044587',
+             ':70M SERVER millennium.overdrive.pw * 1 1ML :a relatively long period of time... (Fremont, California)']
+    for n in range(users):
+        uid = '70MAAA%03d' % n
+        lines.append(':70M UID %s 1429934638 user%s 0::1 hidden-7j810p.9mdf.lrek.0000.0000.IP '
+                     'user%s 0::1 1429934638 +Wioswx +ACGKNOQXacfgklnoqvx :Some real name' % (uid, n, n))
+        lines.append(':%s OPERTYPE Network_Owner' % uid)
+        lines.append(':%s AWAY 1439371390 :Auto-away' % uid)
+    for n in range(users // 10):
+        members = ' '.join('v,70MAAA%03d' % m for m in range(n * 10, n * 10 + 10))
+        lines.append(':70M FJOIN #chan%s 1423790411 +nt :o,70MAAA000 %s' % (n, members))
+        lines.append(':70M FTOPIC #chan%s 1434510754 GLo|o|!GLolol@escape.the.dreamland.ca '
+                     ':Some channel topic' % n)
+        lines.append(':70M FMODE #chan%s 1423790411 +bb *!*@bad%s.example.com *!*@worse.example.com' % (n, n))
+    lines.append(':70M ENDBURST')
+    return lines
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding='utf-8', errors='replace') as f:
+            lines = [line.rstrip('\r\n') for line in f if line.strip()]
+    else:
+        lines = burst()
+    proto = inspircd.Class(classes.FakeIRC('bench', inspircd))
+
+    def split():
+        for line in lines:
+            proto.parseTS6Args(line.split(" "))
+
+    def tokenize():
+        for line in lines:
+            proto.tokenize(line).args
+
+    print('%s lines, %s bytes' % (len(lines), sum(map(len, lines))))
+    number = 20
+    for func in (split, tokenize):
+        elapsed = timeit.timeit(func, number=number) / number
+        print('%-10s %10.2f ms per burst (%.2f us per line)' %
+              (func.__name__, elapsed * 1e3, elapsed / len(lines) * 1e6))
+
+if __name__ == '__main__':
+    main()
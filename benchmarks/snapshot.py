@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Times taking the "before" copy of a channel that MODE hooks get as 'oldchan',
+using IrcChannel.snapshot() and the old IrcChannel.deepcopy(), on a channel
+with many members and a large ban list.
+
+Run from the PyLink directory: python3 benchmarks/snapshot.py [members] [bans]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import timeit
+
+import classes
+
+def build(members, bans):
+    """Returns a channel with <members> users (a tenth of them opped) and
+    <bans> bans."""
+    channel = classes.IrcChannel()
+    for n in range(members):
+        uid = '10X%06d' % n
+        channel.users.add(uid)
+        if n % 10 == 0:
+            channel.setStatus(uid, 'op')
+    channel.modes |= {('b', '*!*@bad%s.example.com' % n) for n in range(bans)}
+    return channel
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    bans = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    channel = build(members, bans)
+    print('Channel with %s members and %s bans' % (members, bans))
+    for name in ('deepcopy', 'snapshot'):
+        func = getattr(channel, name)
+        number = 20 if name == 'deepcopy' else 20000
+        elapsed = timeit.timeit(func, number=number) / number
+        print('%-10s %12.1f us per copy' % (name, elapsed * 1e6))
+
+if __name__ == '__main__':
+    main()
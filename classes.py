@@ -13,13 +13,22 @@ import time
 import socket
 import threading
 import ssl
-from collections import defaultdict
+from collections import defaultdict, deque, Counter
+from collections.abc import Mapping, MutableSet
 import hashlib
+import functools
+import codecs
+import queue
+import zlib
 from copy import deepcopy
 
 from log import log
 import world
 import utils
+import conf
+import scheduler
+import reconnect
+import selectdriver
 
 ### Exceptions
 
@@ -31,6 +40,12 @@ class ProtocolError(Exception):
 class Irc():
     """Base IRC object for PyLink."""
 
+    # Bounds for the amount of data read from the socket at once: this grows
+    # while the uplink is sending a lot (e.g. during a burst), and shrinks
+    # again when things are quiet.
+    min_recv_size = 4096
+    max_recv_size = 262144
+
     def __init__(self, netname, proto, conf):
         """
         Initializes an IRC object. This takes 3 variables: the network name
@@ -44,21 +59,42 @@ class Irc():
         self.botdata = conf['bot']
         self.protoname = proto.__name__
         self.proto = proto.Class(self)
+        # Casemapping object used by utils.toLower(); this is set on first use.
+        self.casemap = None
         self.pingfreq = self.serverdata.get('pingfreq') or 30
         self.pingtimeout = self.pingfreq * 2
 
         self.connected = threading.Event()
         self.aborted = threading.Event()
 
+        self.pingTimer = None
+        self.sweepTimer = None
+        self.connection_thread = None
+        self.dispatcher = None
+        self.ziplink = None
+
+        # SSL context and session, kept across reconnects so that we don't
+        # need to reload certificates or do a full handshake every time.
+        self.ssl = None
+        self._ssl_context = None
+        self._ssl_context_files = None
+        self._ssl_session = None
+        # Time taken by the SSL handshake of the current connection.
+        self.ssl_handshake_time = None
+
+        # Outbound queue for the current connection; this is replaced with a
+        # new one on every connection attempt. Anything sent before then is
+        # dropped.
+        self.sendq = SendQueue()
+        self.sendq.close()
+
         self.initVars()
 
         if world.testing:
             # HACK: Don't thread if we're running tests.
             self.connect()
         else:
-            self.connection_thread = threading.Thread(target = self.connect)
-            self.connection_thread.start()
-        self.pingTimer = None
+            self.start()
 
     def initVars(self):
         """
@@ -82,11 +118,18 @@ class Irc():
         # Intialize the server, channel, and user indexes to be populated by
         # our protocol module. For the server index, we can add ourselves right
         # now.
-        self.servers = {self.sid: IrcServer(None, self.serverdata['hostname'],
-                        internal=True, desc=self.serverdata.get('serverdesc')
-                        or self.botdata['serverdesc'])}
-        self.users = {}
-        self.channels = defaultdict(IrcChannel)
+        self.servers = ServerMapping()
+        self.servers[self.sid] = IrcServer(None, self.serverdata['hostname'],
+                                           internal=True, desc=self.serverdata.get('serverdesc')
+                                           or self.botdata['serverdesc'])
+        self.users = UserMapping(self)
+        # Maps UIDs to the SID of the server they're on, and tracks which UIDs
+        # are PyLink clients. These are kept by Protocol.addClient() and
+        # removeClient(), and used by utils.clientToServer() and
+        # utils.isInternalClient().
+        self.client_servers = {}
+        self.internal_clients = set()
+        self.channels = ChannelMapping(self)
 
         # This sets the list of supported channel and user modes: the default
         # RFC1459 modes are implied. Named modes are used here to make
@@ -124,102 +167,51 @@ class Irc():
         # Defines a list of supported prefix modes.
         self.prefixmodes = {'o': '@', 'v': '+'}
 
+        # Mode lookup tables compiled from the above by utils.compileModeTables().
+        self.cmodetable = self.umodetable = None
+
         # Defines the uplink SID (to be filled in by protocol module).
         self.uplink = None
         self.start_ts = int(time.time())
 
+    def start(self):
+        """
+        Starts the connection for this IRC object. If the "use_event_loop"
+        option in the bot: block is enabled, the connection is handed to the
+        shared event loop in selectdriver.py; otherwise, it gets a connection
+        thread of its own.
+        """
+        if self.botdata.get('use_event_loop'):
+            selectdriver.register(self)
+        else:
+            self.connection_thread = threading.Thread(target=self.connect)
+            self.connection_thread.start()
+
+    def isRunning(self):
+        """
+        Returns whether this IRC object's connection is active: that is,
+        connecting, connected, or waiting to autoconnect.
+        """
+        if self.botdata.get('use_event_loop'):
+            return selectdriver.isRegistered(self)
+        return bool(self.connection_thread and self.connection_thread.is_alive())
+
     def connect(self):
         """
         Runs the connect loop for the IRC object. This is usually called by
-        __init__ in a separate thread to allow multiple concurrent connections.
+        start() in a separate thread to allow multiple concurrent connections.
         """
         while True:
-            self.initVars()
-            ip = self.serverdata["ip"]
-            port = self.serverdata["port"]
-            checks_ok = True
             try:
-                # Set the socket type (IPv6 or IPv4).
-                stype = socket.AF_INET6 if self.serverdata.get("ipv6") else socket.AF_INET
-
-                # Creat the socket.
-                self.socket = socket.socket(stype)
-                self.socket.setblocking(0)
-
-                # Set the connection timeouts. Initial connection timeout is a
-                # lot smaller than the timeout after we've connected; this is
-                # intentional.
-                self.socket.settimeout(self.pingfreq)
-
-                # Enable SSL if set to do so. This requires a valid keyfile and
-                # certfile to be present.
-                self.ssl = self.serverdata.get('ssl')
-                if self.ssl:
-                    log.info('(%s) Attempting SSL for this connection...', self.name)
-                    certfile = self.serverdata.get('ssl_certfile')
-                    keyfile = self.serverdata.get('ssl_keyfile')
-                    if certfile and keyfile:
-                        try:
-                            self.socket = ssl.wrap_socket(self.socket,
-                                                          certfile=certfile,
-                                                          keyfile=keyfile)
-                        except OSError:
-                             log.exception('(%s) Caught OSError trying to '
-                                           'initialize the SSL connection; '
-                                           'are "ssl_certfile" and '
-                                           '"ssl_keyfile" set correctly?',
-                                           self.name)
-                             checks_ok = False
-                    else:  # SSL was misconfigured, abort.
-                        log.error('(%s) SSL certfile/keyfile was not set '
-                                  'correctly, aborting... ', self.name)
-                        checks_ok = False
-
-                log.info("Connecting to network %r on %s:%s", self.name, ip, port)
-                self.socket.connect((ip, port))
-                self.socket.settimeout(self.pingtimeout)
-
-                # If SSL was enabled, optionally verify the certificate
-                # fingerprint for some added security. I don't bother to check
-                # the entire certificate for validity, since most IRC networks
-                # self-sign their certificates anyways.
-                if self.ssl and checks_ok:
-                    peercert = self.socket.getpeercert(binary_form=True)
-                    sha1fp = hashlib.sha1(peercert).hexdigest()
-                    expected_fp = self.serverdata.get('ssl_fingerprint')
-                    if expected_fp:
-                        if sha1fp != expected_fp:
-                            # SSL Fingerprint doesn't match; break.
-                            log.error('(%s) Uplink\'s SSL certificate '
-                                      'fingerprint (SHA1) does not match the '
-                                      'one configured: expected %r, got %r; '
-                                      'disconnecting...', self.name,
-                                      expected_fp, sha1fp)
-                            checks_ok = False
-                        else:
-                            log.info('(%s) Uplink SSL certificate fingerprint '
-                                     '(SHA1) verified: %r', self.name, sha1fp)
-                    else:
-                        log.info('(%s) Uplink\'s SSL certificate fingerprint '
-                                 'is %r. You can enhance the security of your '
-                                 'link by specifying this in a "ssl_fingerprint"'
-                                 ' option in your server block.', self.name,
-                                 sha1fp)
-
-                if checks_ok:
-                    # All our checks passed, get the protocol module to connect
-                    # and run the listen loop.
-                    self.proto.connect()
-                    self.spawnMain()
+                if self._connect():
+                    writer = threading.Thread(target=self._writeLoop,
+                                              args=(self.sendq, self.socket))
+                    writer.start()
                     log.info('(%s) Starting ping schedulers....', self.name)
                     self.schedulePing()
+                    self.scheduleSweep()
                     log.info('(%s) Server ready; listening for data.', self.name)
                     self.run()
-                else:  # Configuration error :(
-                    log.error('(%s) A configuration error was encountered '
-                              'trying to set up this connection. Please check'
-                              ' your configuration file and try again.',
-                              self.name)
             except (socket.error, ProtocolError, ConnectionError) as e:
                 # self.run() or the protocol module it called raised an
                 # exception, meaning we've disconnected!
@@ -231,14 +223,176 @@ class Irc():
 
             # If autoconnect is enabled, loop back to the start. Otherwise,
             # return and stop.
-            autoconnect = self.serverdata.get('autoconnect')
-            log.debug('(%s) Autoconnect delay set to %s seconds.', self.name, autoconnect)
-            if autoconnect is not None and autoconnect >= 1:
-                log.info('(%s) Going to auto-reconnect in %s seconds.', self.name, autoconnect)
-                time.sleep(autoconnect)
-            else:
-                log.info('(%s) Stopping connect loop (autoconnect value %r is < 1).', self.name, autoconnect)
+            autoconnect = self._getAutoconnectDelay()
+            if autoconnect is None:
                 return
+            time.sleep(autoconnect)
+
+    def _connect(self):
+        """
+        Sets up the socket for the IRC object, connects to the uplink, and
+        gets the protocol module to start linking. Returns True if the
+        connection is ready to be read from, and False if a configuration
+        error prevented it from being made.
+
+        Socket and protocol errors are left for the caller to handle.
+        """
+        self.initVars()
+        # Wait until we're allowed to start linking; see reconnect.py.
+        if not world.coordinator.acquire(self):
+            log.info('(%s) Connection aborted while waiting for a burst slot.', self.name)
+            return False
+        if self.serverdata.get('dispatch_queue'):
+            # Run incoming lines and hooks on a separate thread, so that slow
+            # hooks can't hold up reading from the socket.
+            # The shared event loop mustn't wait for room in the queue; it
+            # stops reading from the socket instead (see selectdriver.py).
+            use_event_loop = bool(self.botdata.get('use_event_loop'))
+            self.dispatcher = Dispatcher(self, self.serverdata.get('dispatch_queue_size') or 10000,
+                                         block=not use_event_loop, notify=self._dispatchNotify)
+            self.dispatcher.start()
+        self.framer = LineFramer()
+        self.recv_size = self.min_recv_size
+        if self.serverdata.get('ziplinks'):
+            self.ziplink = ZlibLink(self.serverdata.get('ziplinks_level', 6))
+        else:
+            self.ziplink = None
+        self.sendq = SendQueue(notify=self._sendqNotify,
+                               rate=self.serverdata.get('sendq_budget'),
+                               compressor=self.ziplink)
+        ip = self.serverdata["ip"]
+        port = self.serverdata["port"]
+        checks_ok = True
+
+        # Set the socket type (IPv6 or IPv4).
+        stype = socket.AF_INET6 if self.serverdata.get("ipv6") else socket.AF_INET
+
+        # Creat the socket.
+        self.socket = socket.socket(stype)
+        self.socket.setblocking(0)
+
+        # Set the connection timeouts. Initial connection timeout is a
+        # lot smaller than the timeout after we've connected; this is
+        # intentional.
+        self.socket.settimeout(self.pingfreq)
+
+        # Enable SSL if set to do so. This requires a valid keyfile and
+        # certfile to be present.
+        self.ssl = self.serverdata.get('ssl')
+        if self.ssl:
+            log.info('(%s) Attempting SSL for this connection...', self.name)
+            certfile = self.serverdata.get('ssl_certfile')
+            keyfile = self.serverdata.get('ssl_keyfile')
+            if certfile and keyfile:
+                try:
+                    context = self._getSSLContext(certfile, keyfile)
+                    # The handshake is done separately below, so that we can
+                    # time it. Session resumption needs Python 3.6+.
+                    kwargs = {}
+                    if hasattr(ssl.SSLSocket, 'session'):
+                        kwargs['session'] = self._ssl_session
+                    self.socket = context.wrap_socket(self.socket,
+                                                      do_handshake_on_connect=False,
+                                                      **kwargs)
+                except OSError:
+                     log.exception('(%s) Caught OSError trying to '
+                                   'initialize the SSL connection; '
+                                   'are "ssl_certfile" and '
+                                   '"ssl_keyfile" set correctly?',
+                                   self.name)
+                     checks_ok = False
+            else:  # SSL was misconfigured, abort.
+                log.error('(%s) SSL certfile/keyfile was not set '
+                          'correctly, aborting... ', self.name)
+                checks_ok = False
+
+        log.info("Connecting to network %r on %s:%s", self.name, ip, port)
+        self.socket.connect((ip, port))
+
+        if self.ssl and checks_ok:
+            start = time.time()
+            self.socket.do_handshake()
+            self.ssl_handshake_time = time.time() - start
+            log.info('(%s) SSL handshake completed in %.3f seconds (%s).',
+                     self.name, self.ssl_handshake_time,
+                     'resumed previous session' if getattr(self.socket, 'session_reused', False)
+                     else 'new session')
+        self.socket.settimeout(self.pingtimeout)
+
+        # If SSL was enabled, optionally verify the certificate
+        # fingerprint for some added security. I don't bother to check
+        # the entire certificate for validity, since most IRC networks
+        # self-sign their certificates anyways.
+        if self.ssl and checks_ok:
+            peercert = self.socket.getpeercert(binary_form=True)
+            sha1fp = hashlib.sha1(peercert).hexdigest()
+            expected_fp = self.serverdata.get('ssl_fingerprint')
+            if expected_fp:
+                if sha1fp != expected_fp:
+                    # SSL Fingerprint doesn't match; break.
+                    log.error('(%s) Uplink\'s SSL certificate '
+                              'fingerprint (SHA1) does not match the '
+                              'one configured: expected %r, got %r; '
+                              'disconnecting...', self.name,
+                              expected_fp, sha1fp)
+                    checks_ok = False
+                else:
+                    log.info('(%s) Uplink SSL certificate fingerprint '
+                             '(SHA1) verified: %r', self.name, sha1fp)
+            else:
+                log.info('(%s) Uplink\'s SSL certificate fingerprint '
+                         'is %r. You can enhance the security of your '
+                         'link by specifying this in a "ssl_fingerprint"'
+                         ' option in your server block.', self.name,
+                         sha1fp)
+
+        if checks_ok:
+            # All our checks passed, get the protocol module to connect.
+            self.proto.connect()
+            self.spawnMain()
+            return True
+        else:  # Configuration error :(
+            log.error('(%s) A configuration error was encountered '
+                      'trying to set up this connection. Please check'
+                      ' your configuration file and try again.',
+                      self.name)
+            return False
+
+    def _getSSLContext(self, certfile, keyfile):
+        """
+        Returns the SSL context for this network, creating it if it doesn't
+        exist yet or the certificate/key files were changed.
+        """
+        if self._ssl_context is None or self._ssl_context_files != (certfile, keyfile):
+            log.debug('(%s) Creating SSL context using certfile %r and keyfile %r',
+                      self.name, certfile, keyfile)
+            # We don't verify the uplink's certificate here (most IRC networks
+            # use self-signed ones); use "ssl_fingerprint" for that instead.
+            # PROTOCOL_TLS_CLIENT is new in Python 3.6.
+            context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            context.load_cert_chain(certfile, keyfile)
+            self._ssl_context = context
+            self._ssl_context_files = (certfile, keyfile)
+            # Sessions can't be used across contexts.
+            self._ssl_session = None
+        return self._ssl_context
+
+    def _getAutoconnectDelay(self):
+        """
+        Returns the number of seconds to wait before reconnecting to the
+        network, or None if autoconnect is disabled. Repeated failures back
+        off exponentially; see ReconnectCoordinator.getDelay().
+        """
+        autoconnect = self.serverdata.get('autoconnect')
+        log.debug('(%s) Autoconnect delay set to %s seconds.', self.name, autoconnect)
+        delay = world.coordinator.getDelay(self)
+        if delay is not None:
+            log.info('(%s) Going to auto-reconnect in %.1f seconds.', self.name, delay)
+            return delay
+        else:
+            log.info('(%s) Stopping connect loop (autoconnect value %r is < 1).', self.name, autoconnect)
 
     def callCommand(self, source, text):
         """
@@ -282,6 +436,28 @@ class Irc():
         """Handle disconnects from the remote server."""
         log.debug('(%s) Canceling pingTimer at %s due to _disconnect() call', self.name, time.time())
         self.connected.clear()
+        # Save the SSL session (if any) so that the next connection can
+        # resume it.
+        if self.ssl:
+            try:
+                self._ssl_session = self.socket.session or self._ssl_session
+            except AttributeError:  # Not an SSL socket (SSL setup failed).
+                pass
+        # Give up our burst slot, if we still have one.
+        world.coordinator.release(self)
+        # Drop anything that hasn't been sent yet, and stop the writer.
+        self.sendq.close()
+        # Same for lines that haven't been processed yet.
+        if self.dispatcher:
+            # Don't hold up the shared event loop waiting for a slow hook.
+            self.dispatcher.stop(wait=not self.botdata.get('use_event_loop'))
+            self.dispatcher = None
+        if self.ziplink:
+            log.info('(%s) Ziplink compression ratios: %.1f%% sent, %.1f%% received',
+                     self.name, self.ziplink.sendRatio() * 100, self.ziplink.recvRatio() * 100)
+        if self.sweepTimer:
+            self.sweepTimer.cancel()
+            self.sweepTimer = None
         try:
             self.socket.close()
             self.pingTimer.cancel()
@@ -296,25 +472,67 @@ class Irc():
 
     def run(self):
         """Main IRC loop which listens for messages."""
-        # Some magic below cause this to work, though anything that's
-        # not encoded in UTF-8 doesn't work very well.
-        buf = b""
-        data = b""
         while not self.aborted.is_set():
-            data = self.socket.recv(2048)
-            buf += data
-            if self.connected.is_set() and not data:
-                log.warning('(%s) No data received and self.connected is set; disconnecting!', self.name)
+            if not self._readData():
                 return
-            elif (time.time() - self.lastping) > self.pingtimeout:
-                log.warning('(%s) Connection timed out.', self.name)
-                return
-            while b'\n' in buf:
-                line, buf = buf.split(b'\n', 1)
-                line = line.strip(b'\r')
-                # FIXME: respect other encodings?
-                line = line.decode("utf-8", "replace")
-                self.runline(line)
+
+    def _readData(self):
+        """
+        Reads one chunk of data from the uplink and runs every complete line
+        in it. Returns False if the connection should be dropped (the uplink
+        closed it or stopped answering pings), and True otherwise.
+        """
+        data = self.socket.recv(self.recv_size)
+        if not data:
+            log.warning('(%s) No data received; disconnecting!', self.name)
+            return False
+        elif (time.time() - self.lastping) > self.pingtimeout:
+            log.warning('(%s) Connection timed out.', self.name)
+            return False
+
+        # Read more at a time if the uplink filled our buffer, and less if
+        # it didn't come close.
+        if len(data) == self.recv_size:
+            self.recv_size = min(self.recv_size * 2, self.max_recv_size)
+        elif len(data) < self.recv_size // 4:
+            self.recv_size = max(self.recv_size // 2, self.min_recv_size)
+
+        if self.ziplink:
+            chunks = self.ziplink.decompress(data)
+        else:
+            chunks = (data,)
+        for chunk in chunks:
+            for line in self.framer.feed(chunk):
+                self.dispatch(line)
+        return True
+
+    def dispatch(self, line):
+        """
+        Runs an incoming line, either right away or by queuing it for the
+        dispatcher thread (if one is enabled).
+
+        Even with the dispatcher, PINGs and PONGs are handled right away,
+        so that a backlog of hooks can't cause a ping timeout.
+        """
+        if self.dispatcher is None or isKeepalive(line):
+            self.runline(line)
+        else:
+            self.dispatcher.put(line)
+
+    def queueCall(self, func, *args, name=None):
+        """
+        Runs func(*args) for this network without waiting for it: on the
+        dispatcher thread (in order with incoming lines) if one is enabled,
+        or in a new thread otherwise. This is meant for work handed off by
+        shared threads such as world.scheduler, which mustn't be held up by
+        hooks.
+        """
+        call = functools.partial(func, *args)
+        if self.dispatcher is not None:
+            self.dispatcher.put(call, block=False)
+        else:
+            threading.Thread(target=call, daemon=True,
+                             name='%s %s' % (self.name, name or func.__name__)).start()
 
     def runline(self, line):
         """Sends a command to the protocol module."""
@@ -363,27 +581,68 @@ class Irc():
                 log.error('(%s) The offending hook data was: %s', self.name,
                           hook_args)
                 continue
+        # Once the uplink has finished bursting (and plugins like relay have sent
+        # their own bursts in response), let the next network start linking.
+        if hook_cmd == 'ENDBURST' and numeric == self.uplink:
+            world.coordinator.burstDone(self)
 
-    def send(self, data):
-        """Sends raw text to the uplink server."""
+    def send(self, data, priority=None):
+        """
+        Queues raw text to be sent to the uplink server. priority optionally
+        sets the SendQueue priority class to use; otherwise, it's picked
+        automatically.
+        """
         # Safeguard against newlines in input!! Otherwise, each line gets
         # treated as a separate command, which is particularly nasty.
         data = data.replace('\n', ' ')
-        data = data.encode("utf-8") + b"\n"
-        stripped_data = data.decode("utf-8").strip("\n")
-        log.debug("(%s) -> %s", self.name, stripped_data)
+        log.debug("(%s) -> %s", self.name, data)
+        if not self.sendq.put(data.encode("utf-8") + b"\n", priority=priority):
+            log.debug("(%s) Dropping message %r; network isn't connected!", self.name, data)
+
+    def _sendqNotify(self):
+        """Called by the outbound queue when there is new data to send."""
+        if self.botdata.get('use_event_loop'):
+            selectdriver.wakeup(self)
+
+    def _dispatchNotify(self):
+        """Called by the dispatcher when its queue has drained after filling
+        up, so that reading from the uplink can resume."""
+        if self.botdata.get('use_event_loop'):
+            selectdriver.wakeup(self)
+
+    def _writeLoop(self, sendq, sock):
+        """Writer thread for the connection, used when the shared event loop
+        is disabled. This writes out everything queued in the given
+        SendQueue until it is closed."""
         try:
-            self.socket.send(data)
-        except (OSError, AttributeError):
-            log.debug("(%s) Dropping message %r; network isn't connected!", self.name, stripped_data)
+            while sendq.wait():
+                sendq.flush(sock)
+        except (socket.error, ConnectionError) as e:
+            if sendq.closed:  # We're already disconnecting.
+                return
+            log.warning('(%s) Failed to write to the uplink: %s: %s',
+                        self.name, type(e).__name__, str(e))
+            self.aborted.set()
+            # Wake up the read loop too, so that it notices the disconnect.
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def schedulePing(self):
-        """Schedules periodic pings in a loop."""
-        self.proto.pingServer()
-        self.pingTimer = threading.Timer(self.pingfreq, self.schedulePing)
-        self.pingTimer.daemon = True
-        self.pingTimer.start()
-        log.debug('(%s) Ping scheduled at %s', self.name, time.time())
+        """Schedules periodic pings to the uplink, starting now."""
+        self.pingTimer = world.scheduler.schedule(0, self.proto.pingServer,
+                                                  interval=self.pingfreq,
+                                                  name='%s ping' % self.name)
+        log.debug('(%s) Pings scheduled every %s seconds', self.name, self.pingfreq)
+
+    def scheduleSweep(self):
+        """Schedules periodic removal of empty channels from the channel state."""
+        interval = self.botdata.get('channel_sweep_interval', 300)
+        if interval and interval > 0:
+            self.sweepTimer = world.scheduler.schedule(interval, self.channels.sweep,
+                                                       interval=interval,
+                                                       name='%s channel sweep' % self.name)
 
     def spawnMain(self):
         """Spawns the main PyLink client."""
@@ -404,8 +663,567 @@ class Irc():
     def __repr__(self):
         return "<classes.Irc object for %r>" % self.name
 
+def isKeepalive(line):
+    """Returns whether the given (str) line is a PING or PONG."""
+    args = line.split(' ', 2)
+    command = args[1] if line.startswith(':') and len(args) > 1 else args[0]
+    return command.upper() in ('PING', 'PONG')
+
+class Dispatcher():
+    """
+    Runs incoming lines for an IRC object on a dedicated thread, in the order
+    they were received.
+
+    Lines are queued by the reader in a queue of up to maxsize lines. When it
+    fills up, a blocking reader (one with a connection thread of its own)
+    waits for the dispatcher to catch up. The shared event loop can't wait
+    without holding up every other network, so it queues lines without
+    blocking, and stops reading from the network's socket while isFull() is
+    true; notify is called once the queue has drained to half its size. A
+    warning is logged whenever the queue rises past its high-water mark (80%
+    full).
+    """
+    def __init__(self, irc, maxsize=10000, block=True, notify=None):
+        self.irc = irc
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.maxsize = maxsize
+        self.high_water = max(1, int(maxsize * 0.8))
+        self.low_water = maxsize // 2
+        self.block = block
+        self.notify = notify
+        self.stopped = False
+        self._warned = False
+        # Whether the reader was told that the queue is full, and should be
+        # notified once it drains.
+        self._full = False
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='%s dispatcher' % irc.name)
+
+        # Statistics.
+        self.processed = 0
+        self.max_depth = 0
+
+    def start(self):
+        """Starts the dispatcher thread."""
+        self.thread.start()
+
+    def depth(self):
+        """Returns the number of lines waiting to be processed."""
+        return len(self.queue)
+
+    def isFull(self):
+        """Returns whether the queue is full, in which case the reader should
+        stop reading until it's notified. Once the queue fills up, this stays
+        True until it has drained to half its size."""
+        with self.cond:
+            if len(self.queue) >= self.maxsize and not self.stopped:
+                self._full = True
+            return self._full
+
+    def put(self, line, block=None):
+        """
+        Queues a line to be processed. If the queue is full, this waits for
+        the dispatcher to catch up, unless block (which defaults to the
+        dispatcher's block setting) is False.
+
+        Besides lines, callables (taking no arguments) may be queued, to run
+        them on the dispatcher thread in order with incoming lines.
+        """
+        with self.cond:
+            depth = len(self.queue)
+            self.max_depth = max(self.max_depth, depth)
+            if depth >= self.high_water and not self._warned:
+                log.warning('(%s) Dispatch queue is at %s/%s lines; hooks are '
+                            'falling behind incoming data!', self.irc.name,
+                            depth, self.maxsize)
+                self._warned = True
+            elif self._warned and depth < self.high_water // 2:
+                log.info('(%s) Dispatch queue has caught up (%s/%s lines).',
+                         self.irc.name, depth, self.maxsize)
+                self._warned = False
+            if self.block if block is None else block:
+                while len(self.queue) >= self.maxsize and not self.stopped:
+                    self.cond.wait()
+            if self.stopped:
+                return
+            self.queue.append(line)
+            self.cond.notify_all()
+
+    def run(self):
+        """Main loop for the dispatcher thread."""
+        while True:
+            with self.cond:
+                while not (self.queue or self.stopped):
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                line = self.queue.popleft()
+                # Wake up a reader waiting for room in the queue.
+                self.cond.notify_all()
+                drained = self._full and len(self.queue) <= self.low_water
+                if drained:
+                    self._full = False
+            if drained and self.notify:
+                self.notify()
+
+            if callable(line):
+                try:
+                    line()
+                except Exception:
+                    log.exception('(%s) Unhandled exception caught in queued call %r',
+                                  self.irc.name, line)
+            else:
+                self.irc.runline(line)
+                self.processed += 1
+
+    def stop(self, wait=True):
+        """
+        Stops the dispatcher, dropping any lines that haven't been processed.
+        If wait is True, this also waits for the line it's running (if any)
+        to finish; this should be False when called from a thread that must
+        not be held up by slow hooks, such as the shared event loop.
+        """
+        with self.cond:
+            self.stopped = True
+            self._full = False
+            self.queue.clear()
+            self.cond.notify_all()
+        if wait and threading.current_thread() is not self.thread:
+            self.thread.join()
+
+class LineFramer():
+    """
+    Splits data received from a socket into lines.
+
+    Data is collected in a bytearray, and every complete line in it is split
+    off and decoded in one pass whenever feed() is called, so large bursts
+    don't cost more than the size of the data itself. Lines longer than
+    max_line_length, or more than max_buffer_length bytes of buffered data,
+    raise ProtocolError.
+    """
+    def __init__(self, encoding='utf-8', max_line_length=65536,
+                 max_buffer_length=1048576):
+        self.buffer = bytearray()
+        # FIXME: respect other encodings? Anything not in the given encoding
+        # is replaced with U+FFFD.
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self.max_line_length = max_line_length
+        self.max_buffer_length = max_buffer_length
+
+    def feed(self, data):
+        """Adds data (bytes) to the buffer, and returns a list of all the
+        complete lines in it, with line endings removed."""
+        buf = self.buffer
+        buf += data
+        if len(buf) > self.max_buffer_length:
+            raise ProtocolError('Receive buffer exceeded %s bytes' % self.max_buffer_length)
+
+        end = buf.rfind(b'\n') + 1
+        if not end:  # No complete lines yet.
+            if len(buf) > self.max_line_length:
+                raise ProtocolError('Received a line longer than %s bytes' % self.max_line_length)
+            return []
+
+        # Line lengths are limited in bytes, so check them before decoding,
+        # by looking for each newline within max_line_length bytes of the
+        # previous one (without copying the buffer).
+        limit = self.max_line_length
+        start = 0 if end > limit else end
+        while start < end:
+            newline = buf.find(b'\n', start, start + limit + 1)
+            if newline == -1:
+                break
+            start = newline + 1
+        if start < end or len(buf) - end > limit:
+            raise ProtocolError('Received a line longer than %s bytes' % self.max_line_length)
+
+        with memoryview(buf) as view, view[:end] as chunk:
+            text = self.decoder.decode(chunk)
+        del buf[:end]
+
+        lines = text.split('\n')
+        lines.pop()  # This is always empty, since we split right after a newline.
+        return [line.strip('\r') for line in lines]
+
+class ZlibLink():
+    """
+    Zlib stream compression for a server link (e.g. InspIRCd's m_ziplink),
+    covering everything sent and received on the connection.
+
+    Outgoing data is compressed in batches, with a sync flush after each one
+    so that the uplink can process it right away. Compression ratios in both
+    directions are tracked in sendRatio() and recvRatio().
+    """
+    # Maximum amount of decompressed data to produce at once, so that a small
+    # amount of compressed data can't take up huge amounts of memory. This
+    # must stay well below LineFramer.max_buffer_length, since each chunk is
+    # added to the framer's buffer before any lines are split off.
+    max_chunk_size = 65536
+
+    def __init__(self, level=6):
+        self.compressor = zlib.compressobj(level)
+        self.decompressor = zlib.decompressobj()
+
+        # Statistics.
+        self.bytes_in = 0  # Decompressed bytes received
+        self.compressed_in = 0
+        self.bytes_out = 0  # Uncompressed bytes sent
+        self.compressed_out = 0
+
+    def compress(self, data):
+        """Compresses a batch of outgoing data, and returns it with a sync
+        flush."""
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_out += len(data)
+        self.compressed_out += len(out)
+        return out
+
+    def decompress(self, data):
+        """Decompresses incoming data, yielding it in chunks of at most
+        max_chunk_size bytes. Corrupt data raises ProtocolError."""
+        self.compressed_in += len(data)
+        while True:
+            try:
+                out = self.decompressor.decompress(data, self.max_chunk_size)
+            except zlib.error as e:
+                raise ProtocolError('Failed to decompress data from the uplink: %s' % e)
+            data = self.decompressor.unconsumed_tail
+            self.bytes_in += len(out)
+            yield out
+            # Stop once all input is used up and zlib has nothing more to give.
+            if not data and len(out) < self.max_chunk_size:
+                return
+
+    def sendRatio(self):
+        """Returns the compressed size of outgoing data as a fraction of its
+        original size."""
+        return self.compressed_out / self.bytes_out if self.bytes_out else 1
+
+    def recvRatio(self):
+        """Returns the compressed size of incoming data as a fraction of its
+        original size."""
+        return self.compressed_in / self.bytes_in if self.bytes_in else 1
+
+class SendQueue():
+    """
+    Outbound queue for an IRC connection.
+
+    Lines queued with put() are written out by flush() in batches: everything
+    that can be sent is joined into one buffer and handed to the socket in as
+    few writes as possible. Partial writes are kept in the buffer and resumed
+    on the next flush, so lines are never truncated under load.
+
+    Each line is put in one of four priority classes (KEEPALIVE, STATE, USER,
+    and BURST, from highest to lowest), and higher classes are always sent
+    first. If a bytes-per-second budget (rate) is given, everything except
+    keepalives is paced to fit in it, so that large bursts (e.g. relay
+    introducing thousands of clients) don't overflow the uplink's SendQ or
+    hold up PINGs and live chat.
+
+    Reordering never breaks the protocol: a line is never sent before an
+    earlier line from the same source server (or the line introducing that
+    server), nor before an earlier line from or about any client or channel
+    it names (such as the UID introducing a client, or the last words of a
+    client being killed), and nothing jumps ahead of
+    unsourced link-phase lines such as PASS, CAPAB, and SERVER. To guarantee
+    this, such lines are moved down to the class of the earlier line(s) they
+    depend on.
+
+    If a compressor (ZlibLink) is given, each batch is compressed and flushed
+    as a unit before being written.
+
+    flush() works with both blocking sockets (used by per-network writer
+    threads) and non-blocking ones (used by the shared event loop), where it
+    writes as much as the socket will take.
+    """
+    # Priority classes, from highest to lowest.
+    KEEPALIVE = 0
+    STATE = 1
+    USER = 2
+    BURST = 3
+
+    # Commands sent in the keepalive, user message, and burst classes.
+    # Everything else is considered state-critical.
+    keepalive_commands = {b'PING', b'PONG'}
+    user_commands = {b'PRIVMSG', b'NOTICE'}
+    burst_commands = {b'UID', b'EUID', b'SID', b'SERVER', b'SJOIN', b'FJOIN',
+                      b'BMASK', b'TB', b'FTOPIC', b'METADATA'}
+    # Commands that introduce servers; the SID of the new server is the last
+    # argument before the description.
+    server_commands = {b'SID', b'SERVER'}
+
+    # Window (in seconds) over which bytesPerSecond() is measured.
+    rate_window = 10
+
+    def __init__(self, notify=None, rate=None, compressor=None):
+        self.lock = threading.Condition()
+        self.queues = [deque() for _ in range(4)]
+        # Data taken from the queues that hasn't been (fully) written yet.
+        self.buffer = bytearray()
+        self.closed = False
+        # Function to call when data is queued while the queue is empty.
+        self.notify = notify
+        # Optional ZlibLink used to compress each batch of lines.
+        self.compressor = compressor
+
+        # Tracks how many queued lines each source server, client, and
+        # channel has in each class, as a dict of (key, priority) -> count.
+        self.pending = defaultdict(int)
+
+        # Bytes-per-second budget, or None for no limit. Up to a second's
+        # worth of budget can be saved up.
+        self.rate = rate
+        self.tokens = rate
+        self._refilled = time.time()
+
+        # Statistics.
+        self.bytes_sent = 0
+        self.writes = 0
+        self._samples = deque()
+
+    @staticmethod
+    def _isTarget(arg):
+        """Returns whether a (middle) argument names a channel or a client
+        (UIDs start with the digit of their server's SID, and are 9
+        characters long)."""
+        return arg[:1] in (b'#', b'&') or (len(arg) == 9 and arg[:1].isdigit())
+
+    def classify(self, data):
+        """
+        Returns a tuple of the priority class and the keys of the given line,
+        which it must stay in order with: the source server (the first 3
+        characters of the sender field, or None if there isn't one), the SID
+        introduced by the line (if any), and the clients and channels it's
+        from or about (lowercased): a client sender, and the clients and
+        channels named in its middle arguments.
+        """
+        if data.startswith(b':'):
+            args = data.split(b' ', 2)
+            sender = args[0][1:]
+            source = sender[:3]
+            command = args[1] if len(args) > 1 else b''
+        else:
+            source = None
+            command = data.split(b' ', 1)[0]
+        command = command.strip().upper()
+
+        if command in self.keepalive_commands:
+            return (self.KEEPALIVE, (source,))
+        elif source is None:
+            return (self.STATE, (None,))
+
+        args = data.split(b' :', 1)[0].split()[2:]
+        keys = [source]
+        if command in self.server_commands:
+            keys.append(args[-1][:3])
+        if len(sender) == 9:
+            keys.append(sender.lower())
+        keys += [arg.lower() for arg in args if self._isTarget(arg)]
+        if command in self.user_commands:
+            priority = self.USER
+        elif command in self.burst_commands:
+            priority = self.BURST
+        else:
+            priority = self.STATE
+        return (priority, tuple(keys))
+
+    def put(self, data, priority=None):
+        """
+        Queues a line (bytes) to be sent. The priority class is picked
+        automatically from the line's command, unless given. Returns False if
+        the queue was closed, meaning the line was dropped.
+        """
+        cls, keys = self.classify(data)
+        if priority is not None:
+            cls = priority
+        with self.lock:
+            if self.closed:
+                return False
+            was_empty = not self._hasData()
+
+            if cls == self.KEEPALIVE:
+                # Keepalives may jump ahead of anything but link-phase lines.
+                keys = ()
+                if self.pending.get((None, self.STATE)):
+                    cls = self.STATE
+                    keys = (None,)
+            else:
+                # Move the line down behind earlier lines from the same
+                # source, or from or about the same clients and channels.
+                for lower in (self.BURST, self.USER, self.STATE):
+                    if lower <= cls:
+                        break
+                    if any(self.pending.get((key, lower)) for key in keys):
+                        cls = lower
+                        break
+            for key in keys:
+                self.pending[(key, cls)] += 1
+            self.queues[cls].append((data, keys))
+
+            self.lock.notify()
+        if (was_empty or cls == self.KEEPALIVE) and self.notify:
+            self.notify()
+        return True
+
+    def close(self):
+        """Closes the queue, dropping anything that hasn't been sent."""
+        with self.lock:
+            self.closed = True
+            for queue in self.queues:
+                queue.clear()
+            self.pending.clear()
+            # The writer may still be using the old buffer, so replace it
+            # instead of clearing it in place.
+            self.buffer = bytearray()
+            self.lock.notify_all()
+
+    def _refill(self):
+        """Refills the send budget based on the time passed."""
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _hasData(self):
+        return bool(self.buffer or any(self.queues))
+
+    def hasData(self):
+        """Returns whether there is anything waiting to be sent."""
+        with self.lock:
+            return self._hasData()
+
+    def _nextSendDelay(self):
+        if self.buffer or self.queues[self.KEEPALIVE]:
+            return 0
+        elif not any(self.queues):
+            return None
+        elif not self.rate:
+            return 0
+        self._refill()
+        if self.tokens > 0:
+            return 0
+        return -self.tokens / self.rate + 0.001
+
+    def nextSendDelay(self):
+        """Returns the number of seconds until more data can be sent: 0 if
+        it can be sent now, and None if there is nothing queued."""
+        with self.lock:
+            return self._nextSendDelay()
+
+    def wait(self):
+        """Blocks until there is data that can be sent. Returns False if the
+        queue was closed instead."""
+        with self.lock:
+            while not self.closed:
+                delay = self._nextSendDelay()
+                if delay == 0:
+                    return True
+                self.lock.wait(delay)
+            return False
+
+    def depth(self, priority=None):
+        """Returns the number of lines waiting to be sent, either overall or
+        in the given priority class. A partially written batch counts as one
+        line."""
+        if priority is not None:
+            return len(self.queues[priority])
+        return sum(map(len, self.queues)) + bool(self.buffer)
+
+    def _fill(self):
+        """Moves queued lines that fit in the send budget into the write
+        buffer, highest priority first."""
+        batch = []
+        with self.lock:
+            if self.rate:
+                self._refill()
+            while True:
+                for cls, queue in enumerate(self.queues):
+                    if queue:
+                        break
+                else:
+                    break
+                if self.rate and cls != self.KEEPALIVE:
+                    if self.tokens <= 0:
+                        break
+                    self.tokens -= len(queue[0][0])
+                data, keys = queue.popleft()
+                for key in keys:
+                    self.pending[(key, cls)] -= 1
+                    if not self.pending[(key, cls)]:
+                        del self.pending[(key, cls)]
+                batch.append(data)
+            if batch:
+                data = b''.join(batch)
+                if self.compressor:
+                    data = self.compressor.compress(data)
+                self.buffer += data
+
+    def flush(self, sock):
+        """
+        Writes as much pending data as possible to the socket. Returns True if
+        everything taken from the queue was written, and False if a
+        non-blocking socket couldn't take all of it (call flush() again once
+        it's writable). Lines held back by the send budget stay queued; see
+        nextSendDelay().
+
+        Socket errors other than "would block" are left to the caller.
+        """
+        self._fill()
+        buf = self.buffer
+        while buf and not self.closed:
+            try:
+                with memoryview(buf) as view:
+                    sent = sock.send(view)
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                return False
+            del buf[:sent]
+            self._record(sent)
+            if not buf:
+                # Pick up anything queued while we were writing.
+                self._fill()
+        return True
+
+    def _record(self, sent):
+        """Updates statistics after a write of <sent> bytes."""
+        now = time.time()
+        self.bytes_sent += sent
+        self.writes += 1
+        self._samples.append((now, sent))
+        while self._samples and self._samples[0][0] < now - self.rate_window:
+            self._samples.popleft()
+
+    def bytesPerSecond(self):
+        """Returns the average send rate over the last few seconds."""
+        cutoff = time.time() - self.rate_window
+        return sum(n for ts, n in list(self._samples) if ts >= cutoff) / self.rate_window
+
+def _slotsRepr(obj):
+    """Returns a repr() of a slotted object's attributes, in the style of the
+    __dict__ reprs that PyLink's state classes used to have."""
+    return repr({attr: getattr(obj, attr) for attr in obj.__slots__
+                 if not attr.startswith('_')})
+
 class IrcUser():
-    """PyLink IRC user class."""
+    """PyLink IRC user class.
+
+    Once a user is in irc.users, its nick must only be changed through
+    irc.users.renick(), which keeps the nick index up to date.
+
+    Besides the attributes set from the constructor arguments, these optional
+    fields default to None:
+
+    opertype: The user's oper type (e.g. "IRC Operator"), if known.
+    remote: For relay clients, a (network name, UID) tuple of the user they
+            represent.
+    cloaked_host: The user's cloaked (+x) host, on protocols that send it.
+    """
+    # Slotted to cut down on memory use, since there can be a lot of these.
+    # Plugins that need more fields should add them here, instead of setting
+    # arbitrary attributes.
+    __slots__ = ('nick', 'ts', 'uid', 'ident', 'host', 'realhost', 'ip', 'realname',
+                 'modes', 'identified', 'channels', 'away', 'manipulatable',
+                 'opertype', 'remote', 'cloaked_host')
+
     def __init__(self, nick, ts, uid, ident='null', host='null',
                  realname='PyLink dummy client', realhost='null',
                  ip='0.0.0.0', manipulatable=False):
@@ -417,7 +1235,7 @@ class IrcUser():
         self.realhost = realhost
         self.ip = ip
         self.realname = realname
-        self.modes = set()
+        self.modes = utils.ModeSet()
 
         self.identified = False
         self.channels = set()
@@ -429,8 +1247,213 @@ class IrcUser():
         # For "serious" service clients, this should always be False.
         self.manipulatable = manipulatable
 
+        self.opertype = None
+        self.remote = None
+        self.cloaked_host = None
+
     def __repr__(self):
-        return repr(self.__dict__)
+        return _slotsRepr(self)
+
+class UserMapping(dict):
+    """
+    Dict mapping UIDs to IrcUser objects (irc.users), which also keeps an
+    index of case-folded nicks to UIDs. This lets utils.nickToUid() find users
+    without going over the entire user list.
+
+    Nick changes must be done through renick() to keep the index up to date:
+    setting a user's nick attribute directly isn't supported, and lookups of
+    the new nick won't find the user.
+    """
+    def __init__(self, irc):
+        super().__init__()
+        self.irc = irc
+        # Case-folded nick -> dict of UIDs using it (as an ordered set). There
+        # is usually only one UID per nick, but two users may briefly share one
+        # during a nick collision.
+        self.nicks = {}
+
+    def _fold(self, nick):
+        return utils.toLower(self.irc, nick)
+
+    def _index(self, uid, nick):
+        self.nicks.setdefault(self._fold(nick), {})[uid] = None
+
+    def _unindex(self, uid, nick):
+        folded = self._fold(nick)
+        uids = self.nicks.get(folded)
+        if uids is not None:
+            uids.pop(uid, None)
+            if not uids:
+                del self.nicks[folded]
+
+    def __setitem__(self, uid, user):
+        old = self.get(uid)
+        if old is not None:
+            self._unindex(uid, old.nick)
+        super().__setitem__(uid, user)
+        self._index(uid, user.nick)
+
+    def __delitem__(self, uid):
+        user = self[uid]
+        super().__delitem__(uid)
+        self._unindex(uid, user.nick)
+
+    def pop(self, uid, *default):
+        if uid not in self:
+            if default:
+                return default[0]
+            raise KeyError(uid)
+        user = self[uid]
+        del self[uid]
+        return user
+
+    def popitem(self):
+        uid, user = super().popitem()
+        self._unindex(uid, user.nick)
+        return uid, user
+
+    def setdefault(self, uid, default=None):
+        if uid not in self:
+            self[uid] = default
+        return self[uid]
+
+    def update(self, *args, **kwargs):
+        for uid, user in dict(*args, **kwargs).items():
+            self[uid] = user
+
+    def clear(self):
+        super().clear()
+        self.nicks.clear()
+
+    def reindex(self):
+        """Rebuilds the nick index (e.g. after the casemapping has changed)."""
+        self.nicks.clear()
+        for uid, user in self.items():
+            self._index(uid, user.nick)
+
+    def renick(self, uid, newnick):
+        """Changes the nick of the user with the given UID."""
+        user = self[uid]
+        self._unindex(uid, user.nick)
+        user.nick = newnick
+        self._index(uid, newnick)
+
+    def nickToUid(self, nick):
+        """Returns the UID of the user using the given nick (compared
+        case-insensitively), or None if there isn't one."""
+        folded = self._fold(nick)
+        uids = self.nicks.get(folded)
+        if not uids:
+            return None
+        for uid in list(uids):
+            user = self.get(uid)
+            if user is not None and self._fold(user.nick) == folded:
+                return uid
+            # Stale entry: the user was removed from under us, or (against
+            # the renick() contract) its nick was set directly. Never return
+            # a user that doesn't match, and drop the entry.
+            log.debug('(%s) Fixing stale nick index entry %r for %s', self.irc.name,
+                      folded, uid)
+            self._unindex(uid, nick)
+            if user is not None:
+                self._index(uid, user.nick)
+
+class ServerMapping(dict):
+    """
+    Dict mapping SIDs to IrcServer objects (irc.servers), which also keeps
+    the children set of each server up to date, so that the servers behind a
+    split can be found without going over the entire server list, and an
+    index of server names to SIDs.
+
+    Server renames must be done through rename() to keep the index up to date.
+    """
+    def __init__(self):
+        super().__init__()
+        # Lowercased server name -> SID.
+        self.names = {}
+
+    def _link(self, sid, server):
+        parent = self.get(server.uplink)
+        if parent is not None and server.uplink != sid:
+            parent.children.add(sid)
+        self.names[server.name.lower()] = sid
+
+    def _unlink(self, sid, server):
+        parent = self.get(server.uplink)
+        if parent is not None:
+            parent.children.discard(sid)
+        name = server.name.lower()
+        if self.names.get(name) == sid:
+            del self.names[name]
+
+    def __setitem__(self, sid, server):
+        old = self.get(sid)
+        if old is not None:
+            self._unlink(sid, old)
+            # Servers behind the old entry are now behind the new one.
+            server.children |= old.children
+        super().__setitem__(sid, server)
+        self._link(sid, server)
+
+    def __delitem__(self, sid):
+        server = self[sid]
+        super().__delitem__(sid)
+        self._unlink(sid, server)
+
+    def pop(self, sid, *default):
+        if sid not in self:
+            if default:
+                return default[0]
+            raise KeyError(sid)
+        server = self[sid]
+        del self[sid]
+        return server
+
+    def popitem(self):
+        sid, server = super().popitem()
+        self._unlink(sid, server)
+        return sid, server
+
+    def setdefault(self, sid, default=None):
+        if sid not in self:
+            self[sid] = default
+        return self[sid]
+
+    def update(self, *args, **kwargs):
+        for sid, server in dict(*args, **kwargs).items():
+            self[sid] = server
+
+    def clear(self):
+        super().clear()
+        self.names.clear()
+
+    def rename(self, sid, name):
+        """Changes the name of the server with the given SID."""
+        server = self[sid]
+        oldname = server.name.lower()
+        if self.names.get(oldname) == sid:
+            del self.names[oldname]
+        server.name = name.lower()
+        self.names[server.name] = sid
+
+    def nameToSid(self, name):
+        """Returns the SID of the server with the given name (compared
+        case-insensitively), or None if there isn't one."""
+        sid = self.names.get(name.lower())
+        if sid is not None and sid in self:
+            return sid
+
+    def subtree(self, sid):
+        """
+        Returns a list of the given server's SID and those of every server
+        linked behind it, ordered so that servers come before their uplinks.
+        """
+        servers = [sid]
+        # The list grows as we go, so this walks the whole tree breadth first.
+        for server in servers:
+            servers.extend(self[server].children)
+        servers.reverse()
+        return servers
 
 class IrcServer():
     """PyLink IRC server class.
@@ -439,48 +1462,273 @@ class IrcServer():
             for the main PyLink PseudoServer!
     name: The name of the server.
     internal: Whether the server is an internal PyLink PseudoServer.
+    children: The SIDs of servers linked behind this one. This is kept up to
+              date by ServerMapping (irc.servers).
+    remote: For relay subservers, the name of the network they represent.
+            Defaults to None.
     """
+    __slots__ = ('uplink', 'users', 'children', 'internal', 'name', 'desc', 'remote')
+
     def __init__(self, uplink, name, internal=False, desc="(None given)"):
         self.uplink = uplink
         self.users = set()
+        self.children = set()
         self.internal = internal
         self.name = name.lower()
         self.desc = desc
+        self.remote = None
+    def __repr__(self):
+        return _slotsRepr(self)
+
+# Prefix (status) modes that PyLink tracks for channel members, from highest
+# to lowest rank. Each one is a bit in IrcChannel.status.
+STATUS_MODES = ('owner', 'admin', 'op', 'halfop', 'voice')
+STATUS_FLAGS = {name: 1 << index for index, name in enumerate(STATUS_MODES)}
+
+class StatusView(MutableSet):
+    """
+    Live set-like view of the channel members that have a given prefix mode,
+    as returned by IrcChannel.prefixmodes[<mode>+'s'].
+    """
+    __slots__ = ('channel', 'mode')
+
+    def __init__(self, channel, mode):
+        self.channel = channel
+        self.mode = mode
+
+    def __contains__(self, uid):
+        return self.channel.hasStatus(uid, self.mode)
+
+    def __iter__(self):
+        flag = STATUS_FLAGS[self.mode]
+        return iter([uid for uid, flags in self.channel.status.items() if flags & flag])
+
+    def __len__(self):
+        flag = STATUS_FLAGS[self.mode]
+        return sum(1 for flags in self.channel.status.values() if flags & flag)
+
+    def add(self, uid):
+        self.channel.setStatus(uid, self.mode)
+
+    def discard(self, uid):
+        self.channel.setStatus(uid, self.mode, False)
+
+    def __repr__(self):
+        return repr(set(self))
+
+class PrefixModeMapping(Mapping):
+    """
+    Read view of a channel's prefix modes, mapping 'owners', 'admins', 'ops',
+    'halfops', and 'voices' to StatusView objects. This is what
+    IrcChannel.prefixmodes returns, for callers using the older API.
+    """
+    __slots__ = ('channel',)
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def __getitem__(self, key):
+        if key[:-1] not in STATUS_FLAGS:
+            raise KeyError(key)
+        return StatusView(self.channel, key[:-1])
+
+    def __iter__(self):
+        return (name+'s' for name in STATUS_MODES)
+
+    def __len__(self):
+        return len(STATUS_MODES)
+
     def __repr__(self):
-        return repr(self.__dict__)
+        return repr(dict(self.items()))
 
 class IrcChannel():
     """PyLink IRC channel class."""
+    __slots__ = ('users', 'modes', 'topic', 'ts', 'status', 'topicset', '_shared_modes',
+                 '_shared_status')
+
     def __init__(self):
         # Initialize variables, such as the topic, user list, TS, who's opped, etc.
         self.users = set()
-        self.modes = {('n', None), ('t', None)}
+        self.modes = utils.ModeSet({('n', None), ('t', None)})
         self.topic = ''
         self.ts = int(time.time())
-        self.prefixmodes = {'ops': set(), 'halfops': set(), 'voices': set(),
-                            'owners': set(), 'admins': set()}
+        # Maps UIDs of members with prefix modes (op, voice, etc.) to a bitmask
+        # of STATUS_FLAGS. Members without any prefix modes aren't stored.
+        self.status = {}
 
         # Determines whether a topic has been set here or not. Protocol modules
         # should set this.
         self.topicset = False
 
+        # Whether the mode set and the status dict are shared with a snapshot,
+        # and must be copied before they are changed in place. These are
+        # tracked separately, so that e.g. a ban only copies the mode set.
+        self._shared_modes = False
+        self._shared_status = False
+
     def __repr__(self):
-        return repr(self.__dict__)
+        return _slotsRepr(self)
+
+    @property
+    def prefixmodes(self):
+        """Returns a mapping of prefix mode lists ('ops', 'voices', etc.) to
+        the members that have them."""
+        return PrefixModeMapping(self)
+
+    def unshareModes(self):
+        """Copies the mode set if it's shared with a snapshot. This must be
+        called before changing the mode set in place."""
+        if self._shared_modes:
+            self.modes = self.modes.copy()
+            self._shared_modes = False
+
+    def unshareStatus(self):
+        """Copies the status dict if it's shared with a snapshot."""
+        if self._shared_status:
+            self.status = self.status.copy()
+            self._shared_status = False
+
+    def unshare(self):
+        """Copies both the mode set and the status dict if they're shared
+        with a snapshot."""
+        self.unshareModes()
+        self.unshareStatus()
 
     def removeuser(self, target):
         """Removes a user from a channel."""
-        for s in self.prefixmodes.values():
-            s.discard(target)
+        if target in self.status:
+            self.unshareStatus()
+            del self.status[target]
         self.users.discard(target)
 
+    def setStatus(self, target, mode, value=True):
+        """Sets (or unsets, if value is False) the named prefix mode (e.g. 'op')
+        on a user."""
+        oldflags = self.status.get(target, 0)
+        if value:
+            flags = oldflags | STATUS_FLAGS[mode]
+        else:
+            flags = oldflags & ~STATUS_FLAGS[mode]
+        if flags == oldflags:
+            return
+        self.unshareStatus()
+        if flags:
+            self.status[target] = flags
+        else:
+            del self.status[target]
+
+    def hasStatus(self, target, mode):
+        """Returns whether a user has the named prefix mode (e.g. 'op')."""
+        return bool(self.status.get(target, 0) & STATUS_FLAGS[mode])
+
+    def getPrefixModes(self, target):
+        """Returns a list of the prefix modes a user has, from highest to
+        lowest rank (e.g. ['op', 'voice'])."""
+        flags = self.status.get(target, 0)
+        if not flags:
+            return []
+        return [name for name in STATUS_MODES if flags & STATUS_FLAGS[name]]
+
+    def clearModes(self):
+        """Removes all modes from the channel."""
+        self.modes = utils.ModeSet()
+        self._shared_modes = False
+
+    def clearStatus(self):
+        """Removes all prefix modes from every member."""
+        self.status = {}
+        self._shared_status = False
+
+    def snapshot(self):
+        """
+        Returns a copy of the channel's current state, for hooks that need to
+        see the channel as it was before a change (e.g. the 'oldchan' argument
+        of MODE hooks).
+
+        This is much cheaper than deepcopy(): the mode set and status dict are
+        shared, and each is only copied by the channel once it changes that
+        one (see unshareModes() and unshareStatus()). The member list is the
+        channel's live set, and shouldn't be relied on.
+        """
+        snap = IrcChannel.__new__(IrcChannel)
+        for attr in ('users', 'modes', 'topic', 'ts', 'status', 'topicset'):
+            setattr(snap, attr, getattr(self, attr))
+        snap._shared_modes = self._shared_modes = True
+        snap._shared_status = self._shared_status = True
+        return snap
+
     def deepcopy(self):
         """Returns a deep copy of the channel object."""
         return deepcopy(self)
 
+class ChannelMapping(dict):
+    """
+    Dict mapping channel names to IrcChannel objects (irc.channels).
+
+    Channels are only created by getOrCreate(), which protocol modules call
+    when users join or a channel is burst. Looking up an unknown channel with
+    irc.channels[name] returns a new IrcChannel that is *not* stored, so that
+    lookups never leave empty "phantom" channels behind; these lookups are
+    counted in the phantoms attribute. Since changes made to such a channel
+    would be lost, anything that changes a channel's state (its modes,
+    topic, TS or members) must look it up with getOrCreate().
+
+    Empty channels without the permanent mode (+P) are removed by
+    removeIfEmpty() and sweep().
+    """
+    def __init__(self, irc):
+        super().__init__()
+        self.irc = irc
+        # Number of lookups of channels that didn't exist, and number of empty
+        # channels removed by sweep().
+        self.phantoms = 0
+        self.swept = 0
+
+    def __missing__(self, name):
+        self.phantoms += 1
+        log.debug('(%s) Lookup of unknown channel %r (%s so far)', self.irc.name,
+                  name, self.phantoms)
+        return IrcChannel()
+
+    def getOrCreate(self, name):
+        """Returns the IrcChannel object for the given channel name, creating
+        it if it doesn't exist."""
+        channel = self.get(name)
+        if channel is None:
+            channel = self[name] = IrcChannel()
+        return channel
+
+    def _isEmpty(self, channel):
+        return not (channel.users or (self.irc.cmodes.get('permanent'), None) in channel.modes)
+
+    def removeIfEmpty(self, name):
+        """Removes the given channel if it has no users and isn't permanent.
+        Returns True if the channel was removed."""
+        channel = self.get(name)
+        if channel is not None and self._isEmpty(channel):
+            del self[name]
+            return True
+        return False
+
+    def sweep(self):
+        """Removes all empty, non-permanent channels, and returns how many were
+        removed."""
+        empty = [name for name, channel in self.items() if self._isEmpty(channel)]
+        for name in empty:
+            del self[name]
+        if empty:
+            self.swept += len(empty)
+            log.debug('(%s) Removed %s empty channels: %s', self.irc.name, len(empty), empty)
+        return len(empty)
+
 ### FakeIRC classes, used for test cases
 
 class FakeIRC(Irc):
     """Fake IRC object used for unit tests."""
+    def __init__(self, netname, proto, config=None):
+        # Default to the testing configuration from conf.py.
+        super().__init__(netname, proto, config or conf.testconf)
+
     def connect(self):
         self.messages = []
         self.hookargs = []
@@ -499,7 +1747,7 @@ class FakeIRC(Irc):
             self.hookmsgs.append(hook_args)
             self.callHooks(hook_args)
 
-    def send(self, data):
+    def send(self, data, priority=None):
         self.messages.append(data)
         log.debug('-> ' + data)
 
@@ -529,6 +1777,35 @@ class FakeIRC(Irc):
         self.hookmsgs = []
         return hookmsgs
 
+class IrcMessage():
+    """PyLink IRC message class, for lines split by Protocol.tokenize().
+
+    source: The sender prefix of the line, without its leading ":", or None
+            if the line didn't have one.
+    command: The command name.
+    params: The list of parameters before the trailing one.
+    trailing: The last parameter, if it was sent with a leading ":" (this
+              is the only one that may contain spaces). Otherwise, None.
+    """
+    __slots__ = ('source', 'command', 'params', 'trailing')
+
+    def __init__(self, source, command, params, trailing=None):
+        self.source = source
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+
+    @property
+    def args(self):
+        """Returns all of the message's parameters, including the trailing
+        one, in the format that handle_ABCD() functions take."""
+        if self.trailing is None:
+            return self.params
+        return self.params + [self.trailing]
+
+    def __repr__(self):
+        return _slotsRepr(self)
+
 class Protocol():
     # TODO: Future state-keeping things will go here
     def __init__(self, irc):
@@ -536,6 +1813,88 @@ class Protocol():
         self.casemapping = 'rfc1459'
         self.hook_map = {}
 
+        # Command -> bound handler tables, built on first use by buildHandlers().
+        self.handlers = None
+        self.link_handlers = None
+        # Number of times each incoming command was handled, and the commands
+        # received that we have no handler for.
+        self.command_counts = Counter()
+        self.unknown_commands = Counter()
+
+    def buildHandlers(self):
+        """
+        Builds the tables used to dispatch incoming commands: handle_ABCD()
+        methods (including aliases such as "handle_notice = handle_privmsg")
+        are listed under the command ABCD, and link_ABCD() methods, which
+        handle unprefixed commands sent while linking, under ABCD in a
+        separate table.
+        """
+        handlers = {}
+        link_handlers = {}
+        for attr in dir(self):
+            if attr.startswith('handle_') and attr != 'handle_events':
+                handlers[attr[7:].upper()] = getattr(self, attr)
+            elif attr.startswith('link_') and callable(getattr(self, attr)):
+                link_handlers[attr[5:].upper()] = getattr(self, attr)
+        log.debug('(%s) Built handler tables for %s commands (%s link commands)',
+                  self.irc.name, len(handlers), len(link_handlers))
+        self.handlers = handlers
+        self.link_handlers = link_handlers
+
+    def dispatch(self, numeric, command, args):
+        """
+        Passes an incoming command to its handler, returning the
+        [numeric, command, parsed_args] list to call hooks with, or None.
+        Commands with no handler are counted in self.unknown_commands.
+        """
+        if self.handlers is None:
+            self.buildHandlers()
+        try:
+            func = self.handlers[command]
+        except KeyError:
+            # Commands are matched case-insensitively, but are almost always
+            # sent in upper case already.
+            func = self.handlers.get(command.upper())
+            if func is None:  # Unhandled command
+                self.unknown_commands[command] += 1
+                if self.unknown_commands[command] == 1:
+                    log.debug('(%s) No handler for command %r; ignoring it', self.irc.name,
+                              command)
+                return
+        self.command_counts[command] += 1
+        parsed_args = func(numeric, command, args)
+        if parsed_args is not None:
+            return [numeric, command, parsed_args]
+
+    def dispatchLink(self, msg):
+        """
+        Passes an unprefixed command sent while linking (e.g. SERVER or CAPAB),
+        given as an IrcMessage, to its link_ABCD() handler. Commands with no
+        link handler are counted in self.unknown_commands.
+        """
+        if self.link_handlers is None:
+            self.buildHandlers()
+        command = msg.command
+        try:
+            func = self.link_handlers[command]
+        except KeyError:
+            self.unknown_commands[command] += 1
+            return
+        self.command_counts[command] += 1
+        func(msg.args)
+
+    def tokenize(self, line):
+        """Splits a raw IRC line into an IrcMessage, scanning it only once."""
+        # :70M FJOIN #chat 1423790411 +nt :,10XAAAAAA
+        # -> source '70M', command 'FJOIN', params ['#chat', '1423790411', '+nt'],
+        #    trailing ',10XAAAAAA'
+        source = None
+        if line.startswith(':'):
+            source, _, line = line[1:].partition(' ')
+        line, sep, trailing = line.partition(' :')
+        command, *params = line.split(' ')
+        return IrcMessage(source, command, params, trailing if sep else None)
+
     def parseArgs(self, args):
         """Parses a string of RFC1459-style arguments split into a list, where ":" may
         be used for multi-word arguments that last until the end of a line.
@@ -559,32 +1918,59 @@ class Protocol():
                 break
         return real_args
 
+    def addClient(self, user, server):
+        """Internal function to add a client (an IrcUser object) on the given
+        server to our internal state. Returns the IrcUser object."""
+        uid = user.uid
+        self.irc.users[uid] = user
+        self.irc.servers[server].users.add(uid)
+        self.irc.client_servers[uid] = server
+        if self.irc.servers[server].internal:
+            self.irc.internal_clients.add(uid)
+        return user
+
     def removeClient(self, numeric):
         """Internal function to remove a client from our internal state."""
-        for c, v in self.irc.channels.copy().items():
-            v.removeuser(numeric)
-            # Clear empty non-permanent channels.
-            if not (self.irc.channels[c].users or ((self.irc.cmodes.get('permanent'), None) in self.irc.channels[c].modes)):
-                del self.irc.channels[c]
-            assert numeric not in v.users, "IrcChannel's removeuser() is broken!"
-
-        sid = numeric[:3]
-        log.debug('Removing client %s from self.irc.users', numeric)
-        del self.irc.users[numeric]
-        log.debug('Removing client %s from self.irc.servers[%s].users', numeric, sid)
-        self.irc.servers[sid].users.discard(numeric)
+        self.removeClients([numeric])
+
+    def removeClients(self, numerics):
+        """Internal function to remove multiple clients from our internal state
+        at once (e.g. on netsplits)."""
+        # Channels that lost users, to be checked for emptiness at the end.
+        touched = set()
+        for numeric in numerics:
+            user = self.irc.users[numeric]
+            # Only the channels the user is in need to be looked at.
+            for c in user.channels.copy():
+                v = self.irc.channels.get(c)
+                if v is None:
+                    continue
+                v.removeuser(numeric)
+                touched.add(c)
+                assert numeric not in v.users, "IrcChannel's removeuser() is broken!"
+
+            sid = self.irc.client_servers.pop(numeric, numeric[:3])
+            self.irc.internal_clients.discard(numeric)
+            log.debug('Removing client %s from self.irc.users', numeric)
+            del self.irc.users[numeric]
+            log.debug('Removing client %s from self.irc.servers[%s].users', numeric, sid)
+            self.irc.servers[sid].users.discard(numeric)
+
+        # Clear empty non-permanent channels.
+        for c in touched:
+            self.irc.channels.removeIfEmpty(c)
 
     def updateTS(self, channel, their_ts):
-        our_ts = self.irc.channels[channel].ts
+        c = self.irc.channels.getOrCreate(channel)
+        our_ts = c.ts
         if their_ts < our_ts:
             # Channel timestamp was reset on burst
             log.debug('(%s) Setting channel TS of %s to %s from %s',
                       self.irc.name, channel, their_ts, our_ts)
-            self.irc.channels[channel].ts = their_ts
+            c.ts = their_ts
             # When TS is reset, clear all modes we currently have
-            self.irc.channels[channel].modes.clear()
-            for p in self.irc.channels[channel].prefixmodes.values():
-                p.clear()
+            c.clearModes()
+            c.clearStatus()
 
 class FakeProto(Protocol):
     """Dummy protocol module for testing purposes."""
@@ -601,7 +1987,7 @@ class FakeProto(Protocol):
         return user
 
     def joinClient(self, client, channel):
-        self.irc.channels[channel].users.add(client)
+        self.irc.channels.getOrCreate(channel).users.add(client)
         self.irc.users[client].channels.add(channel)
 
 FakeProto.Class = FakeProto
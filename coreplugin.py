@@ -57,9 +57,9 @@ def handle_whois(irc, source, command, args):
             and not (sourceisOper or source in c.users):
                 continue
         # Show prefix modes like a regular IRCd does.
-        for prefixmode, prefixchar in irc.prefixmodes.items():
-            modename = [mname for mname, char in irc.cmodes.items() if char == prefixmode]
-            if modename and target in c.prefixmodes[modename[0]+'s']:
+        for pmode in c.getPrefixModes(target):
+            prefixchar = irc.prefixmodes.get(irc.cmodes.get(pmode))
+            if prefixchar:
                 chan = prefixchar + chan
         public_chans.append(chan)
     if public_chans:
@@ -70,7 +70,7 @@ def handle_whois(irc, source, command, args):
     # 313: sends a string denoting the target's operator privilege,
     # only if they have umode +o.
     if ('o', None) in user.modes:
-        if hasattr(user, 'opertype'):
+        if user.opertype:
             opertype = user.opertype
         else:
             opertype = "IRC Operator"
@@ -270,10 +270,11 @@ def reload(irc, source, args):
 
 def main(irc=None):
     # This is a global sanity check, to make sure the protocol module is doing
-    # its job.
-    if irc and not irc.connected.wait(2):
+    # its job. It's ran once startup has finished (see ReadinessBarrier in
+    # reconnect.py), so there is no need to wait here.
+    if irc and not irc.connected.is_set():
         log.warning('(%s) IRC network %s (protocol %s) has not set '
-                    'irc.connected state after 2 seconds - this may be a bug '
-                    'in the protocol module, and will cause plugins like '
-                    'relay to not work correctly!', irc.name, irc.name,
-                    irc.protoname)
+                    'irc.connected state by the end of startup - either its '
+                    'uplink is unreachable, or this is a bug in the protocol '
+                    'module, which will cause plugins like relay to not work '
+                    'correctly!', irc.name, irc.name, irc.protoname)
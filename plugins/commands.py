@@ -129,7 +129,6 @@ def showchan(irc, source, args):
         return
 
     nicks = [irc.users[u].nick for u in c.users]
-    pmodes = ('owner', 'admin', 'op', 'halfop', 'voice')
 
     f('Information on channel \x02%s\x02:' % channel)
     f('\x02Channel topic\x02: %s' % c.topic)
@@ -143,7 +142,7 @@ def showchan(irc, source, args):
         for user, nick in sorted(zip(c.users, nicks),
                                  key=lambda userpair: userpair[1].lower()):
             prefixmodes = [irc.prefixmodes.get(irc.cmodes.get(pmode, ''), '')
-                           for pmode in pmodes if user in c.prefixmodes[pmode+'s']]
+                           for pmode in c.getPrefixModes(user)]
             nicklist.append(''.join(prefixmodes) + nick)
 
         while nicklist[:20]:  # 20 nicks per line to prevent message cutoff.
@@ -4,8 +4,6 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import threading
-
 import conf
 import utils
 import world
@@ -46,12 +44,11 @@ def connect(irc, source, args):
     except KeyError:  # Unknown network.
         irc.reply('Error: No such network "%s" (case sensitive).' % netname)
         return
-    if network.connection_thread.is_alive():
+    if network.isRunning():
         irc.reply('Error: Network "%s" seems to be already connected.' % netname)
     else:  # Reconnect the network!
         network.initVars()
-        network.connection_thread = threading.Thread(target=network.connect)
-        network.connection_thread.start()
+        network.start()
         irc.reply("Done.")
 
 @utils.add_cmd
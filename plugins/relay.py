@@ -3,7 +3,6 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import pickle
-import sched
 import threading
 import string
 from collections import defaultdict
@@ -22,6 +21,7 @@ spawnlocks_servers = defaultdict(threading.RLock)
 savecache = ExpiringDict(max_len=5, max_age_seconds=10)
 killcache = ExpiringDict(max_len=5, max_age_seconds=10)
 relay_started = True
+exportdb_task = None
 
 dbname = utils.getDatabaseName('pylinkrelay')
 
@@ -29,10 +29,9 @@ dbname = utils.getDatabaseName('pylinkrelay')
 
 def initializeAll(irc):
     """Initializes all relay channels for the given IRC object."""
-    # Wait for all IRC objects to initialize first. This prevents
-    # relay servers from being spawned too early (before server authentication),
-    # which would break connections.
-    world.started.wait(2)
+    # This doesn't wait for other networks to finish linking: those that
+    # haven't connected yet are skipped here, and get initialized on their
+    # own ENDBURST. Waiting would only hold up this network's burst slot.
     for chanpair, entrydata in db.items():
         network, channel = chanpair
         initializeChannel(irc, channel)
@@ -42,16 +41,12 @@ def initializeAll(irc):
 
 def main(irc=None):
     """Main function, called during plugin loading at start."""
-    global relay_started
+    global relay_started, exportdb_task
     relay_started = True
     loadDB()
-    world.schedulers['relaydb'] = scheduler = sched.scheduler()
-    scheduler.enter(30, 1, exportDB, argument=(True,))
-    # Thread this because exportDB() queues itself as part of its
-    # execution, in order to get a repeating loop.
-    thread = threading.Thread(target=scheduler.run)
-    thread.daemon = True
-    thread.start()
+    # Export the database every 30 seconds.
+    exportdb_task = world.scheduler.schedule(30, exportDB, interval=30,
+                                             name='relay database export')
     if irc is not None:
         for ircobj in world.networkobjects.values():
             initializeAll(ircobj)
@@ -60,12 +55,14 @@ def die(sourceirc):
     """Deinitialize PyLink Relay by quitting all relay clients."""
     global relay_started
     relay_started = False
+    if exportdb_task:
+        exportdb_task.cancel()
     for irc in world.networkobjects.values():
         for user in irc.users.copy():
             if isRelayClient(irc, user):
                 irc.proto.quitClient(user, "Relay plugin unloaded.")
         for server, sobj in irc.servers.copy().items():
-            if hasattr(sobj, 'remote'):
+            if sobj.remote:
                 irc.proto.squitServer(irc.sid, server, text="Relay plugin unloaded.")
     relayservers.clear()
     relayusers.clear()
@@ -140,34 +137,29 @@ def loadDB():
             ", creating a new one in memory...", dbname)
         db = {}
 
-def exportDB(reschedule=False):
-    """Exports the relay database, optionally creating a loop to do this
-    automatically."""
-    scheduler = world.schedulers.get('relaydb')
-    if reschedule and scheduler and relay_started:
-        scheduler.enter(30, 1, exportDB, argument=(True,))
+def exportDB():
+    """Exports the relay database."""
     log.debug("Relay: exporting links database to %s", dbname)
     with open(dbname, 'wb') as f:
         pickle.dump(db, f, protocol=4)
 
-def getPrefixModes(irc, remoteirc, channel, user, mlist=None):
+def getPrefixModes(irc, remoteirc, channel, user, chanobj=None):
     """
     Fetches all prefix modes for a user in a channel that are supported by the
     remote IRC network given.
 
-    Optionally, an mlist argument can be given to look at an earlier state of
+    Optionally, a chanobj argument can be given to look at an earlier state of
     the channel, e.g. for checking the op  status of a mode setter before their
     modes are processed and added to the channel state.
     """
     modes = ''
-    mlist = mlist or irc.channels[channel].prefixmodes
-    for pmode in ('owner', 'admin', 'op', 'halfop', 'voice'):
+    chanobj = chanobj or irc.channels[channel]
+    pmodes = chanobj.getPrefixModes(user)
+    log.debug('(%s) getPrefixModes: prefix modes for %r on %s are %r',
+              irc.name, user, channel, pmodes)
+    for pmode in pmodes:
         if pmode in remoteirc.cmodes:  # Mode supported by IRCd
-            userlist = mlist[pmode+'s']
-            log.debug('(%s) getPrefixModes: checking if %r is in %s list: %r',
-                      irc.name, user, pmode, userlist)
-            if user in userlist:
-                modes += remoteirc.cmodes[pmode]
+            modes += remoteirc.cmodes[pmode]
     return modes
 
 def getRemoteSid(irc, remoteirc):
@@ -230,7 +222,7 @@ def getRemoteUser(irc, remoteirc, user, spawnIfMissing=True):
             modes = set(getSupportedUmodes(irc, remoteirc, userobj.modes))
             opertype = ''
             if ('o', None) in userobj.modes:
-                if hasattr(userobj, 'opertype'):
+                if userobj.opertype:
                     # InspIRCd's special OPERTYPE command; this is mandatory
                     # and setting of umode +/-o will fail unless this
                     # is used instead. This also sets an oper type for
@@ -288,7 +280,7 @@ def getOrigUser(irc, user, targetirc=None):
     # First, iterate over everyone!
     try:
         remoteuser = irc.users[user].remote
-    except (AttributeError, KeyError):
+    except KeyError:
         remoteuser = None
     log.debug('(%s) getOrigUser: remoteuser set to %r (looking up %s/%s).',
               irc.name, remoteuser, user, irc.name)
@@ -409,13 +401,9 @@ def checkClaim(irc, channel, sender, chanobj=None):
     6) The sender is a PyLink client/server (checks are suppressed in this case).
     """
     relay = getRelay((irc.name, channel))
-    try:
-        mlist = chanobj.prefixmodes
-    except AttributeError:
-        mlist = None
-    sender_modes = getPrefixModes(irc, irc, channel, sender, mlist=mlist)
-    log.debug('(%s) relay.checkClaim: sender modes (%s/%s) are %s (mlist=%s)', irc.name,
-              sender, channel, sender_modes, mlist)
+    sender_modes = getPrefixModes(irc, irc, channel, sender, chanobj=chanobj)
+    log.debug('(%s) relay.checkClaim: sender modes (%s/%s) are %s', irc.name,
+              sender, channel, sender_modes)
     return (not relay) or irc.name == relay[0] or not db[relay]['claim'] or \
         irc.name in db[relay]['claim'] or \
         any([mode in sender_modes for mode in ('y', 'q', 'a', 'o', 'h')]) \
@@ -459,8 +447,6 @@ def isRelayClient(irc, user):
             # Is the .remote attribute set? If so, don't relay already
             # relayed clients; that'll trigger an endless loop!
             return True
-    except AttributeError:  # Nope, it isn't.
-        pass
     except KeyError:  # The user doesn't exist?!?
         return True
     return False
@@ -579,10 +565,10 @@ def relayModes(irc, remoteirc, sender, channel, modes=None):
                     log.debug("(%s) Relay mode: argument found as (%r, %r) "
                               "for network %r.",
                               irc.name, modechar, arg, remoteirc.name)
-                    oplist = remoteirc.channels[remotechan].prefixmodes[name+'s']
-                    log.debug("(%s) Relay mode: list of %ss on %r is: %s",
-                              irc.name, name, remotechan, oplist)
-                    if prefix == '+' and arg in oplist:
+                    has_mode = remoteirc.channels[remotechan].hasStatus(arg, name)
+                    log.debug("(%s) Relay mode: %r has %s on %r: %s",
+                              irc.name, arg, name, remotechan, has_mode)
+                    if prefix == '+' and has_mode:
                         # Don't set prefix modes that are already set.
                         log.debug("(%s) Relay mode: skipping setting %s on %s/%s because it appears to be already set.",
                                   irc.name, name, arg, remoteirc.name)
@@ -891,10 +877,15 @@ def handle_mode(irc, numeric, command, args):
             if checkClaim(irc, target, numeric, chanobj=oldchan):
                 relayModes(irc, remoteirc, numeric, target, modes)
             else:  # Mode change blocked by CLAIM.
-                reversed_modes = utils.reverseModes(irc, target, modes, oldobj=oldchan)
+                # Use the undo record from applyModes() if the protocol module
+                # gave us one; it has the exact old arguments for +k, +l, etc.
+                reversed_modes = args.get('undo')
+                if reversed_modes is None:
+                    reversed_modes = utils.reverseModes(irc, target, modes, oldobj=oldchan)
                 log.debug('(%s) Reversing mode changes of %r with %r (CLAIM).',
                           irc.name, modes, reversed_modes)
-                irc.proto.modeClient(irc.pseudoclient.uid, target, reversed_modes)
+                if reversed_modes:
+                    irc.proto.modeClient(irc.pseudoclient.uid, target, reversed_modes)
                 break
         else:
             # Set hideoper on remote opers, to prevent inflating
@@ -940,7 +931,7 @@ utils.add_hook(handle_topic, 'TOPIC')
 def handle_kill(irc, numeric, command, args):
     target = args['target']
     userdata = args['userdata']
-    realuser = getOrigUser(irc, target) or userdata.__dict__.get('remote')
+    realuser = getOrigUser(irc, target) or (userdata and userdata.remote)
     log.debug('(%s) relay handle_kill: realuser is %r', irc.name, realuser)
     # Target user was remote:
     if realuser and realuser[0] != irc.name:
@@ -44,10 +44,9 @@ class InspIRCdProtocol(TS6BaseProtocol):
         realname = realname or self.irc.botdata['realname']
         realhost = realhost or host
         raw_modes = utils.joinModes(modes)
-        u = self.irc.users[uid] = IrcUser(nick, ts, uid, ident=ident, host=host, realname=realname,
-            realhost=realhost, ip=ip, manipulatable=manipulatable)
+        u = self.addClient(IrcUser(nick, ts, uid, ident=ident, host=host, realname=realname,
+            realhost=realhost, ip=ip, manipulatable=manipulatable), server)
         utils.applyModes(self.irc, uid, modes)
-        self.irc.servers[server].users.add(uid)
         self._send(server, "UID {uid} {ts} {nick} {realhost} {host} {ident} {ip}"
                         " {ts} {modes} + :{realname}".format(ts=ts, host=host,
                                                  nick=nick, ident=ident, uid=uid,
@@ -68,7 +67,7 @@ class InspIRCdProtocol(TS6BaseProtocol):
             log.error('(%s) Error trying to join client %r to %r (no such pseudoclient exists)', self.irc.name, client, channel)
             raise LookupError('No such PyLink PseudoClient exists.')
         # Strip out list-modes, they shouldn't be ever sent in FJOIN.
-        modes = [m for m in self.irc.channels[channel].modes if m[0] not in self.irc.cmodes['*A']]
+        modes = [m for m in self.irc.channels.getOrCreate(channel).modes if m[0] not in self.irc.cmodes['*A']]
         self._send(server, "FJOIN {channel} {ts} {modes} :,{uid}".format(
                 ts=self.irc.channels[channel].ts, uid=client, channel=channel,
                 modes=utils.joinModes(modes)))
@@ -93,7 +92,7 @@ class InspIRCdProtocol(TS6BaseProtocol):
         if not server:
             raise LookupError('No such PyLink PseudoClient exists.')
 
-        orig_ts = self.irc.channels[channel].ts
+        orig_ts = self.irc.channels.getOrCreate(channel).ts
         ts = ts or orig_ts
         self.updateTS(channel, ts)
 
@@ -136,13 +135,7 @@ class InspIRCdProtocol(TS6BaseProtocol):
         set the opertype attribute of an IrcUser object (in self.irc.users),
         and the change will be reflected here."""
         userobj = self.irc.users[target]
-        try:
-            otype = opertype or userobj.opertype or 'IRC Operator'
-        except AttributeError:
-            log.debug('(%s) opertype field for %s (%s) isn\'t filled yet!',
-                      self.irc.name, target, userobj.nick)
-            # whatever, this is non-standard anyways.
-            otype = 'IRC Operator'
+        otype = opertype or userobj.opertype or 'IRC Operator'
         assert otype, "Tried to send an empty OPERTYPE!"
         log.debug('(%s) Sending OPERTYPE from %s to oper them up.',
                   self.irc.name, target)
@@ -211,8 +204,9 @@ class InspIRCdProtocol(TS6BaseProtocol):
         ts = int(time.time())
         servername = self.irc.servers[numeric].name
         self._send(numeric, 'FTOPIC %s %s %s :%s' % (target, ts, servername, text))
-        self.irc.channels[target].topic = text
-        self.irc.channels[target].topicset = True
+        c = self.irc.channels.getOrCreate(target)
+        c.topic = text
+        c.topicset = True
 
     def inviteClient(self, numeric, target, channel):
         """Sends an INVITE from a PyLink client.."""
@@ -280,9 +274,8 @@ class InspIRCdProtocol(TS6BaseProtocol):
         assert len(sid) == 3, "Incorrect SID length"
         if sid in self.irc.servers:
             raise ValueError('A server with SID %r already exists!' % sid)
-        for server in self.irc.servers.values():
-            if name == server.name:
-                raise ValueError('A server named %r already exists!' % name)
+        if self.irc.servers.nameToSid(name):
+            raise ValueError('A server named %r already exists!' % name)
         if not utils.isInternalServer(self.irc, uplink):
             raise ValueError('Server %r is not a PyLink internal PseudoServer!' % uplink)
         if not utils.isServerName(name):
@@ -316,87 +309,80 @@ class InspIRCdProtocol(TS6BaseProtocol):
         """Event handler for the InspIRCd protocol.
 
         This passes most commands to the various handle_ABCD() functions
-        elsewhere in this module, but also handles commands sent in the
-        initial server linking phase."""
+        elsewhere in this module, and commands sent in the initial server
+        linking phase to the link_ABCD() functions."""
         # Each server message looks something like this:
         # :70M FJOIN #chat 1423790411 +AFPfjnt 6:5 7:5 9:5 :v,1SRAAESWE
         # :<sid> <command> <argument1> <argument2> ... :final multi word argument
-        args = data.split(" ")
-        if not args:
+        msg = self.tokenize(data)
+        if not msg.command:
             # No data??
             return
-        if args[0] == 'SERVER':
-           # <- SERVER whatever.net abcdefgh 0 10X :something
-           servername = args[1].lower()
-           numeric = args[4]
-           if args[2] != self.irc.serverdata['recvpass']:
-                # Check if recvpass is correct
-                raise ProtocolError('Error: recvpass from uplink server %s does not match configuration!' % servername)
-           sdesc = ' '.join(args).split(':', 1)[1]
-           self.irc.servers[numeric] = IrcServer(None, servername, desc=sdesc)
-           self.irc.uplink = numeric
-           return
-        elif args[0] == 'CAPAB':
-            # Capability negotiation with our uplink
-            if args[1] == 'CHANMODES':
-                # <- CAPAB CHANMODES :admin=&a allowinvite=A autoop=w ban=b banexception=e blockcolor=c c_registered=r exemptchanops=X filter=g flood=f halfop=%h history=H invex=I inviteonly=i joinflood=j key=k kicknorejoin=J limit=l moderated=m nickflood=F noctcp=C noextmsg=n nokick=Q noknock=K nonick=N nonotice=T official-join=!Y op=@o operonly=O opmoderated=U owner=~q permanent=P private=p redirect=L reginvite=R regmoderated=M secret=s sslonly=z stripcolor=S topiclock=t voice=+v
-
-                # Named modes are essential for a cross-protocol IRC service. We
-                # can use InspIRCd as a model here and assign a similar mode map to our cmodes list.
-                for modepair in args[2:]:
-                    name, char = modepair.split('=')
-                    if name == 'reginvite':  # Reginvite? That's a dumb name.
-                        name = 'regonly'
-                    if name == 'founder':  # Channel mode +q
-                        # Founder, owner; same thing. m_customprefix allows you to name it anything you like
-                        # (the former is config default, but I personally prefer the latter.)
-                        name = 'owner'
-                    # We don't really care about mode prefixes; just the mode char
-                    self.irc.cmodes[name.lstrip(':')] = char[-1]
-            elif args[1] == 'USERMODES':
-                # <- CAPAB USERMODES :bot=B callerid=g cloak=x deaf_commonchan=c helpop=h hidechans=I hideoper=H invisible=i oper=o regdeaf=R servprotect=k showwhois=W snomask=s u_registered=r u_stripcolor=S wallops=w
-                # Ditto above.
-                for modepair in args[2:]:
-                    name, char = modepair.split('=')
-                    self.irc.umodes[name.lstrip(':')] = char
-            elif args[1] == 'CAPABILITIES':
-                # <- CAPAB CAPABILITIES :NICKMAX=21 CHANMAX=64 MAXMODES=20 IDENTMAX=11 MAXQUIT=255 MAXTOPIC=307 MAXKICK=255 MAXGECOS=128 MAXAWAY=200 IP6SUPPORT=1 PROTOCOL=1202 PREFIX=(Yqaohv)!~&@%+ CHANMODES=IXbegw,k,FHJLfjl,ACKMNOPQRSTUcimnprstz USERMODES=,,s,BHIRSWcghikorwx GLOBOPS=1 SVSPART=1
-                caps = dict([x.lstrip(':').split('=') for x in args[2:]])
-                protocol_version = int(caps['PROTOCOL'])
-                if protocol_version < 1202:
-                    raise ProtocolError("Remote protocol version is too old! At least 1202 (InspIRCd 2.0.x) is needed. (got %s)" % protocol_version)
-                self.irc.maxnicklen = int(caps['NICKMAX'])
-                self.irc.maxchanlen = int(caps['CHANMAX'])
-                # Modes are divided into A, B, C, and D classes
-                # See http://www.irc.org/tech_docs/005.html
-
-                # FIXME: Find a better way to assign/store this.
-                self.irc.cmodes['*A'], self.irc.cmodes['*B'], self.irc.cmodes['*C'], self.irc.cmodes['*D'] \
-                    = caps['CHANMODES'].split(',')
-                self.irc.umodes['*A'], self.irc.umodes['*B'], self.irc.umodes['*C'], self.irc.umodes['*D'] \
-                    = caps['USERMODES'].split(',')
-                prefixsearch = re.search(r'\(([A-Za-z]+)\)(.*)', caps['PREFIX'])
-                self.irc.prefixmodes = dict(zip(prefixsearch.group(1), prefixsearch.group(2)))
-                log.debug('(%s) self.irc.prefixmodes set to %r', self.irc.name, self.irc.prefixmodes)
-                # Sanity check: set this AFTER we fetch the capabilities for the network!
-                self.irc.connected.set()
-        try:
-            args = self.parseTS6Args(args)
-            numeric = args[0]
-            command = args[1]
-            args = args[2:]
-        except IndexError:
+        if msg.source is None:
+            # Commands without a sender prefix are only sent while linking.
+            self.dispatchLink(msg)
             return
+        return self.dispatch(msg.source, msg.command, msg.args)
 
-        # We will do wildcard event handling here. Unhandled events are just ignored.
-        try:
-            func = getattr(self, 'handle_'+command.lower())
-        except AttributeError:  # unhandled event
-            pass
-        else:
-            parsed_args = func(numeric, command, args)
-            if parsed_args is not None:
-                return [numeric, command, parsed_args]
+    def link_server(self, args):
+        """Handles the uplink's SERVER command, sent while linking."""
+        # <- SERVER whatever.net abcdefgh 0 10X :something
+        servername = args[0].lower()
+        numeric = args[3]
+        if args[1] != self.irc.serverdata['recvpass']:
+            # Check if recvpass is correct
+            raise ProtocolError('Error: recvpass from uplink server %s does not match configuration!' % servername)
+        self.irc.servers[numeric] = IrcServer(None, servername, desc=args[-1])
+        self.irc.uplink = numeric
+
+    def link_capab(self, args):
+        """Handles capability negotiation with our uplink (CAPAB)."""
+        if args[0] == 'CHANMODES':
+            # <- CAPAB CHANMODES :admin=&a allowinvite=A autoop=w ban=b banexception=e blockcolor=c c_registered=r exemptchanops=X filter=g flood=f halfop=%h history=H invex=I inviteonly=i joinflood=j key=k kicknorejoin=J limit=l moderated=m nickflood=F noctcp=C noextmsg=n nokick=Q noknock=K nonick=N nonotice=T official-join=!Y op=@o operonly=O opmoderated=U owner=~q permanent=P private=p redirect=L reginvite=R regmoderated=M secret=s sslonly=z stripcolor=S topiclock=t voice=+v
+
+            # Named modes are essential for a cross-protocol IRC service. We
+            # can use InspIRCd as a model here and assign a similar mode map to our cmodes list.
+            for modepair in ' '.join(args[1:]).split():
+                name, char = modepair.split('=')
+                if name == 'reginvite':  # Reginvite? That's a dumb name.
+                    name = 'regonly'
+                if name == 'founder':  # Channel mode +q
+                    # Founder, owner; same thing. m_customprefix allows you to name it anything you like
+                    # (the former is config default, but I personally prefer the latter.)
+                    name = 'owner'
+                # We don't really care about mode prefixes; just the mode char
+                self.irc.cmodes[name] = char[-1]
+        elif args[0] == 'USERMODES':
+            # <- CAPAB USERMODES :bot=B callerid=g cloak=x deaf_commonchan=c helpop=h hidechans=I hideoper=H invisible=i oper=o regdeaf=R servprotect=k showwhois=W snomask=s u_registered=r u_stripcolor=S wallops=w
+            # Ditto above.
+            for modepair in ' '.join(args[1:]).split():
+                name, char = modepair.split('=')
+                self.irc.umodes[name] = char
+        elif args[0] == 'CAPABILITIES':
+            # <- CAPAB CAPABILITIES :NICKMAX=21 CHANMAX=64 MAXMODES=20 IDENTMAX=11 MAXQUIT=255 MAXTOPIC=307 MAXKICK=255 MAXGECOS=128 MAXAWAY=200 IP6SUPPORT=1 PROTOCOL=1202 PREFIX=(Yqaohv)!~&@%+ CHANMODES=IXbegw,k,FHJLfjl,ACKMNOPQRSTUcimnprstz USERMODES=,,s,BHIRSWcghikorwx GLOBOPS=1 SVSPART=1
+            caps = dict([x.split('=') for x in ' '.join(args[1:]).split()])
+            protocol_version = int(caps['PROTOCOL'])
+            if protocol_version < 1202:
+                raise ProtocolError("Remote protocol version is too old! At least 1202 (InspIRCd 2.0.x) is needed. (got %s)" % protocol_version)
+            # Newer InspIRCd versions tell us which casemapping they use.
+            if caps.get('CASEMAPPING') in utils.casemappings:
+                self.casemapping = caps['CASEMAPPING']
+            self.irc.maxnicklen = int(caps['NICKMAX'])
+            self.irc.maxchanlen = int(caps['CHANMAX'])
+            # Modes are divided into A, B, C, and D classes
+            # See http://www.irc.org/tech_docs/005.html
+
+            # FIXME: Find a better way to assign/store this.
+            self.irc.cmodes['*A'], self.irc.cmodes['*B'], self.irc.cmodes['*C'], self.irc.cmodes['*D'] \
+                = caps['CHANMODES'].split(',')
+            self.irc.umodes['*A'], self.irc.umodes['*B'], self.irc.umodes['*C'], self.irc.umodes['*D'] \
+                = caps['USERMODES'].split(',')
+            prefixsearch = re.search(r'\(([A-Za-z]+)\)(.*)', caps['PREFIX'])
+            self.irc.prefixmodes = dict(zip(prefixsearch.group(1), prefixsearch.group(2)))
+            log.debug('(%s) self.irc.prefixmodes set to %r', self.irc.name, self.irc.prefixmodes)
+            utils.compileModeTables(self.irc)
+            # Sanity check: set this AFTER we fetch the capabilities for the network!
+            self.irc.connected.set()
 
     def handle_ping(self, source, command, args):
         """Handles incoming PING commands, so we don't time out."""
@@ -422,7 +408,7 @@ class InspIRCdProtocol(TS6BaseProtocol):
         userlist = args[-1].split()
 
         their_ts = int(args[1])
-        our_ts = self.irc.channels[channel].ts
+        our_ts = self.irc.channels.getOrCreate(channel).ts
         self.updateTS(channel, their_ts)
 
         modestring = args[2:-1] or args[2]
@@ -443,11 +429,10 @@ class InspIRCdProtocol(TS6BaseProtocol):
         # :70M UID 70MAAAAAB 1429934638 GL 0::1 hidden-7j810p.9mdf.lrek.0000.0000.IP gl 0::1 1429934638 +Wioswx +ACGKNOQXacfgklnoqvx :realname
         uid, ts, nick, realhost, host, ident, ip = args[0:7]
         realname = args[-1]
-        self.irc.users[uid] = IrcUser(nick, ts, uid, ident, host, realname, realhost, ip)
+        self.addClient(IrcUser(nick, ts, uid, ident, host, realname, realhost, ip), numeric)
         parsedmodes = utils.parseModes(self.irc, uid, [args[8], args[9]])
         log.debug('Applying modes %s for %s', parsedmodes, uid)
         utils.applyModes(self.irc, uid, parsedmodes)
-        self.irc.servers[numeric].users.add(uid)
         return {'uid': uid, 'ts': ts, 'nick': nick, 'realhost': realhost, 'host': host, 'ident': ident, 'ip': ip}
 
     def handle_server(self, numeric, command, args):
@@ -465,13 +450,16 @@ class InspIRCdProtocol(TS6BaseProtocol):
         """Handles the FMODE command, used for channel mode changes."""
         # <- :70MAAAAAA FMODE #chat 1433653462 +hhT 70MAAAAAA 70MAAAAAD
         channel = utils.toLower(self.irc, args[0])
-        oldobj = self.irc.channels[channel].deepcopy()
+        if channel not in self.irc.channels:
+            log.debug('(%s) Ignoring FMODE for unknown channel %s', self.irc.name, channel)
+            return
+        oldobj = self.irc.channels[channel].snapshot()
         modes = args[2:]
         changedmodes = utils.parseModes(self.irc, channel, modes)
-        utils.applyModes(self.irc, channel, changedmodes)
+        undo = utils.applyModes(self.irc, channel, changedmodes)
         ts = int(args[1])
         return {'target': channel, 'modes': changedmodes, 'ts': ts,
-                'oldchan': oldobj}
+                'oldchan': oldobj, 'undo': undo}
 
     def handle_mode(self, numeric, command, args):
         """Handles incoming user mode changes."""
@@ -499,8 +487,9 @@ class InspIRCdProtocol(TS6BaseProtocol):
         ts = args[1]
         setter = args[2]
         topic = args[-1]
-        self.irc.channels[channel].topic = topic
-        self.irc.channels[channel].topicset = True
+        c = self.irc.channels.getOrCreate(channel)
+        c.topic = topic
+        c.topicset = True
         return {'channel': channel, 'setter': setter, 'ts': ts, 'topic': topic}
 
     # SVSTOPIC is used by InspIRCd module m_topiclock - its arguments are the same as FTOPIC
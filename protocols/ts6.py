@@ -8,6 +8,7 @@ curdir = os.path.dirname(__file__)
 sys.path += [curdir, os.path.dirname(curdir)]
 import utils
 from log import log
+import world
 
 from classes import *
 from ts6_common import TS6BaseProtocol
@@ -40,10 +41,9 @@ class TS6Protocol(TS6BaseProtocol):
         realname = realname or self.irc.botdata['realname']
         realhost = realhost or host
         raw_modes = utils.joinModes(modes)
-        u = self.irc.users[uid] = IrcUser(nick, ts, uid, ident=ident, host=host, realname=realname,
-            realhost=realhost, ip=ip, manipulatable=manipulatable)
+        u = self.addClient(IrcUser(nick, ts, uid, ident=ident, host=host, realname=realname,
+            realhost=realhost, ip=ip, manipulatable=manipulatable), server)
         utils.applyModes(self.irc, uid, modes)
-        self.irc.servers[server].users.add(uid)
         self._send(server, "EUID {nick} 1 {ts} {modes} {ident} {host} {ip} {uid} "
                 "{realhost} * :{realname}".format(ts=ts, host=host,
                 nick=nick, ident=ident, uid=uid,
@@ -59,7 +59,7 @@ class TS6Protocol(TS6BaseProtocol):
         if not utils.isInternalClient(self.irc, client):
             log.error('(%s) Error trying to join client %r to %r (no such pseudoclient exists)', self.irc.name, client, channel)
             raise LookupError('No such PyLink PseudoClient exists.')
-        self._send(client, "JOIN {ts} {channel} +".format(ts=self.irc.channels[channel].ts, channel=channel))
+        self._send(client, "JOIN {ts} {channel} +".format(ts=self.irc.channels.getOrCreate(channel).ts, channel=channel))
         self.irc.channels[channel].users.add(client)
         self.irc.users[client].channels.add(channel)
 
@@ -90,7 +90,7 @@ class TS6Protocol(TS6BaseProtocol):
         if not server:
             raise LookupError('No such PyLink PseudoClient exists.')
 
-        orig_ts = self.irc.channels[channel].ts
+        orig_ts = self.irc.channels.getOrCreate(channel).ts
         ts = ts or orig_ts
         self.updateTS(channel, ts)
 
@@ -199,8 +199,9 @@ class TS6Protocol(TS6BaseProtocol):
         ts = self.irc.channels[target].ts
         servername = self.irc.servers[numeric].name
         self._send(numeric, 'TB %s %s %s :%s' % (target, ts, servername, text))
-        self.irc.channels[target].topic = text
-        self.irc.channels[target].topicset = True
+        c = self.irc.channels.getOrCreate(target)
+        c.topic = text
+        c.topicset = True
 
     def inviteClient(self, numeric, target, channel):
         """Sends an INVITE from a PyLink client.."""
@@ -334,88 +335,86 @@ class TS6Protocol(TS6BaseProtocol):
                                self.irc.serverdata.get('serverdesc') or self.irc.botdata['serverdesc']))
 
     def handle_events(self, data):
-        """Generic event handler for the TS6 protocol: does protocol negotation
-        and passes commands to handle_ABCD() functions elsewhere in this module."""
+        """Generic event handler for the TS6 protocol: passes commands sent while
+        linking to the link_ABCD() functions, and all others to handle_ABCD()
+        functions elsewhere in this module."""
         # TS6 messages:
         # :42X COMMAND arg1 arg2 :final long arg
         # :42XAAAAAA PRIVMSG #somewhere :hello!
-        args = data.split(" ")
-        if not args:
+        msg = self.tokenize(data)
+        if not msg.command:
             # No data??
             return
-        if args[0] == 'PASS':
-            # <- PASS $somepassword TS 6 :42X
-            if args[1] != self.irc.serverdata['recvpass']:
-                # Check if recvpass is correct
-                raise ProtocolError('Error: recvpass from uplink server %s does not match configuration!' % servername)
-            if 'TS 6' not in data:
-                raise ProtocolError("Remote protocol version is too old! Is this even TS6?")
-            # Server name and SID are sent in different messages, grr
-            numeric = data.rsplit(':', 1)[1]
-            log.debug('(%s) Found uplink SID as %r', self.irc.name, numeric)
-            self.irc.servers[numeric] = IrcServer(None, 'unknown')
-            self.irc.uplink = numeric
+        if msg.source is None:
+            # Commands without a sender prefix are only sent while linking.
+            self.dispatchLink(msg)
             return
-        elif args[0] == 'SERVER':
-            # <- SERVER charybdis.midnight.vpn 1 :charybdis test server
-            sname = args[1].lower()
-            log.debug('(%s) Found uplink server name as %r', self.irc.name, sname)
-            self.irc.servers[self.irc.uplink].name = sname
-            self.irc.servers[self.irc.uplink].desc = ' '.join(args).split(':', 1)[1]
-            # According to the TS6 protocol documentation, we should send SVINFO
-            # when we get our uplink's SERVER command.
-            self.irc.send('SVINFO 6 6 0 :%s' % int(time.time()))
-        elif args[0] == 'SQUIT':
-            # What? Charybdis send this in a different format!
-            # <- SQUIT 00A :Remote host closed the connection
-            split_server = args[1]
-            res = self.handle_squit(split_server, 'SQUIT', [split_server])
-            self.irc.callHooks([split_server, 'SQUIT', res])
-        elif args[0] == 'CAPAB':
-            # We only get a list of keywords here. Charybdis obviously assumes that
-            # we know what modes it supports (indeed, this is a standard list).
-            # <- CAPAB :BAN CHW CLUSTER ENCAP EOPMOD EUID EX IE KLN KNOCK MLOCK QS RSFNC SAVE SERVICES TB UNKLN
-            self.irc.caps = caps = data.split(':', 1)[1].split()
-            for required_cap in ('EUID', 'SAVE', 'TB', 'ENCAP', 'QS'):
-                if required_cap not in caps:
-                    raise ProtocolError('%s not found in TS6 capabilities list; this is required! (got %r)' % (required_cap, caps))
-
-            if 'EX' in caps:
-                self.irc.cmodes['banexception'] = 'e'
-            if 'IE' in caps:
-                self.irc.cmodes['invex'] = 'I'
-            if 'SERVICES' in caps:
-                self.irc.cmodes['regonly'] = 'r'
-
-            log.debug('(%s) self.irc.connected set!', self.irc.name)
-            self.irc.connected.set()
-
-            # Charybdis doesn't have the idea of an explicit endburst; but some plugins
-            # like relay require it to know that the network's connected.
-            # We'll set a timer to manually call endburst. It's not beautiful,
-            # but it's the best we can do.
-            endburst_timer = threading.Timer(1, self.irc.callHooks, args=([self.irc.uplink, 'ENDBURST', {}],))
-            log.debug('(%s) Starting delay to send ENDBURST', self.irc.name)
-            endburst_timer.start()
-        try:
-            args = self.parseTS6Args(args)
-
-            numeric = args[0]
-            command = args[1]
-            args = args[2:]
-        except IndexError:
-            return
-
-        # We will do wildcard command handling here. Unhandled commands are just ignored.
-        try:
-            func = getattr(self, 'handle_'+command.lower())
-        except AttributeError:  # Unhandled command
-            pass
-        else:
-            parsed_args = func(numeric, command, args)
-            if parsed_args is not None:
-                return [numeric, command, parsed_args]
-
+        return self.dispatch(msg.source, msg.command, msg.args)
+
+    def link_pass(self, args):
+        """Handles the uplink's PASS command, which carries its SID."""
+
+        # <- PASS $somepassword TS 6 :42X
+        if args[0] != self.irc.serverdata['recvpass']:
+            # Check if recvpass is correct
+            raise ProtocolError('Error: recvpass from uplink server for network %s does not match configuration!' % self.irc.name)
+        if args[1:3] != ['TS', '6']:
+            raise ProtocolError("Remote protocol version is too old! Is this even TS6?")
+        # Server name and SID are sent in different messages, grr
+        numeric = args[-1]
+        log.debug('(%s) Found uplink SID as %r', self.irc.name, numeric)
+        self.irc.servers[numeric] = IrcServer(None, 'unknown')
+        self.irc.uplink = numeric
+
+    def link_server(self, args):
+        """Handles the uplink's SERVER command, sent while linking."""
+        # <- SERVER charybdis.midnight.vpn 1 :charybdis test server
+        sname = args[0].lower()
+        log.debug('(%s) Found uplink server name as %r', self.irc.name, sname)
+        self.irc.servers.rename(self.irc.uplink, sname)
+        self.irc.servers[self.irc.uplink].desc = args[-1]
+        # According to the TS6 protocol documentation, we should send SVINFO
+        # when we get our uplink's SERVER command.
+        self.irc.send('SVINFO 6 6 0 :%s' % int(time.time()))
+
+    def link_squit(self, args):
+        """Handles unprefixed SQUIT commands."""
+        # What? Charybdis send this in a different format!
+        # <- SQUIT 00A :Remote host closed the connection
+        split_server = args[0]
+        res = self.handle_squit(split_server, 'SQUIT', [split_server])
+        self.irc.callHooks([split_server, 'SQUIT', res])
+
+    def link_capab(self, args):
+        """Handles the uplink's capability list (CAPAB)."""
+        # We only get a list of keywords here. Charybdis obviously assumes that
+        # we know what modes it supports (indeed, this is a standard list).
+        # <- CAPAB :BAN CHW CLUSTER ENCAP EOPMOD EUID EX IE KLN KNOCK MLOCK QS RSFNC SAVE SERVICES TB UNKLN
+        self.irc.caps = caps = ' '.join(args).split()
+        for required_cap in ('EUID', 'SAVE', 'TB', 'ENCAP', 'QS'):
+            if required_cap not in caps:
+                raise ProtocolError('%s not found in TS6 capabilities list; this is required! (got %r)' % (required_cap, caps))
+
+        if 'EX' in caps:
+            self.irc.cmodes['banexception'] = 'e'
+        if 'IE' in caps:
+            self.irc.cmodes['invex'] = 'I'
+        if 'SERVICES' in caps:
+            self.irc.cmodes['regonly'] = 'r'
+        utils.compileModeTables(self.irc)
+
+        log.debug('(%s) self.irc.connected set!', self.irc.name)
+        self.irc.connected.set()
+
+        # Charybdis doesn't have the idea of an explicit endburst; but some plugins
+        # like relay require it to know that the network's connected.
+        # We'll set a timer to manually call endburst. It's not beautiful,
+        # but it's the best we can do. The hooks themselves are handed off to
+        # the network's dispatcher (or a thread of their own), so that they
+        # don't hold up other networks' timers.
+        log.debug('(%s) Starting delay to send ENDBURST', self.irc.name)
+        world.scheduler.schedule(1, self.irc.queueCall, self.irc.callHooks,
+                                 [self.irc.uplink, 'ENDBURST', {}], name='%s fake ENDBURST' % self.irc.name)
     def handle_ping(self, source, command, args):
         """Handles incoming PING commands."""
         # PING:
@@ -446,7 +445,7 @@ class TS6Protocol(TS6BaseProtocol):
         channel = utils.toLower(self.irc, args[1])
         userlist = args[-1].split()
         their_ts = int(args[0])
-        our_ts = self.irc.channels[channel].ts
+        our_ts = self.irc.channels.getOrCreate(channel).ts
 
         self.updateTS(channel, their_ts)
 
@@ -491,6 +490,8 @@ class TS6Protocol(TS6BaseProtocol):
             return {'channels': oldchans, 'text': 'Left all channels.', 'parse_as': 'PART'}
         else:
             channel = utils.toLower(self.irc, args[1])
+            self.irc.channels.getOrCreate(channel).users.add(numeric)
+            self.irc.users[numeric].channels.add(channel)
             self.updateTS(channel, ts)
         # We send users and modes here because SJOIN and JOIN both use one hook,
         # for simplicity's sake (with plugins).
@@ -509,11 +510,10 @@ class TS6Protocol(TS6BaseProtocol):
                   'host=%s realname=%s realhost=%s ip=%s', self.irc.name, nick, ts, uid,
                   ident, host, realname, realhost, ip)
 
-        self.irc.users[uid] = IrcUser(nick, ts, uid, ident, host, realname, realhost, ip)
+        self.addClient(IrcUser(nick, ts, uid, ident, host, realname, realhost, ip), numeric)
         parsedmodes = utils.parseModes(self.irc, uid, [modes])
         log.debug('Applying modes %s for %s', parsedmodes, uid)
         utils.applyModes(self.irc, uid, parsedmodes)
-        self.irc.servers[numeric].users.add(uid)
         # Call the OPERED UP hook if +o is being added to the mode list.
         if ('+o', None) in parsedmodes:
             otype = 'Server_Administrator' if ('+a', None) in parsedmodes else 'IRC_Operator'
@@ -546,13 +546,16 @@ class TS6Protocol(TS6BaseProtocol):
         """Handles incoming TMODE commands (channel mode change)."""
         # <- :42XAAAAAB TMODE 1437450768 #endlessvoid -c+lkC 3 agte4
         channel = utils.toLower(self.irc, args[1])
-        oldobj = self.irc.channels[channel].deepcopy()
+        if channel not in self.irc.channels:
+            log.debug('(%s) Ignoring TMODE for unknown channel %s', self.irc.name, channel)
+            return
+        oldobj = self.irc.channels[channel].snapshot()
         modes = args[2:]
         changedmodes = utils.parseModes(self.irc, channel, modes)
-        utils.applyModes(self.irc, channel, changedmodes)
+        undo = utils.applyModes(self.irc, channel, changedmodes)
         ts = int(args[0])
         return {'target': channel, 'modes': changedmodes, 'ts': ts,
-                'oldchan': oldobj}
+                'oldchan': oldobj, 'undo': undo}
 
     def handle_mode(self, numeric, command, args):
         """Handles incoming user mode changes."""
@@ -574,8 +577,9 @@ class TS6Protocol(TS6BaseProtocol):
         ts = args[0]
         setter = args[2]
         topic = args[-1]
-        self.irc.channels[channel].topic = topic
-        self.irc.channels[channel].topicset = True
+        c = self.irc.channels.getOrCreate(channel)
+        c.topic = topic
+        c.topicset = True
         return {'channel': channel, 'setter': setter, 'ts': ts, 'topic': topic}
 
     def handle_invite(self, numeric, command, args):
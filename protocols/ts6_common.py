@@ -21,12 +21,8 @@ class TS6BaseProtocol(Protocol):
 
     def _getSid(self, sname):
         """Returns the SID of a server with the given name, if present."""
-        nick = sname.lower()
-        for k, v in self.irc.servers.items():
-            if v.name.lower() == nick:
-                return k
-        else:
-            return sname  # Fall back to given text instead of None
+        # Fall back to given text instead of None
+        return self.irc.servers.nameToSid(sname) or sname
 
     ### OUTGOING COMMANDS
 
@@ -63,7 +59,7 @@ class TS6BaseProtocol(Protocol):
         if not utils.isInternalClient(self.irc, numeric):
             raise LookupError('No such PyLink PseudoClient exists.')
         self._send(numeric, 'NICK %s %s' % (newnick, int(time.time())))
-        self.irc.users[numeric].nick = newnick
+        self.irc.users.renick(numeric, newnick)
 
     def partClient(self, client, channel, reason=None):
         """Sends a part from a PyLink client."""
@@ -102,8 +98,9 @@ class TS6BaseProtocol(Protocol):
         if not utils.isInternalClient(self.irc, numeric):
             raise LookupError('No such PyLink PseudoClient exists.')
         self._send(numeric, 'TOPIC %s :%s' % (target, text))
-        self.irc.channels[target].topic = text
-        self.irc.channels[target].topicset = True
+        c = self.irc.channels.getOrCreate(target)
+        c.topic = text
+        c.topicset = True
 
     def spawnServer(self, name, sid=None, uplink=None, desc=None):
         """
@@ -121,9 +118,8 @@ class TS6BaseProtocol(Protocol):
         assert len(sid) == 3, "Incorrect SID length"
         if sid in self.irc.servers:
             raise ValueError('A server with SID %r already exists!' % sid)
-        for server in self.irc.servers.values():
-            if name == server.name:
-                raise ValueError('A server named %r already exists!' % name)
+        if self.irc.servers.nameToSid(name):
+            raise ValueError('A server named %r already exists!' % name)
         if not utils.isInternalServer(self.irc, uplink):
             raise ValueError('Server %r is not a PyLink internal PseudoServer!' % uplink)
         if not utils.isServerName(name):
@@ -189,7 +185,8 @@ class TS6BaseProtocol(Protocol):
         """Handles incoming NICK changes."""
         # <- :70MAAAAAA NICK GL-devel 1434744242
         oldnick = self.irc.users[numeric].nick
-        newnick = self.irc.users[numeric].nick = args[0]
+        newnick = args[0]
+        self.irc.users.renick(numeric, newnick)
         return {'newnick': newnick, 'oldnick': oldnick, 'ts': int(args[1])}
 
     def handle_quit(self, numeric, command, args):
@@ -210,7 +207,7 @@ class TS6BaseProtocol(Protocol):
         # <- :70M SAVE 0AL000001 1433728673
         user = args[0]
         oldnick = self.irc.users[user].nick
-        self.irc.users[user].nick = user
+        self.irc.users.renick(user, user)
         return {'target': user, 'ts': int(args[1]), 'oldnick': oldnick}
 
     def handle_squit(self, numeric, command, args):
@@ -223,19 +220,18 @@ class TS6BaseProtocol(Protocol):
         if split_server not in self.irc.servers:
             log.warning("(%s) Tried to split a server (%s) that didn't exist!", self.irc.name, split_server)
             return
-        # Prevent RuntimeError: dictionary changed size during iteration
-        old_servers = self.irc.servers.copy()
-        for sid, data in old_servers.items():
-            if data.uplink == split_server:
+        # Find every server behind the one that split (leaf servers first), and
+        # all of their users.
+        affected_servers = self.irc.servers.subtree(split_server)
+        for sid in affected_servers:
+            if sid != split_server:
                 log.debug('Server %s also hosts server %s, removing those users too...', split_server, sid)
-                args = self.handle_squit(sid, 'SQUIT', [sid, "PyLink: Automatically splitting leaf servers of %s" % sid])
-                affected_users += args['users']
-        for user in self.irc.servers[split_server].users.copy():
-            affected_users.append(user)
-            log.debug('Removing client %s (%s)', user, self.irc.users[user].nick)
-            self.removeClient(user)
+            affected_users.extend(self.irc.servers[sid].users)
+        # Then, remove them all in one go.
+        self.removeClients(affected_users)
         sname = self.irc.servers[split_server].name
-        del self.irc.servers[split_server]
+        for sid in affected_servers:
+            del self.irc.servers[sid]
         log.debug('(%s) Netsplit affected users: %s', self.irc.name, affected_users)
         return {'target': split_server, 'users': affected_users, 'name': sname}
 
@@ -246,9 +242,10 @@ class TS6BaseProtocol(Protocol):
         channel = utils.toLower(self.irc, args[0])
         topic = args[1]
         ts = int(time.time())
-        oldtopic = self.irc.channels[channel].topic
-        self.irc.channels[channel].topic = topic
-        self.irc.channels[channel].topicset = True
+        c = self.irc.channels.getOrCreate(channel)
+        oldtopic = c.topic
+        c.topic = topic
+        c.topicset = True
         return {'channel': channel, 'setter': numeric, 'ts': ts, 'topic': topic,
                 'oldtopic': oldtopic}
 
@@ -267,8 +264,7 @@ class TS6BaseProtocol(Protocol):
             except IndexError:
                 reason = ''
             # Clear empty non-permanent channels.
-            if not (self.irc.channels[channel].users or ((self.irc.cmodes.get('permanent'), None) in self.irc.channels[channel].modes)):
-                del self.irc.channels[channel]
+            self.irc.channels.removeIfEmpty(channel)
         return {'channels': channels, 'text': reason}
 
     def handle_away(self, numeric, command, args):
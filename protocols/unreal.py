@@ -21,7 +21,8 @@ class UnrealProtocol(TS6BaseProtocol):
         self.min_proto_ver = 3999
         self.hook_map = {'UMODE2': 'MODE', 'SVSKILL': 'KILL', 'SVSMODE': 'MODE',
                          'SVS2MODE': 'MODE', 'SJOIN': 'JOIN', 'SETHOST': 'CHGHOST',
-                         'SETIDENT': 'CHGIDENT', 'SETNAME': 'CHGNAME'}
+                         'SETIDENT': 'CHGIDENT', 'SETNAME': 'CHGNAME',
+                         'EOS': 'ENDBURST'}
         self.uidgen = {}
         self.sidgen = utils.TS6SIDGenerator(self.irc)
 
@@ -60,10 +61,9 @@ class UnrealProtocol(TS6BaseProtocol):
         realname = realname or self.irc.botdata['realname']
         realhost = realhost or host
         raw_modes = utils.joinModes(modes)
-        u = self.irc.users[uid] = IrcUser(nick, ts, uid, ident=ident, host=host, realname=realname,
-            realhost=realhost, ip=ip, manipulatable=manipulatable)
+        u = self.addClient(IrcUser(nick, ts, uid, ident=ident, host=host, realname=realname,
+            realhost=realhost, ip=ip, manipulatable=manipulatable), server)
         utils.applyModes(self.irc, uid, modes)
-        self.irc.servers[server].users.add(uid)
 
         # UnrealIRCd requires encoding the IP by first packing it into a binary format,
         # and then encoding the binary with Base64.
@@ -103,7 +103,7 @@ class UnrealProtocol(TS6BaseProtocol):
         if not utils.isInternalClient(self.irc, client):
             raise LookupError('No such PyLink client exists.')
         self._send(client, "JOIN %s" % channel)
-        self.irc.channels[channel].users.add(client)
+        self.irc.channels.getOrCreate(channel).users.add(client)
         self.irc.users[client].channels.add(channel)
 
     def sjoinServer(self, server, channel, users, ts=None):
@@ -130,7 +130,7 @@ class UnrealProtocol(TS6BaseProtocol):
         if not server:
             raise LookupError('No such PyLink server exists.')
 
-        orig_ts = self.irc.channels[channel].ts
+        orig_ts = self.irc.channels.getOrCreate(channel).ts
         ts = ts or orig_ts
         self.updateTS(channel, ts)
 
@@ -229,8 +229,9 @@ class UnrealProtocol(TS6BaseProtocol):
         if not utils.isInternalServer(self.irc, numeric):
             raise LookupError('No such PyLink server exists.')
         self._send(numeric, 'TOPIC %s :%s' % (target, text))
-        self.irc.channels[target].topic = text
-        self.irc.channels[target].topicset = True
+        c = self.irc.channels.getOrCreate(target)
+        c.topic = text
+        c.topicset = True
 
     def updateClient(self, numeric, field, text):
         """Updates the ident, host, or realname of a PyLink client."""
@@ -333,10 +334,9 @@ class UnrealProtocol(TS6BaseProtocol):
             else:
                 raise ProtocolError("Invalid number of bits in IP address field (got %s, expected 4 or 16)." % len(ipbits))
         realname = args[-1]
-        self.irc.users[uid] = IrcUser(nick, ts, uid, ident, host, realname, realhost, ip)
+        self.addClient(IrcUser(nick, ts, uid, ident, host, realname, realhost, ip), numeric)
         parsedmodes = utils.parseModes(self.irc, uid, [modestring])
         utils.applyModes(self.irc, uid, parsedmodes)
-        self.irc.servers[numeric].users.add(uid)
 
         # The cloaked (+x) host is completely separate from the displayed host
         # and real host in that it is ONLY shown if the user is +x (cloak mode
@@ -362,6 +362,15 @@ class UnrealProtocol(TS6BaseProtocol):
             log.debug('(%s) Set self.irc.lastping.', self.irc.name)
             self.irc.lastping = time.time()
 
+    def handle_eos(self, numeric, command, args):
+        """EOS (end of sync) handler; sends an ENDBURST hook with empty contents
+        when our uplink is done bursting. This also frees its burst slot."""
+        # <- :001 EOS
+        # Every server behind our uplink sends its own EOS, but ENDBURST is
+        # only meant to be sent once per link.
+        if numeric == self.irc.uplink:
+            return {}
+
     def handle_server(self, numeric, command, args):
         """Handles the SERVER command, which is used for both authentication and
         introducing legacy (non-SID) servers."""
@@ -440,6 +449,7 @@ class UnrealProtocol(TS6BaseProtocol):
                 self.caps['SJ3'] = True
         self.irc.cmodes.update({'halfop': 'h', 'admin': 'a', 'owner': 'q',
                                 'op': 'o', 'voice': 'v'})
+        utils.compileModeTables(self.irc)
 
     def _getNick(self, target):
         """Converts a nick argument to its matching UID. This differs from utils.nickToUid()
@@ -462,12 +472,12 @@ class UnrealProtocol(TS6BaseProtocol):
         send an explicit sender prefix, in which case, it will be set to the SID
         of the uplink server.
         """
-        data = data.split(" ")
-        try:  # Message starts with a SID/UID prefix.
-            args = self.parseTS6Args(data)
-            sender = args[0]
-            command = args[1]
-            args = args[2:]
+        msg = self.tokenize(data)
+        if not msg.command:
+            # No data??
+            return
+        if msg.source is not None:  # Message starts with a SID/UID prefix.
+            sender = msg.source
             # If the sender isn't in UID format, try to convert it automatically.
             # Unreal's protocol isn't quite consistent with this yet!
             sender_server = self._getSid(sender)
@@ -477,21 +487,10 @@ class UnrealProtocol(TS6BaseProtocol):
             else:
                 # Sender is a user.
                 numeric = self._getNick(sender)
-        # parseTS6Args() will raise IndexError if the TS6 sender prefix is missing.
-        except IndexError:
+        else:
             # Raw command without an explicit sender; assume it's being sent by our uplink.
-            args = self.parseArgs(data)
             numeric = self.irc.uplink
-            command = args[0]
-            args = args[1:]
-        try:
-            func = getattr(self, 'handle_'+command.lower())
-        except AttributeError:  # unhandled command
-            pass
-        else:
-            parsed_args = func(numeric, command, args)
-            if parsed_args is not None:
-                return [numeric, command, parsed_args]
+        return self.dispatch(numeric, msg.command, msg.args)
 
     def handle_privmsg(self, source, command, args):
         # Convert nicks to UIDs, where they exist.
@@ -506,7 +505,6 @@ class UnrealProtocol(TS6BaseProtocol):
         """Handles the UnrealIRCd JOIN command."""
         # <- :GL JOIN #pylink,#test
         for channel in args[0].split(','):
-            c = self.irc.channels[channel]
             if args[0] == '0':
                 # /join 0; part the user from all channels
                 oldchans = self.irc.users[numeric].channels.copy()
@@ -517,8 +515,9 @@ class UnrealProtocol(TS6BaseProtocol):
                     self.irc.users[numeric].channels.discard(ch)
                 return {'channels': oldchans, 'text': 'Left all channels.', 'parse_as': 'PART'}
 
+            c = self.irc.channels.getOrCreate(channel)
             self.irc.users[numeric].channels.add(channel)
-            self.irc.channels[channel].users.add(numeric)
+            c.users.add(numeric)
             # Call hooks manually, because one JOIN command in UnrealIRCd can
             # have multiple channels...
             self.irc.callHooks([numeric, command, {'channel': channel, 'users': [numeric], 'modes':
@@ -533,7 +532,7 @@ class UnrealProtocol(TS6BaseProtocol):
         channel = utils.toLower(self.irc, args[1])
         userlist = args[-1].split()
 
-        our_ts = self.irc.channels[channel].ts
+        our_ts = self.irc.channels.getOrCreate(channel).ts
         their_ts = int(args[0])
         self.updateTS(channel, their_ts)
 
@@ -582,17 +581,19 @@ class UnrealProtocol(TS6BaseProtocol):
         # Also, we need to get rid of that extra space following the +f argument. :|
         if utils.isChannel(args[0]):
             channel = utils.toLower(self.irc, args[0])
-            oldobj = self.irc.channels[channel].deepcopy()
+            # MODE is also used in channel bursts, so create the channel if needed.
+            oldobj = self.irc.channels.getOrCreate(channel).snapshot()
             modes = list(filter(None, args[1:]))  # normalize whitespace
             parsedmodes = utils.parseModes(self.irc, channel, modes)
+            undo = []
             if parsedmodes:
-                utils.applyModes(self.irc, channel, parsedmodes)
+                undo = utils.applyModes(self.irc, channel, parsedmodes)
             if numeric in self.irc.servers and args[-1].isdigit():
                 # Sender is a server AND last arg is number. Perform TS updates.
                 their_ts = int(args[-1])
                 if their_ts > 0:
                     self.updateTS(channel, their_ts)
-            return {'target': channel, 'modes': parsedmodes, 'oldchan': oldobj}
+            return {'target': channel, 'modes': parsedmodes, 'oldchan': oldobj, 'undo': undo}
         else:
             log.warning("(%s) received MODE for non-channel target: %r",
                         self.irc.name, args)
@@ -621,9 +622,10 @@ class UnrealProtocol(TS6BaseProtocol):
         channel = utils.toLower(self.irc, args[0])
         topic = args[-1]
         ts = args[2]
-        oldtopic = self.irc.channels[channel].topic
-        self.irc.channels[channel].topic = topic
-        self.irc.channels[channel].topicset = True
+        c = self.irc.channels.getOrCreate(channel)
+        oldtopic = c.topic
+        c.topic = topic
+        c.topicset = True
         return {'channel': channel, 'setter': numeric, 'ts': ts, 'topic': topic,
                 'oldtopic': oldtopic}
 
@@ -0,0 +1,264 @@
+"""
+reconnect.py - Connection coordinator for PyLink networks.
+
+Every connection attempt made by an IRC object goes through the shared
+coordinator (world.coordinator), which:
+
+- Spaces out reconnects with exponential backoff and random jitter, so that
+  networks which lost their links at the same time don't all come back at
+  once.
+- Limits how many networks may be linking and bursting at the same time
+  (the "max_bursting_networks" option in the bot: block). Networks waiting
+  for a slot get one in order of their "connect_priority" server option
+  (higher first).
+- Keeps track of connect attempt and burst timings for each network.
+
+A network's burst slot is released when its uplink finishes bursting
+(ENDBURST), when it disconnects, or after "burst_timeout" seconds.
+
+At startup, networks link concurrently, and a ReadinessBarrier tracks which
+of them have finished linking. world.started is set once all of them (or the
+number set by the "startup_quorum" bot option) are ready.
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from log import log
+import world
+import scheduler  # Sets up world.scheduler, used for burst timeouts.
+
+class NetworkTimings():
+    """Connection statistics for a single network."""
+
+    def __init__(self):
+        # Number of connect attempts made, and how many of the latest ones
+        # failed in a row (this is what the backoff is based on).
+        self.attempts = 0
+        self.failures = 0
+        self.last_attempt = None
+
+        # How long the latest attempt waited for a burst slot.
+        self.wait_time = None
+        # How long the latest successful burst took, from getting a slot to
+        # the uplink's end of burst.
+        self.burst_time = None
+        self.bursts = 0
+        self.burst_timeouts = 0
+
+    def __repr__(self):
+        return "<NetworkTimings (%s attempts, %s failures, last burst %ss)>" % \
+            (self.attempts, self.failures, self.burst_time)
+
+class ReadinessBarrier():
+    """
+    Tracks which networks have finished linking, and sets an event once all of
+    them, or a quorum of them, are ready.
+    """
+
+    def __init__(self, networks, quorum=None, event=None):
+        self.lock = threading.Lock()
+        # Network names are matched case-insensitively, since IRC objects
+        # lowercase the names given in the configuration.
+        self.pending = {name.lower() for name in networks}
+        self.ready = set()
+        # Number of networks needed for the barrier to be passed.
+        if quorum is None or not (1 <= quorum <= len(self.pending)):
+            quorum = len(self.pending)
+        self.quorum = quorum
+        self.event = event or threading.Event()
+        self.start_time = time.time()
+        # How long it took for the quorum to be reached.
+        self.elapsed = None
+        self._check()
+
+    def networkReady(self, name):
+        """Marks the named network as having finished linking."""
+        name = name.lower()
+        with self.lock:
+            if name not in self.pending:
+                return
+            self.pending.discard(name)
+            self.ready.add(name)
+            self._check()
+
+    def _check(self):
+        """Sets the event if the quorum has been reached."""
+        if len(self.ready) >= self.quorum and not self.event.is_set():
+            self.elapsed = time.time() - self.start_time
+            log.info('%s of %s networks finished linking in %.2f seconds.',
+                     len(self.ready), len(self.ready) + len(self.pending), self.elapsed)
+            self.event.set()
+
+    def wait(self, timeout=None):
+        """Waits for the quorum to be reached, and returns whether it was."""
+        return self.event.wait(timeout)
+
+    def isPassed(self):
+        """Returns whether the quorum has been reached."""
+        return self.event.is_set()
+
+class ReconnectCoordinator():
+    """Coordinates connection attempts across all networks."""
+    # Default maximum reconnect delay, in seconds.
+    default_max_delay = 300
+    # Default jitter, as a fraction of the reconnect delay.
+    default_jitter = 0.2
+    # Default number of seconds after which a burst slot is freed, even if
+    # the uplink hasn't finished bursting.
+    default_burst_timeout = 60
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        # Heap of (-priority, sequence number, IRC object) for networks waiting
+        # for a burst slot.
+        self.waiting = []
+        self._counter = itertools.count()
+        # Networks currently holding a burst slot, mapped to the time they got it
+        # and their burst timeout task.
+        self.bursting = {}
+        # Network name -> NetworkTimings.
+        self.timings = {}
+        # ReadinessBarrier for networks linking at startup, if any.
+        self.barrier = None
+
+    def getTimings(self, irc):
+        """Returns the NetworkTimings object for the given IRC object."""
+        with self.lock:
+            return self.timings.setdefault(irc.name, NetworkTimings())
+
+    def _getLimit(self, irc):
+        """Returns the maximum number of concurrently bursting networks, or
+        None if there is no limit."""
+        limit = irc.botdata.get('max_bursting_networks')
+        if limit is not None and limit >= 1:
+            return limit
+
+    def _canStart(self, irc):
+        """Returns whether the given network may take a burst slot now. This
+        must be called with the lock held."""
+        limit = self._getLimit(irc)
+        if limit is not None and len(self.bursting) >= limit:
+            return False
+        # Only the waiting network with the highest priority may go next.
+        return self.waiting[0][2] is irc
+
+    def acquire(self, irc):
+        """
+        Waits for a burst slot for the given IRC object, and returns True once
+        it has one. If the network is aborted while waiting, False is returned
+        instead.
+        """
+        timings = self.getTimings(irc)
+        start = time.time()
+        priority = irc.serverdata.get('connect_priority') or 0
+        with self.lock:
+            if irc in self.bursting:
+                # Already holding a slot.
+                return True
+            entry = (-priority, next(self._counter), irc)
+            heapq.heappush(self.waiting, entry)
+            try:
+                while not self._canStart(irc):
+                    if not irc.aborted.is_set():
+                        log.debug('(%s) Waiting for a burst slot (%s networks bursting)',
+                                  irc.name, len(self.bursting))
+                    self.lock.wait(1)
+                    if irc.aborted.is_set():
+                        return False
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                # Let the next waiting network check whether it can go.
+                self.lock.notify_all()
+
+            timeout = irc.botdata.get('burst_timeout') or self.default_burst_timeout
+            task = world.scheduler.schedule(timeout, self._burstTimeout, irc,
+                                            name='%s burst timeout' % irc.name)
+            self.bursting[irc] = (time.time(), task)
+
+        timings.attempts += 1
+        timings.last_attempt = start
+        timings.wait_time = time.time() - start
+        if timings.wait_time >= 1:
+            log.info('(%s) Got a burst slot after waiting %.1f seconds.', irc.name,
+                     timings.wait_time)
+        return True
+
+    def release(self, irc, completed=False):
+        """
+        Releases the given IRC object's burst slot, if it has one. completed
+        should be True if the uplink finished its burst, which also resets the
+        network's reconnect backoff.
+        """
+        with self.lock:
+            try:
+                started, task = self.bursting.pop(irc)
+            except KeyError:
+                return
+            task.cancel()
+            self.lock.notify_all()
+
+        timings = self.getTimings(irc)
+        if completed:
+            timings.bursts += 1
+            timings.burst_time = time.time() - started
+            timings.failures = 0
+            log.info('(%s) Burst finished in %.2f seconds.', irc.name, timings.burst_time)
+            if self.barrier:
+                self.barrier.networkReady(irc.name)
+        else:
+            timings.failures += 1
+
+    def burstDone(self, irc):
+        """Marks the given IRC object as having finished its burst."""
+        self.release(irc, completed=True)
+
+    def _burstTimeout(self, irc):
+        """Frees a burst slot that has been held for too long."""
+        if irc not in self.bursting:
+            return
+        log.warning('(%s) Uplink has not finished bursting after %s seconds; releasing '
+                    'its burst slot.', irc.name, irc.botdata.get('burst_timeout') or
+                    self.default_burst_timeout)
+        self.getTimings(irc).burst_timeouts += 1
+        # The link itself may still be fine (not all protocols send an end of
+        # burst), so don't count this as a failure if it's still up.
+        self.release(irc, completed=irc.connected.is_set())
+
+    def getDelay(self, irc):
+        """
+        Returns the number of seconds to wait before the given IRC object's
+        next connect attempt, or None if autoconnect is disabled.
+
+        The delay starts at the network's "autoconnect" value and doubles with
+        every failed attempt in a row, up to "autoconnect_max" (300 seconds by
+        default). A random jitter of up to "autoconnect_jitter" times the delay
+        (0.2 by default) is then added.
+        """
+        base = irc.serverdata.get('autoconnect')
+        if base is None or base < 1:
+            return None
+
+        maxdelay = max(irc.serverdata.get('autoconnect_max') or self.default_max_delay, base)
+        jitter = irc.serverdata.get('autoconnect_jitter')
+        if jitter is None:
+            jitter = self.default_jitter
+
+        failures = self.getTimings(irc).failures
+        # Cap the exponent, so that this doesn't overflow for networks that
+        # have been down for a very long time.
+        delay = min(base * 2 ** min(max(failures - 1, 0), 32), maxdelay)
+        return delay + random.uniform(0, delay * jitter)
+
+    def stats(self):
+        """Returns a dict mapping network names to their NetworkTimings."""
+        with self.lock:
+            return dict(self.timings)
+
+# Only create the shared coordinator once.
+if world.coordinator is None:
+    world.coordinator = ReconnectCoordinator()
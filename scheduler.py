@@ -0,0 +1,153 @@
+"""
+scheduler.py - Shared timer service for PyLink.
+
+This module provides one scheduler (world.scheduler) that plugins and
+protocol modules can use to run delayed or repeating tasks, instead of
+starting a threading.Timer or sched thread of their own. All tasks are kept
+in a heap and ran by a single thread.
+
+Example:
+
+    task = world.scheduler.schedule(30, exportDB, interval=30)
+    ...
+    task.cancel()
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from log import log
+import world
+
+class ScheduledTask():
+    """Handle for a task created by Scheduler.schedule()."""
+
+    def __init__(self, scheduler, func, args, kwargs, interval=None,
+                 jitter=0, name=None):
+        self.scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.jitter = jitter
+        self.name = name or getattr(func, '__qualname__', repr(func))
+        self.cancelled = False
+        # The time at which this task will next run.
+        self.when = None
+
+        # Run-time statistics.
+        self.runs = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.last_run = None
+
+    def cancel(self):
+        """Cancels the task. This is safe to call more than once, or from
+        inside the task itself."""
+        self.scheduler.cancel(self)
+
+    def averageTime(self):
+        """Returns the average time (in seconds) taken by each run."""
+        return self.total_time / self.runs if self.runs else 0
+
+    def __repr__(self):
+        return "<ScheduledTask %r (%s runs, avg %.4fs)>" % (self.name, self.runs,
+                                                           self.averageTime())
+
+class Scheduler():
+    """Heap-based scheduler that runs tasks in a single thread."""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        # Heap of (run time, sequence number, task) tuples. Cancelled tasks
+        # are left in the heap and skipped when they come up.
+        self.heap = []
+        self._counter = itertools.count()
+        # All tasks that are waiting to run; this is used for statistics.
+        self.tasks = set()
+        self.thread = None
+
+    def schedule(self, delay, func, *args, interval=None, jitter=0, name=None,
+                 **kwargs):
+        """
+        Schedules func(*args, **kwargs) to run after <delay> seconds, and
+        returns a ScheduledTask handle that can be used to cancel it.
+
+        If interval is given, the task repeats every <interval> seconds after
+        its first run. If jitter is given, a random delay of up to <jitter>
+        seconds is added to every run, so that tasks created at the same time
+        (e.g. pings for networks that connected together) don't all fire at
+        once.
+        """
+        task = ScheduledTask(self, func, args, kwargs, interval=interval,
+                             jitter=jitter, name=name)
+        with self.lock:
+            self.tasks.add(task)
+            self._push(task, delay)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='scheduler',
+                                               daemon=True)
+                self.thread.start()
+        return task
+
+    def _push(self, task, delay):
+        """Adds a task to the heap. This must be called with the lock held."""
+        if task.jitter:
+            delay += random.uniform(0, task.jitter)
+        task.when = time.time() + delay
+        heapq.heappush(self.heap, (task.when, next(self._counter), task))
+        self.lock.notify()
+
+    def cancel(self, task):
+        """Cancels a scheduled task."""
+        with self.lock:
+            task.cancelled = True
+            self.tasks.discard(task)
+
+    def _next(self):
+        """Waits for and returns the next task that's due to run."""
+        with self.lock:
+            while True:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.lock.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay <= 0:
+                    return heapq.heappop(self.heap)[2]
+                self.lock.wait(delay)
+
+    def run(self):
+        """Main loop for the scheduler thread."""
+        while True:
+            task = self._next()
+            start = time.time()
+            try:
+                task.func(*task.args, **task.kwargs)
+            except Exception:
+                log.exception('Unhandled exception caught in scheduled task %r', task.name)
+            elapsed = time.time() - start
+
+            task.runs += 1
+            task.total_time += elapsed
+            task.max_time = max(task.max_time, elapsed)
+            task.last_run = start
+
+            with self.lock:
+                if task.interval is not None and not task.cancelled:
+                    self._push(task, task.interval)
+                else:
+                    self.tasks.discard(task)
+
+    def stats(self):
+        """Returns a list of all pending tasks, sorted by total run time."""
+        with self.lock:
+            return sorted(self.tasks, key=lambda task: task.total_time, reverse=True)
+
+# Only create the shared scheduler once.
+if world.scheduler is None:
+    world.scheduler = Scheduler()
@@ -0,0 +1,285 @@
+"""
+selectdriver.py - Shared event loop for PyLink IRC connections.
+
+When the "use_event_loop" option in the bot: block is enabled, the uplink
+sockets of every network are handled by one selectors-based loop, instead of
+each network getting a connection thread of its own. Reads, writes, line
+parsing, hook dispatch, and ping timeout checks for all networks happen in
+the loop thread; pings themselves are sent by world.scheduler.
+
+Connecting (including the SSL handshake and the protocol module's initial
+burst) still happens in a short-lived thread per attempt, so that one
+unreachable uplink can't stall every other network. Once a link is up, its
+socket is handed over to the loop.
+
+Nothing in the loop thread may block: when a network's dispatch queue (see
+the "dispatch_queue" server option) fills up, the loop stops reading from
+that network's socket until the queue has drained, instead of waiting for it.
+"""
+
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+from log import log
+import classes
+
+class SelectDriver():
+    """Event loop that handles the connections of multiple IRC objects."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+        # Every IRC object managed by the loop: this includes networks that
+        # are connecting or waiting to autoconnect, and not just those whose
+        # sockets are registered with the selector.
+        self.networks = set()
+
+        # IRC objects whose connect threads have finished linking, and are
+        # waiting to be added to the selector by the loop thread.
+        self.ready = []
+
+        # Connected IRC objects handed over to the loop, and those of them
+        # whose sockets aren't being read from because their dispatch queues
+        # are full. These are only used by the loop thread.
+        self.active = set()
+        self.paused = set()
+        # Connected IRC objects waiting for their sockets to be writable.
+        self.writing = set()
+
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # This socket pair is used to wake up select() when a network is
+        # handed over from its connect thread.
+        self._waker, self._wakee = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wakee.setblocking(False)
+        self.selector.register(self._wakee, selectors.EVENT_READ)
+
+    def add(self, irc, delay=0):
+        """Starts a connect thread for the given IRC object, optionally
+        after waiting <delay> seconds."""
+        with self.lock:
+            self.networks.add(irc)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='selectdriver')
+                self.thread.start()
+        irc.connection_thread = threading.Thread(target=self._connect, args=(irc, delay))
+        irc.connection_thread.start()
+
+    def _connect(self, irc, delay=0):
+        """Connect loop for an IRC object, ran in its own thread until the
+        link is up (or autoconnect is disabled)."""
+        while True:
+            if delay:
+                time.sleep(delay)
+            try:
+                if irc._connect():
+                    with self.lock:
+                        self.ready.append(irc)
+                    self._wakeup()
+                    return
+            except (socket.error, classes.ProtocolError, ConnectionError) as e:
+                log.warning('(%s) Disconnected from IRC: %s: %s',
+                            irc.name, type(e).__name__, str(e))
+
+            irc._disconnect()
+            delay = irc._getAutoconnectDelay()
+            if delay is None:
+                self._remove(irc)
+                return
+
+    def _remove(self, irc):
+        """Stops managing the given IRC object."""
+        with self.lock:
+            self.networks.discard(irc)
+        # Wake up the loop so that it can exit if this was the last network.
+        self._wakeup()
+
+    def _wakeup(self):
+        """Interrupts the loop's select() call."""
+        try:
+            self._waker.send(b'\0')
+        except BlockingIOError:  # A wakeup is already pending.
+            pass
+
+    def wakeup(self, irc):
+        """Tells the loop that the IRC object has data queued to send, or
+        that its dispatch queue has drained. This is only needed when called
+        from outside the loop thread."""
+        if threading.current_thread() is not self.thread:
+            self._wakeup()
+
+    def _drop(self, irc):
+        """Takes a disconnected IRC object out of the loop, and schedules
+        a reconnect if autoconnect is enabled."""
+        self.active.discard(irc)
+        self.paused.discard(irc)
+        self.writing.discard(irc)
+        self._updateEvents(irc)
+        irc._disconnect()
+        delay = irc._getAutoconnectDelay()
+        if delay is None:
+            self._remove(irc)
+        else:
+            self.add(irc, delay=delay)
+
+    def _read(self, irc):
+        """Reads data from an IRC object's socket."""
+        try:
+            alive = irc._readData()
+            # SSL sockets may have already decrypted data buffered, which
+            # select() can't see.
+            while alive and irc.ssl and irc.socket.pending():
+                alive = irc._readData()
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Nothing to read yet (e.g. only part of an SSL record arrived).
+            alive = True
+        except (socket.error, classes.ProtocolError, ConnectionError) as e:
+            log.warning('(%s) Disconnected from IRC: %s: %s',
+                        irc.name, type(e).__name__, str(e))
+            alive = False
+        if not alive or irc.aborted.is_set():
+            self._drop(irc)
+        elif irc.dispatcher and irc.dispatcher.isFull():
+            log.debug('(%s) selectdriver: dispatch queue is full; pausing reads', irc.name)
+            self.paused.add(irc)
+            self._updateEvents(irc)
+
+    def _resume(self):
+        """Resumes reading from networks whose dispatch queues have drained."""
+        for irc in list(self.paused):
+            if not (irc.dispatcher and irc.dispatcher.isFull()):
+                log.debug('(%s) selectdriver: dispatch queue has drained; resuming reads', irc.name)
+                self.paused.discard(irc)
+                self._updateEvents(irc)
+
+    def _updateEvents(self, irc):
+        """Registers an IRC object's socket for the events the loop should
+        watch for (if any), or unregisters it."""
+        events = 0
+        if irc in self.active:
+            if irc not in self.paused:
+                events |= selectors.EVENT_READ
+            if irc in self.writing:
+                events |= selectors.EVENT_WRITE
+        try:
+            key = self.selector.get_key(irc.socket)
+        except KeyError:
+            if events:
+                self.selector.register(irc.socket, events, irc)
+            return
+        if not events:
+            self.selector.unregister(irc.socket)
+        elif key.events != events:
+            self.selector.modify(irc.socket, events, irc)
+
+    def _write(self, irc):
+        """Writes out an IRC object's queued data, and watches its socket for
+        writability if it couldn't take all of it."""
+        try:
+            done = irc.sendq.flush(irc.socket)
+        except (socket.error, ConnectionError) as e:
+            log.warning('(%s) Failed to write to the uplink: %s: %s',
+                        irc.name, type(e).__name__, str(e))
+            self._drop(irc)
+            return
+        if done:
+            self.writing.discard(irc)
+        else:
+            self.writing.add(irc)
+        self._updateEvents(irc)
+
+    def _checkNetworks(self):
+        """Checks for aborted connections and ping timeouts on every
+        connected network."""
+        now = time.time()
+        for irc in list(self.active):
+            if irc.aborted.is_set():
+                self._drop(irc)
+            elif (now - irc.lastping) > irc.pingtimeout:
+                log.warning('(%s) Connection timed out.', irc.name)
+                self._drop(irc)
+
+    def run(self):
+        """Main loop for the select driver."""
+        log.debug('selectdriver: starting event loop')
+        while True:
+            with self.lock:
+                ready, self.ready = self.ready, []
+                if not (self.networks or ready):
+                    log.debug('selectdriver: no networks left; stopping event loop')
+                    self.thread = None
+                    return
+
+            for irc in ready:
+                log.info('(%s) Starting ping schedulers....', irc.name)
+                irc.schedulePing()
+                irc.scheduleSweep()
+                log.info('(%s) Server ready; listening for data.', irc.name)
+                irc.socket.setblocking(False)
+                self.active.add(irc)
+                self._updateEvents(irc)
+
+            for key, mask in self.selector.select(timeout=self._getTimeout()):
+                if key.data is None:
+                    # Clear the wakeup byte(s).
+                    try:
+                        self._wakee.recv(1024)
+                    except BlockingIOError:
+                        pass
+                elif mask & selectors.EVENT_READ and key.data in self.active:
+                    self._read(key.data)
+
+            self._resume()
+            self._checkNetworks()
+
+            # Write out everything that was queued during this pass (and is
+            # allowed to go out by the send budget).
+            for irc in list(self.active):
+                if irc in self.active and irc.sendq.nextSendDelay() == 0:
+                    self._write(irc)
+
+    def _getTimeout(self):
+        """Returns how long select() should wait for: at most a second, or
+        less if a network's send budget frees up sooner."""
+        timeout = 1
+        for irc in self.active:
+            # Networks waiting for their socket to be writable will wake up
+            # select() on their own.
+            if irc not in self.writing:
+                delay = irc.sendq.nextSendDelay()
+                if delay is not None:
+                    timeout = min(timeout, delay)
+        return timeout
+
+    def isRegistered(self, irc):
+        """Returns whether the IRC object is managed by this loop."""
+        with self.lock:
+            return irc in self.networks
+
+# The shared driver, created by the first register() call so that nothing
+# is set up when the event loop isn't used.
+driver = None
+_driver_lock = threading.Lock()
+
+def register(irc):
+    """Adds an IRC object to the shared event loop."""
+    global driver
+    with _driver_lock:
+        if driver is None:
+            driver = SelectDriver()
+    driver.add(irc)
+
+def isRegistered(irc):
+    """Returns whether an IRC object is managed by the shared event loop."""
+    return driver is not None and driver.isRegistered(irc)
+
+def wakeup(irc):
+    """Tells the shared event loop (if it's running) that the IRC object
+    needs attention; see SelectDriver.wakeup()."""
+    if driver is not None:
+        driver.wakeup(irc)
@@ -0,0 +1,192 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import selectors
+import socket
+import threading
+import unittest
+
+import classes
+import selectdriver
+from tests_common import RecordingProto
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.irc = classes.FakeIRC('unittest', RecordingProto)
+        self.proto = self.irc.proto
+        self.irc.dispatcher = classes.Dispatcher(self.irc, maxsize=100)
+        self.irc.dispatcher.start()
+
+    def tearDown(self):
+        if self.irc.dispatcher:
+            self.irc.dispatcher.stop()
+
+    def _waitForLines(self, count):
+        for _ in range(200):
+            if len(self.proto.handled) >= count:
+                return
+            threading.Event().wait(0.01)
+        self.fail('Dispatcher did not process %s lines in time' % count)
+
+    def _waitForThread(self, queued=0):
+        # Waits for the dispatcher to pick up the first (stalled) line it's
+        # given, leaving <queued> lines in the queue.
+        for _ in range(200):
+            if self.irc.dispatcher.depth() <= queued:
+                return
+            threading.Event().wait(0.01)
+        self.fail('Dispatcher did not pick up a line in time')
+
+    def testOrdering(self):
+        lines = [':70MAAAAAA PRIVMSG #test :%s' % x for x in range(50)]
+        for line in lines:
+            self.irc.dispatch(line)
+        self._waitForLines(50)
+        self.assertEqual([data for data, thread in self.proto.handled], lines)
+        # Everything ran on the dispatcher thread.
+        self.assertEqual({thread for data, thread in self.proto.handled},
+                         {self.irc.dispatcher.thread})
+        self.assertEqual(self.irc.dispatcher.processed, 50)
+
+    def testKeepalive(self):
+        # Stall the dispatcher, like a slow hook would.
+        self.proto.blocker.clear()
+        self.irc.dispatch(':70MAAAAAA PRIVMSG #test :slow')
+        self.irc.dispatch(':70MAAAAAA PRIVMSG #test :slower')
+        # PINGs are still handled right away, in the reader's thread.
+        self.irc.dispatch(':70M PING 70M 9PY')
+        self.assertEqual(self.proto.handled,
+                         [(':70M PING 70M 9PY', threading.current_thread())])
+        self.proto.blocker.set()
+        self._waitForLines(3)
+
+    def testIsKeepalive(self):
+        self.assertTrue(classes.isKeepalive(':70M PING 70M 9PY'))
+        self.assertTrue(classes.isKeepalive('PING :irc.example.com'))
+        self.assertTrue(classes.isKeepalive(':70M PONG 70M 9PY'))
+        self.assertFalse(classes.isKeepalive(':70MAAAAAA PRIVMSG #test :PING'))
+        self.assertFalse(classes.isKeepalive('SERVER test.server 1 :PING'))
+
+    def testStop(self):
+        self.proto.blocker.clear()
+        for x in range(10):
+            self.irc.dispatch(':70MAAAAAA PRIVMSG #test :%s' % x)
+        self._waitForThread(queued=9)
+        threading.Timer(0.1, self.proto.blocker.set).start()
+        self.irc.dispatcher.stop()
+        # Only the line that was running finishes; the rest is dropped.
+        self.assertEqual(len(self.proto.handled), 1)
+        self.assertFalse(self.irc.dispatcher.thread.is_alive())
+
+    def testStopNoWait(self):
+        self.proto.blocker.clear()
+        self.irc.dispatch(':70MAAAAAA PRIVMSG #test :slow')
+        self._waitForThread()
+        # Stopping from the event loop doesn't wait for the slow line.
+        self.irc.dispatcher.stop(wait=False)
+        self.assertTrue(self.irc.dispatcher.thread.is_alive())
+        self.proto.blocker.set()
+        self.irc.dispatcher.thread.join(2)
+        self.assertFalse(self.irc.dispatcher.thread.is_alive())
+
+    def testNonBlocking(self):
+        self.irc.dispatcher.stop()
+        drained = threading.Event()
+        dispatcher = self.irc.dispatcher = classes.Dispatcher(self.irc, maxsize=10, block=False,
+                                                              notify=drained.set)
+        dispatcher.start()
+        self.proto.blocker.clear()
+        # Filling the queue doesn't block the reader; it's told to stop reading instead.
+        for x in range(15):
+            self.irc.dispatch(':70MAAAAAA PRIVMSG #test :%s' % x)
+        self.assertTrue(dispatcher.isFull())
+        self.proto.blocker.set()
+        self.assertTrue(drained.wait(2))
+        self.assertFalse(dispatcher.isFull())
+        self._waitForLines(15)
+
+    def testQueuedCall(self):
+        called = []
+        self.irc.dispatch(':70MAAAAAA PRIVMSG #test :first')
+        self.irc.queueCall(called.append, 'call')
+        self.irc.dispatch(':70MAAAAAA PRIVMSG #test :second')
+        self._waitForLines(2)
+        self.assertEqual(called, ['call'])
+
+    def testQueuedCallOrdering(self):
+        # Queued calls run on the dispatcher thread, after the lines before them.
+        self.proto.blocker.clear()
+        self.irc.dispatch(':70MAAAAAA PRIVMSG #test :slow')
+        done = threading.Event()
+        threads = []
+        self.irc.queueCall(lambda: (threads.append(threading.current_thread()), done.set()))
+        self.assertFalse(done.wait(0.05))
+        self.proto.blocker.set()
+        self.assertTrue(done.wait(2))
+        self.assertEqual(threads, [self.irc.dispatcher.thread])
+
+    def testQueuedCallNoDispatcher(self):
+        self.irc.dispatcher.stop()
+        self.irc.dispatcher = None
+        done = threading.Event()
+        threads = []
+        self.irc.queueCall(lambda: (threads.append(threading.current_thread()), done.set()))
+        self.assertTrue(done.wait(2))
+        self.assertNotEqual(threads, [threading.current_thread()])
+
+class TestSelectDriverBackpressure(unittest.TestCase):
+    def setUp(self):
+        self.irc = classes.FakeIRC('unittest', RecordingProto)
+        self.proto = self.irc.proto
+        self.irc.dispatcher = classes.Dispatcher(self.irc, maxsize=4, block=False)
+        self.irc.dispatcher.start()
+        self.driver = selectdriver.SelectDriver()
+        self.irc.socket, self.peer = socket.socketpair()
+        self.driver.active.add(self.irc)
+        self.driver._updateEvents(self.irc)
+
+    def tearDown(self):
+        self.proto.blocker.set()
+        self.irc.dispatcher.stop()
+        self.irc.socket.close()
+        self.peer.close()
+
+    def _events(self):
+        try:
+            return self.driver.selector.get_key(self.irc.socket).events
+        except KeyError:
+            return 0
+
+    def testPauseReads(self):
+        self.assertEqual(self._events(), selectors.EVENT_READ)
+        self.proto.blocker.clear()
+
+        def readData():
+            for x in range(5):
+                self.irc.dispatch(':70MAAAAAA PRIVMSG #test :%s' % x)
+            return True
+        self.irc._readData = readData
+
+        # The read doesn't block on the full queue, but the socket stops
+        # being watched for reads.
+        self.driver._read(self.irc)
+        self.assertIn(self.irc, self.driver.paused)
+        self.assertEqual(self._events(), 0)
+
+        # Pending writes are still watched for while reads are paused.
+        self.driver.writing.add(self.irc)
+        self.driver._updateEvents(self.irc)
+        self.assertEqual(self._events(), selectors.EVENT_WRITE)
+
+        self.proto.blocker.set()
+        for _ in range(200):
+            if not self.irc.dispatcher.isFull():
+                break
+            threading.Event().wait(0.01)
+        self.driver._resume()
+        self.assertNotIn(self.irc, self.driver.paused)
+        self.assertEqual(self._events(), selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import classes
+import unittest
+
+class TestLineFramer(unittest.TestCase):
+    def setUp(self):
+        self.framer = classes.LineFramer(max_line_length=100, max_buffer_length=1000)
+
+    def testFeed(self):
+        self.assertEqual(self.framer.feed(b':70M PING 70M 0AL\r\n:70MAAAAAA PRIVMSG #test :hi\n'),
+                         [':70M PING 70M 0AL', ':70MAAAAAA PRIVMSG #test :hi'])
+        self.assertEqual(self.framer.feed(b''), [])
+
+    def testPartialLines(self):
+        self.assertEqual(self.framer.feed(b':70MAAAAAA PRIV'), [])
+        self.assertEqual(self.framer.feed(b'MSG #test :hello\r'), [])
+        self.assertEqual(self.framer.feed(b'\n:70M PI'), [':70MAAAAAA PRIVMSG #test :hello'])
+        self.assertEqual(self.framer.feed(b'NG 70M 0AL\n'), [':70M PING 70M 0AL'])
+
+    def testSplitMultibyte(self):
+        # A multibyte UTF-8 character split across two reads.
+        data = ':70MAAAAAA PRIVMSG #test :été\n'.encode('utf-8')
+        self.assertEqual(self.framer.feed(data[:28]), [])
+        self.assertEqual(self.framer.feed(data[28:]), [':70MAAAAAA PRIVMSG #test :été'])
+
+    def testInvalidUTF8(self):
+        self.assertEqual(self.framer.feed(b'PRIVMSG #test :\xff\n'), ['PRIVMSG #test :�'])
+
+    def testLimits(self):
+        self.assertRaises(classes.ProtocolError, self.framer.feed, b'a' * 101)
+        self.framer = classes.LineFramer(max_line_length=100, max_buffer_length=1000)
+        self.assertRaises(classes.ProtocolError, self.framer.feed, b'a' * 101 + b'\n')
+        self.framer = classes.LineFramer(max_line_length=100, max_buffer_length=1000)
+        self.assertRaises(classes.ProtocolError, self.framer.feed, b'a\n' * 501)
+
+    def testMultibyteLimit(self):
+        # max_line_length is in bytes, not characters: 60 characters of "é"
+        # take up 120 bytes in UTF-8.
+        self.assertRaises(classes.ProtocolError, self.framer.feed, 'é'.encode('utf-8') * 60 + b'\n')
+        self.framer = classes.LineFramer(max_line_length=100, max_buffer_length=1000)
+        self.assertEqual(self.framer.feed('é'.encode('utf-8') * 50 + b'\n'), ['é' * 50])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ import unittest
 
 import inspircd
 import classes
+import utils
 import world
 
 import tests_common
@@ -45,16 +46,27 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.proto.spawnServer('level3.pylink', '34Z', uplink='34Q')
         self.proto.spawnServer('level4.pylink', '34Y', uplink='34Z')
         self.assertEqual(self.irc.servers['34Y'].uplink, '34Z')
+        self.assertEqual(self.irc.servers['34Z'].children, {'34Y'})
+        self.assertEqual(self.proto._getSid('Level4.PyLink'), '34Y')
+        self.assertEqual(self.irc.servers.subtree('34Q'), ['34Y', '34Z', '34Q'])
         s4u = self.proto.spawnClient('person1', 'person', 'users.overdrive.pw', server='34Y').uid
         s3u = self.proto.spawnClient('person2', 'person', 'users.overdrive.pw', server='34Z').uid
         self.proto.joinClient(s3u, '#pylink')
         self.proto.joinClient(s4u, '#pylink')
         self.irc.run(':34Z SQUIT 34Y :random squit messsage')
+        self.assertNotIn('34Y', self.irc.servers['34Z'].children)
         self.assertNotIn(s4u, self.irc.users)
+        self.assertNotIn(s4u, self.irc.client_servers)
+        self.assertNotIn(s4u, self.irc.internal_clients)
         self.assertNotIn('34Y', self.irc.servers)
         # Netsplits are obviously recursive, so all these should be removed.
-        self.proto.handle_squit('9PY', 'SQUIT', ['34P'])
+        hookdata = self.proto.handle_squit('9PY', 'SQUIT', ['34P'])
+        self.assertEqual(hookdata, {'target': '34P', 'users': [s3u], 'name': 'level1.pylink'})
         self.assertNotIn(s3u, self.irc.users)
+        self.assertNotIn('34P', self.irc.servers[self.irc.sid].children)
+        # Unknown server names are returned as is.
+        self.assertEqual(self.proto._getSid('level4.pylink'), 'level4.pylink')
+        self.assertIsNone(self.irc.servers.nameToSid('level1.pylink'))
         self.assertNotIn('34P', self.irc.servers)
         self.assertNotIn('34Q', self.irc.servers)
         self.assertNotIn('34Z', self.irc.servers)
@@ -72,6 +84,8 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.assertIn('10XAAAAAB', self.irc.servers['10X'].users)
         u = self.irc.users['10XAAAAAB']
         self.assertEqual('GL', u.nick)
+        self.assertEqual(utils.nickToUid(self.irc, 'gl'), '10XAAAAAB')
+        self.assertEqual(utils.clientToServer(self.irc, '10XAAAAAB'), '10X')
 
         expected = {'uid': '10XAAAAAB', 'ts': '1429934638', 'nick': 'GL',
                     'realhost': '0::1', 'ident': 'gl', 'ip': '0::1',
@@ -89,6 +103,7 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.assertEqual(hookdata['target'], self.u)
         self.assertEqual(hookdata['text'], 'killed')
         self.assertNotIn(self.u, self.irc.users)
+        self.assertNotEqual(utils.nickToUid(self.irc, 'PyLink'), self.u)
 
     def testHandleKick(self):
         self.irc.takeMsgs()  # Ignore the initial connect messages
@@ -125,6 +140,10 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.assertEqual({'10XAAAAAA', '10XAAAAAB', '10XAAAAAC'}, self.irc.channels['#chat'].users)
         self.assertIn('10XAAAAAA', self.irc.channels['#chat'].prefixmodes['ops'])
         self.assertEqual({'10XAAAAAA', '10XAAAAAB'}, self.irc.channels['#chat'].prefixmodes['voices'])
+        self.assertEqual(['op', 'voice'], self.irc.channels['#chat'].getPrefixModes('10XAAAAAA'))
+        self.assertEqual([], self.irc.channels['#chat'].getPrefixModes('10XAAAAAC'))
+        # Members without prefix modes aren't stored in the status map.
+        self.assertNotIn('10XAAAAAC', self.irc.channels['#chat'].status)
 
     def testHandleFJoinHook(self):
         self.irc.run(':10X FJOIN #PyLink 1423790418 +ls 10 :ov,10XAAAAAA v,10XAAAAAB ,10XAAAAAC')
@@ -144,6 +163,9 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.assertEqual({('i', None), ('k', 'herebedragons'), ('l', '100')}, self.irc.channels['#pylink'].modes)
         self.irc.run(':70M FMODE #pylink 1423790413 -ilk+m herebedragons')
         self.assertEqual({('m', None)}, self.irc.channels['#pylink'].modes)
+        # Modes for unknown channels don't create them.
+        self.irc.run(':70M FMODE #nothere 1423790413 +m')
+        self.assertNotIn('#nothere', self.irc.channels)
 
     def testHandleFModeWithPrefixes(self):
         self.irc.run(':70M FJOIN #pylink 123 +n :o,10XAAAAAA ,10XAAAAAB')
@@ -157,6 +179,43 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.irc.run(':70M FMODE #pylink 123 -o %s' % self.u)
         self.assertEqual(modes, self.irc.channels['#pylink'].modes)
         self.assertNotIn(self.u, self.irc.channels['#pylink'].prefixmodes['ops'])
+        self.assertFalse(self.irc.channels['#pylink'].hasStatus(self.u, 'op'))
+
+    def testHandleFModeOldChan(self):
+        self.irc.run(':70M FJOIN #pylink 123 +n :o,10XAAAAAA ,10XAAAAAB')
+        self.irc.takeHooks()
+        self.irc.run(':70M FMODE #pylink 123 -o+vm 10XAAAAAA 10XAAAAAB')
+        hookdata = self.irc.takeHooks()[0][-1]
+        oldchan = hookdata['oldchan']
+        self.assertEqual(hookdata['undo'], [('-m', None), ('-v', '10XAAAAAB'), ('+o', '10XAAAAAA')])
+        # The snapshot in the hook shows the channel as it was before the change.
+        self.assertTrue(oldchan.hasStatus('10XAAAAAA', 'op'))
+        self.assertFalse(oldchan.hasStatus('10XAAAAAB', 'voice'))
+        self.assertNotIn(('m', None), oldchan.modes)
+        c = self.irc.channels['#pylink']
+        self.assertFalse(c.hasStatus('10XAAAAAA', 'op'))
+        self.assertTrue(c.hasStatus('10XAAAAAB', 'voice'))
+        self.assertIn(('m', None), c.modes)
+
+    def testHandleFModeCopiesOnlyWhatChanges(self):
+        self.irc.run(':70M FJOIN #pylink 123 +n :o,10XAAAAAA ,10XAAAAAB')
+        c = self.irc.channels['#pylink']
+        modes, status = c.modes, c.status
+        # Ban changes don't copy the status dict...
+        self.irc.run(':70M FMODE #pylink 123 +b *!*@bad.example.com')
+        self.assertIs(c.status, status)
+        self.assertIsNot(c.modes, modes)
+        self.assertNotIn(('b', '*!*@bad.example.com'), modes)
+        # ...status changes don't copy the mode set...
+        modes = c.modes
+        self.irc.run(':70M FMODE #pylink 123 +v 10XAAAAAB')
+        self.assertIs(c.modes, modes)
+        self.assertIsNot(c.status, status)
+        # ...and changes that do nothing copy neither.
+        modes, status = c.modes, c.status
+        self.irc.run(':70M FMODE #pylink 123 +n-k *')
+        self.assertIs(c.modes, modes)
+        self.assertIs(c.status, status)
 
     def testHandleFModeRemovesOldParams(self):
         self.irc.run(':70M FMODE #pylink 1423790412 +l 50')
@@ -204,6 +263,7 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.assertEqual(hookdata['text'], 'Quit: quit message goes here')
         self.assertNotIn('10XAAAAAB', self.irc.users)
         self.assertNotIn('10XAAAAAB', self.irc.servers['10X'].users)
+        self.assertIsNone(utils.clientToServer(self.irc, '10XAAAAAB'))
 
     def testHandleServer(self):
         self.irc.run(':00A SERVER test.server * 1 00C :testing raw message syntax')
@@ -212,6 +272,10 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.assertEqual(hookdata['sid'], '00C')
         self.assertEqual(hookdata['text'], 'testing raw message syntax')
         self.assertIn('00C', self.irc.servers)
+        self.assertEqual(self.irc.servers.nameToSid('Test.Server'), '00C')
+        self.irc.servers.rename('00C', 'renamed.server')
+        self.assertIsNone(self.irc.servers.nameToSid('test.server'))
+        self.assertEqual(self.proto._getSid('renamed.server'), '00C')
 
     def testHandleNick(self):
         self.irc.run(':%s NICK PyLink-devel 1434744242' % self.u)
@@ -219,6 +283,8 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         expected = {'newnick': 'PyLink-devel', 'oldnick': 'PyLink', 'ts': 1434744242}
         self.assertEqual(hookdata, expected)
         self.assertEqual('PyLink-devel', self.irc.users[self.u].nick)
+        self.assertEqual(utils.nickToUid(self.irc, 'pylink-DEVEL'), self.u)
+        self.assertIsNone(utils.nickToUid(self.irc, 'PyLink'))
 
     def testHandleSave(self):
         self.irc.run(':%s NICK Derp_ 1433728673' % self.u)
@@ -226,6 +292,8 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         hookdata = self.irc.takeHooks()[-1][-1]
         self.assertEqual(hookdata, {'target': self.u, 'ts': 1433728673, 'oldnick': 'Derp_'})
         self.assertEqual(self.u, self.irc.users[self.u].nick)
+        self.assertEqual(utils.nickToUid(self.irc, self.u), self.u)
+        self.assertIsNone(utils.nickToUid(self.irc, 'Derp_'))
 
     def testHandleInvite(self):
         self.irc.run(':10XAAAAAA INVITE %s #blah 0' % self.u)
@@ -241,5 +309,46 @@ class InspIRCdTestCase(tests_common.CommonProtoTestCase):
         self.irc.run(':10XAAAAAB OPERTYPE Network_Owner')
         self.assertIn(('o', None), self.irc.users['10XAAAAAB'].modes)
 
+    def testHandlerTable(self):
+        self.proto.buildHandlers()
+        self.assertEqual(self.proto.handlers['FJOIN'], self.proto.handle_fjoin)
+        # Aliased handlers are listed under their own command.
+        self.assertEqual(self.proto.handlers['SVSTOPIC'], self.proto.handle_ftopic)
+        self.assertNotIn('EVENTS', self.proto.handlers)
+        self.assertEqual(set(self.proto.link_handlers), {'SERVER', 'CAPAB'})
+
+    def testTokenize(self):
+        msg = self.proto.tokenize(':70M FJOIN #chat 1423790411 +nt :o,10XAAAAAA ,10XAAAAAB')
+        self.assertEqual(msg.source, '70M')
+        self.assertEqual(msg.command, 'FJOIN')
+        self.assertEqual(msg.params, ['#chat', '1423790411', '+nt'])
+        self.assertEqual(msg.trailing, 'o,10XAAAAAA ,10XAAAAAB')
+        self.assertEqual(msg.args, ['#chat', '1423790411', '+nt', 'o,10XAAAAAA ,10XAAAAAB'])
+        # Same as parseTS6Args(), minus the sender and command.
+        line = ':70MAAAAAA PRIVMSG #chat :hello :) world'
+        self.assertEqual(self.proto.tokenize(line).args,
+                         self.proto.parseTS6Args(line.split(' '))[2:])
+
+        msg = self.proto.tokenize('CAPAB END')
+        self.assertIsNone(msg.source)
+        self.assertEqual(msg.command, 'CAPAB')
+        self.assertEqual(msg.args, ['END'])
+        self.assertIsNone(msg.trailing)
+        # An empty trailing parameter is still a parameter.
+        self.assertEqual(self.proto.tokenize(':70M FNAME :').args, [''])
+
+    def testCommandCounts(self):
+        self.irc.run('SERVER whatever. abcd 0 10X :Whatever Server - Hellas Planitia, Mars')
+        self.irc.run(':10X PING 10X %s' % self.irc.sid)
+        self.irc.run(':10X PING 10X %s' % self.irc.sid)
+        self.assertEqual(self.proto.command_counts['SERVER'], 1)
+        self.assertEqual(self.proto.command_counts['PING'], 2)
+        # Commands with no handler are counted, not just dropped.
+        self.irc.run(':10X SNONOTICE x :some notice')
+        self.irc.run('SOMETHING unprefixed')
+        self.assertEqual(self.proto.unknown_commands['SNONOTICE'], 1)
+        self.assertEqual(self.proto.unknown_commands['SOMETHING'], 1)
+        self.assertNotIn('SNONOTICE', self.proto.command_counts)
+
 if __name__ == '__main__':
     unittest.main()
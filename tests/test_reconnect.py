@@ -0,0 +1,150 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+import unittest
+
+import reconnect
+import world
+
+class FakeNetwork():
+    """Stand-in for an IRC object, with only what the coordinator uses."""
+    def __init__(self, name, priority=0, botdata=None, **serverdata):
+        self.name = name
+        self.botdata = botdata or {}
+        self.serverdata = dict(serverdata, connect_priority=priority)
+        self.aborted = threading.Event()
+        self.connected = threading.Event()
+
+class TestReconnectCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.coordinator = reconnect.ReconnectCoordinator()
+
+    def testSharedCoordinator(self):
+        self.assertIsInstance(world.coordinator, reconnect.ReconnectCoordinator)
+
+    def testBackoff(self):
+        irc = FakeNetwork('test', autoconnect=5, autoconnect_max=60,
+                          autoconnect_jitter=0)
+        delays = []
+        for _ in range(6):
+            self.coordinator.acquire(irc)
+            self.coordinator.release(irc)
+            delays.append(self.coordinator.getDelay(irc))
+        self.assertEqual(delays, [5, 10, 20, 40, 60, 60])
+
+        # A finished burst resets the backoff.
+        self.coordinator.acquire(irc)
+        self.coordinator.burstDone(irc)
+        self.assertEqual(self.coordinator.getDelay(irc), 5)
+        timings = self.coordinator.getTimings(irc)
+        self.assertEqual(timings.attempts, 7)
+        self.assertEqual(timings.bursts, 1)
+        self.assertIsNotNone(timings.burst_time)
+
+    def testJitter(self):
+        irc = FakeNetwork('test', autoconnect=10, autoconnect_jitter=0.5)
+        for _ in range(20):
+            self.assertTrue(10 <= self.coordinator.getDelay(irc) <= 15)
+
+    def testAutoconnectDisabled(self):
+        self.assertIsNone(self.coordinator.getDelay(FakeNetwork('test')))
+        self.assertIsNone(self.coordinator.getDelay(FakeNetwork('test', autoconnect=-1)))
+
+    def testLimit(self):
+        botdata = {'max_bursting_networks': 1}
+        first = FakeNetwork('first', botdata=botdata)
+        self.assertTrue(self.coordinator.acquire(first))
+
+        order = []
+        def connect(irc):
+            if self.coordinator.acquire(irc):
+                order.append(irc.name)
+                self.coordinator.burstDone(irc)
+
+        low = FakeNetwork('low', priority=1, botdata=botdata)
+        high = FakeNetwork('high', priority=5, botdata=botdata)
+        threads = [threading.Thread(target=connect, args=(low,))]
+        threads[0].start()
+        time.sleep(0.1)
+        threads.append(threading.Thread(target=connect, args=(high,)))
+        threads[1].start()
+        time.sleep(0.1)
+        # Nobody else can start while the first network is bursting.
+        self.assertEqual(order, [])
+
+        self.coordinator.burstDone(first)
+        for thread in threads:
+            thread.join(5)
+        # The network with the higher priority goes first, even though it
+        # started waiting later.
+        self.assertEqual(order, ['high', 'low'])
+
+    def testAbortWhileWaiting(self):
+        botdata = {'max_bursting_networks': 1}
+        first = FakeNetwork('first', botdata=botdata)
+        self.coordinator.acquire(first)
+        second = FakeNetwork('second', botdata=botdata)
+        second.aborted.set()
+        self.assertFalse(self.coordinator.acquire(second))
+        self.assertEqual(self.coordinator.waiting, [])
+        self.coordinator.release(first)
+
+    def testBurstTimeout(self):
+        irc = FakeNetwork('test', botdata={'burst_timeout': 0.05})
+        irc.connected.set()
+        self.coordinator.acquire(irc)
+        time.sleep(0.3)
+        self.assertNotIn(irc, self.coordinator.bursting)
+        self.assertEqual(self.coordinator.getTimings(irc).burst_timeouts, 1)
+
+    def testBarrier(self):
+        barrier = reconnect.ReadinessBarrier(['first', 'second'])
+        self.coordinator.barrier = barrier
+        first = FakeNetwork('first')
+        second = FakeNetwork('second')
+        self.coordinator.acquire(first)
+        self.coordinator.acquire(second)
+        self.coordinator.burstDone(first)
+        self.assertFalse(barrier.wait(0.05))
+        # Failed attempts don't count as being ready.
+        self.coordinator.release(second)
+        self.assertFalse(barrier.isPassed())
+        self.coordinator.acquire(second)
+        self.coordinator.burstDone(second)
+        self.assertTrue(barrier.wait(1))
+        self.assertEqual(barrier.ready, {'first', 'second'})
+        self.assertIsNotNone(barrier.elapsed)
+
+class TestReadinessBarrier(unittest.TestCase):
+    def testQuorum(self):
+        event = threading.Event()
+        barrier = reconnect.ReadinessBarrier(['a', 'b', 'c'], quorum=2, event=event)
+        barrier.networkReady('a')
+        barrier.networkReady('a')
+        self.assertFalse(event.is_set())
+        barrier.networkReady('b')
+        self.assertTrue(event.is_set())
+        self.assertEqual(barrier.pending, {'c'})
+
+    def testMixedCase(self):
+        # IRC objects use lowercased network names.
+        barrier = reconnect.ReadinessBarrier(['OverdriveNet', 'ts6net'])
+        barrier.networkReady('overdrivenet')
+        self.assertFalse(barrier.isPassed())
+        barrier.networkReady('TS6Net')
+        self.assertTrue(barrier.isPassed())
+        self.assertEqual(barrier.ready, {'overdrivenet', 'ts6net'})
+
+    def testInvalidQuorum(self):
+        # Quorums larger than the number of networks mean all of them.
+        barrier = reconnect.ReadinessBarrier(['a', 'b'], quorum=5)
+        self.assertEqual(barrier.quorum, 2)
+
+    def testNoNetworks(self):
+        self.assertTrue(reconnect.ReadinessBarrier([]).isPassed())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+import unittest
+
+import scheduler
+import world
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler()
+
+    def testSharedScheduler(self):
+        self.assertIsInstance(world.scheduler, scheduler.Scheduler)
+
+    def testSchedule(self):
+        ran = threading.Event()
+        task = self.scheduler.schedule(0.01, ran.set)
+        self.assertTrue(ran.wait(2))
+        # Give the scheduler thread a moment to record statistics.
+        time.sleep(0.05)
+        self.assertEqual(task.runs, 1)
+        self.assertNotIn(task, self.scheduler.stats())
+
+    def testOrdering(self):
+        results = []
+        done = threading.Event()
+        self.scheduler.schedule(0.06, done.set)
+        self.scheduler.schedule(0.04, results.append, 'c')
+        self.scheduler.schedule(0.01, results.append, 'a')
+        self.scheduler.schedule(0.02, results.append, 'b')
+        self.assertTrue(done.wait(2))
+        self.assertEqual(results, ['a', 'b', 'c'])
+
+    def testInterval(self):
+        results = []
+        task = self.scheduler.schedule(0, results.append, 1, interval=0.01)
+        time.sleep(0.2)
+        task.cancel()
+        runs = len(results)
+        self.assertGreater(runs, 2)
+        self.assertEqual(task.runs, runs)
+        time.sleep(0.05)
+        # No more runs after cancelling.
+        self.assertEqual(len(results), runs)
+
+    def testCancel(self):
+        ran = threading.Event()
+        task = self.scheduler.schedule(0.05, ran.set)
+        task.cancel()
+        self.assertFalse(ran.wait(0.2))
+        self.assertEqual(task.runs, 0)
+
+    def testJitter(self):
+        task = self.scheduler.schedule(10, lambda: None, jitter=5)
+        self.assertGreaterEqual(task.when, time.time() + 9)
+        self.assertLessEqual(task.when, time.time() + 15)
+        task.cancel()
+
+    def testExceptions(self):
+        # Errors in tasks shouldn't break the scheduler.
+        ran = threading.Event()
+        self.scheduler.schedule(0, lambda: 1/0)
+        self.scheduler.schedule(0.01, ran.set)
+        self.assertTrue(ran.wait(2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import classes
+import unittest
+
+class SlowSocket():
+    """Fake socket that only accepts a few bytes per send() call, and
+    optionally "fills up" (raises BlockingIOError) after a number of calls."""
+    def __init__(self, chunksize=7, limit=None):
+        self.data = b''
+        self.chunksize = chunksize
+        self.limit = limit
+        self.calls = 0
+
+    def send(self, data):
+        if self.limit is not None and self.calls >= self.limit:
+            raise BlockingIOError
+        self.calls += 1
+        data = bytes(data[:self.chunksize])
+        self.data += data
+        return len(data)
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.sendq = classes.SendQueue()
+
+    def testPartialWrites(self):
+        lines = [b'PRIVMSG #test :line %d\n' % x for x in range(50)]
+        for line in lines:
+            self.sendq.put(line)
+        self.assertEqual(self.sendq.depth(), 50)
+        sock = SlowSocket()
+        self.assertTrue(self.sendq.flush(sock))
+        self.assertEqual(sock.data, b''.join(lines))
+        self.assertFalse(self.sendq.hasData())
+        self.assertEqual(self.sendq.bytes_sent, len(sock.data))
+        self.assertGreater(self.sendq.bytesPerSecond(), 0)
+
+    def testWouldBlock(self):
+        lines = [b'NOTICE #test :line %d\n' % x for x in range(10)]
+        for line in lines:
+            self.sendq.put(line)
+        sock = SlowSocket(limit=3)
+        self.assertFalse(self.sendq.flush(sock))
+        self.assertEqual(sock.data, b''.join(lines)[:21])
+        # The rest of the batch is still queued, and resumes where it left off.
+        self.assertTrue(self.sendq.hasData())
+        self.sendq.put(b'PING :test\n')
+        sock.limit = None
+        self.assertTrue(self.sendq.flush(sock))
+        self.assertEqual(sock.data, b''.join(lines) + b'PING :test\n')
+
+    def testBatching(self):
+        for x in range(100):
+            self.sendq.put(b'PING :%d\n' % x)
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        # Everything should've been written in one call.
+        self.assertEqual(sock.calls, 1)
+
+    def testClose(self):
+        self.sendq.put(b'QUIT :bye\n')
+        self.sendq.close()
+        self.assertFalse(self.sendq.hasData())
+        self.assertFalse(self.sendq.put(b'PING :test\n'))
+        self.assertFalse(self.sendq.wait())
+
+    def testPriorities(self):
+        self.sendq.put(b':0AL UID 0ALAAAAAA 1 user host host user 0.0.0.0 1 + :realname\n')
+        self.sendq.put(b':9PYAAAAAA PRIVMSG #test :hello\n')
+        self.sendq.put(b':8PY KICK #other 9PYAAAAAB :bye\n')
+        self.sendq.put(b':9PY PONG 9PY 70M\n')
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines(),
+                         [b':9PY PONG 9PY 70M',
+                          b':8PY KICK #other 9PYAAAAAB :bye',
+                          b':9PYAAAAAA PRIVMSG #test :hello',
+                          b':0AL UID 0ALAAAAAA 1 user host host user 0.0.0.0 1 + :realname'])
+
+    def testSourceOrdering(self):
+        # Lines from a server shouldn't overtake its earlier burst lines, or the
+        # line introducing it.
+        lines = [b':0AL SID relay.test 1 1AB :relay server\n',
+                 b':1AB UID 1ABAAAAAA 1 user host host user 0.0.0.0 1 + :realname\n',
+                 b':1AB FMODE #test 1 +o 1ABAAAAAA\n',
+                 b':1ABAAAAAA PRIVMSG #test :hi\n']
+        for line in lines:
+            self.sendq.put(line)
+        self.sendq.put(b':9PYAAAAAA PRIVMSG #other :unrelated\n')
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines(),
+                         [b':9PYAAAAAA PRIVMSG #other :unrelated'] + [l.strip() for l in lines])
+
+    def testTargetOrdering(self):
+        # Lines about a client or channel from other servers shouldn't overtake
+        # earlier lines from or about it, such as the burst lines introducing it.
+        lines = [b':1AB UID 1ABAAAAAA 1 user host host user 0.0.0.0 1 + :realname\n',
+                 b':1AB FJOIN #test 1 +nt :,1ABAAAAAA\n',
+                 b':9PY KICK #test 1ABAAAAAA :bye\n',
+                 b':9PYAAAAAA PRIVMSG 1ABAAAAAA :hi\n',
+                 b':9PY MODE 1ABAAAAAA +i\n']
+        for line in lines:
+            self.sendq.put(line)
+        self.sendq.put(b':8PY KICK #other 8PYAAAAAB :unrelated\n')
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines(),
+                         [b':8PY KICK #other 8PYAAAAAB :unrelated'] + [l.strip() for l in lines])
+
+        # Once the introduction is out, later lines about the client still
+        # wait for the earlier ones that were held back.
+        self.sendq = classes.SendQueue(rate=50)
+        self.sendq.put(lines[0])
+        self.sendq.put(lines[2])
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines(), [lines[0].strip()])
+        self.sendq.put(b':9PY KILL 1ABAAAAAA :killed\n')
+        self.sendq.tokens = 100
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines()[1:],
+                         [lines[2].strip(), b':9PY KILL 1ABAAAAAA :killed'])
+
+        # A KILL mustn't overtake lines still queued from the client it kills.
+        self.sendq = classes.SendQueue()
+        self.sendq.put(b':1ABAAAAAA PRIVMSG #test :last words\n')
+        self.sendq.put(b':9PY KILL 1ABAAAAAA :killed\n')
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines(),
+                         [b':1ABAAAAAA PRIVMSG #test :last words', b':9PY KILL 1ABAAAAAA :killed'])
+
+    def testLinkPhaseOrdering(self):
+        # Nothing should jump ahead of unsourced lines sent while linking.
+        self.sendq.put(b'PASS abcd TS 6 :9PY\n')
+        self.sendq.put(b'SERVER pylink.unittest 0 :PyLink\n')
+        self.sendq.put(b':9PY PING 9PY 70M\n')
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines(),
+                         [b'PASS abcd TS 6 :9PY', b'SERVER pylink.unittest 0 :PyLink',
+                          b':9PY PING 9PY 70M'])
+
+    def testBudget(self):
+        self.sendq = classes.SendQueue(rate=100)
+        for x in range(10):
+            self.sendq.put(b':1AB UID 1ABAAAAA%s 1 user host host user 0.0.0.0 1 + :realname\n' % str(x).encode())
+        sock = SlowSocket(chunksize=65536)
+        self.sendq.flush(sock)
+        # Only what fits in the budget is sent.
+        self.assertEqual(len(sock.data.splitlines()), 2)
+        self.assertEqual(self.sendq.depth(), 8)
+        self.assertGreater(self.sendq.nextSendDelay(), 0)
+
+        # Keepalives skip the budget.
+        self.sendq.put(b':9PY PONG 9PY 70M\n')
+        self.assertEqual(self.sendq.nextSendDelay(), 0)
+        self.sendq.flush(sock)
+        self.assertEqual(sock.data.splitlines()[-1], b':9PY PONG 9PY 70M')
+        self.assertEqual(self.sendq.depth(), 8)
+
+if __name__ == '__main__':
+    unittest.main()
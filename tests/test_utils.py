@@ -37,6 +37,63 @@ class TestUtils(unittest.TestCase):
         self.assertNotIn('join', world.hooks)
         self.assertIn(dummyf, world.hooks['JOIN'])
 
+    def testToLower(self):
+        self.assertEqual(utils.toLower(self.irc, '#Channel{A}|~'), '#channel[a]\\^')
+        self.irc.proto.casemapping = 'strict-rfc1459'
+        self.assertEqual(utils.toLower(self.irc, '#Channel{A}|~'), '#channel[a]\\~')
+        self.irc.proto.casemapping = 'ascii'
+        self.assertEqual(utils.toLower(self.irc, '#Channel{A}|~'), '#channel{a}|~')
+        # Non-ASCII text is lowercased too, as it always has been.
+        self.assertEqual(utils.toLower(self.irc, '#ÉTÉ'), '#été')
+        self.assertEqual(self.irc.casemap.name, 'ascii')
+
+    def testCasemappingCache(self):
+        casemap = utils.Casemapping('rfc1459')
+        casemap.cache_size = 10
+        for n in range(25):
+            self.assertEqual(casemap.lower('#Chan%s' % n), '#chan%s' % n)
+        self.assertLessEqual(len(casemap.cache), 10)
+        self.assertRaises(ValueError, utils.Casemapping, 'unicode')
+
+    def testNickToUid(self):
+        def reference(nick):
+            # The old behaviour: a linear scan over every user.
+            nick = utils.toLower(self.irc, nick)
+            for uid, user in self.irc.users.items():
+                if utils.toLower(self.irc, user.nick) == nick:
+                    return uid
+
+        nicks = ['GL', 'gl[away]', 'GL{AWAY}', 'Derp|', 'derp\\', 'someone', 'x^y', 'X~Y']
+        for n, nick in enumerate(nicks):
+            self.irc.users['9PYAAAAA%s' % n] = classes.IrcUser(nick, 1234, '9PYAAAAA%s' % n)
+        self.irc.users.renick('9PYAAAAA0', 'GL-away')
+        self.irc.users.renick('9PYAAAAA5', '9PYAAAAA5')
+        del self.irc.users['9PYAAAAA3']
+        self.irc.users.pop('9PYAAAAA6')
+
+        for nick in nicks + ['gl-AWAY', '9pyaaaaa5', 'nobody']:
+            self.assertEqual(utils.nickToUid(self.irc, nick), reference(nick), nick)
+        # rfc1459 casemapping: [] are the lowercase forms of {}, etc.
+        self.assertEqual(utils.nickToUid(self.irc, 'gl{away}'), '9PYAAAAA1')
+        self.assertEqual(utils.nickToUid(self.irc, 'DERP\\'), '9PYAAAAA4')
+        self.assertEqual(utils.nickToUid(self.irc, 'x~y'), '9PYAAAAA7')
+
+    def testNickToUidRenick(self):
+        # Nick changes go through renick(), after which either nick can be
+        # looked up first.
+        self.irc.users['9PYAAAAAA'] = classes.IrcUser('GL', 1234, '9PYAAAAAA')
+        self.irc.users.renick('9PYAAAAAA', 'Derp')
+        self.assertEqual(utils.nickToUid(self.irc, 'derp'), '9PYAAAAAA')
+        self.assertIsNone(utils.nickToUid(self.irc, 'gl'))
+
+    def testNickToUidStale(self):
+        # Setting a nick directly isn't supported, but a stale index entry
+        # never returns a user that doesn't match the nick.
+        self.irc.users['9PYAAAAAA'] = user = classes.IrcUser('GL', 1234, '9PYAAAAAA')
+        user.nick = 'Derp'
+        self.assertIsNone(utils.nickToUid(self.irc, 'gl'))
+        self.assertNotIn('gl', self.irc.users.nicks)
+
     def testIsNick(self):
         self.assertFalse(utils.isNick('abcdefgh', nicklen=3))
         self.assertTrue(utils.isNick('aBcdefgh', nicklen=30))
@@ -123,6 +180,10 @@ class TestUtils(unittest.TestCase):
                            target=self.irc.pseudoclient.uid)
 
     def testReverseModesExisting(self):
+        # parseModes() skips prefix modes set on users that don't exist, so
+        # create the ones used below.
+        for uid in ('9PYAAAAAA', 'GLolol', 'test', 'abcde', 'atat', 'abcd'):
+            self.irc.users[uid] = classes.IrcUser(uid, 1, uid)
         utils.applyModes(self.irc, '#test', [('+m', None), ('+l', '50'), ('+k', 'supersecret'),
                                              ('+o', '9PYAAAAAA')])
 
@@ -146,5 +207,130 @@ class TestUtils(unittest.TestCase):
         self._reverseModes('-voo GLolol GLolol 10XAAAAAA', '+o GLolol')
         self._reverseModes('-bb *!*@* *!user@badisp.tk', '+b *!user@badisp.tk')
 
+    def testModeTable(self):
+        table = utils.getModeTable(self.irc)
+        self.assertEqual(table.types['b'], 'A')
+        self.assertEqual(table.types['k'], 'B')
+        self.assertEqual(table.types['l'], 'C')
+        self.assertEqual(table.types['n'], 'D')
+        self.assertEqual(table.types['o'], 'prefix')
+        self.assertEqual(table.chars['ban'], 'b')
+        self.assertEqual(table.names['b'], 'ban')
+        self.assertEqual(table.statusnames, {'o': 'op', 'v': 'voice'})
+        self.assertEqual(utils.getModeTable(self.irc, usermodes=True).types['s'], 'C')
+
+        # Tables are rebuilt on request, e.g. after mode negotiation.
+        self.irc.cmodes['*D'] += 'z'
+        utils.compileModeTables(self.irc)
+        self.assertEqual(utils.getModeTable(self.irc).types['z'], 'D')
+
+    def testParseModes(self):
+        self.irc.channels.getOrCreate('#test')
+        res = utils.parseModes(self.irc, '#test', ['+mitl-o', '3', self.irc.pseudoclient.nick])
+        self.assertEqual(res, [('+m', None), ('+i', None), ('+t', None), ('+l', '3'),
+                               ('-o', self.irc.pseudoclient.uid)])
+        res = utils.parseModes(self.irc, '#test', ['-lk+b', '*', 'bad!*@*'])
+        self.assertEqual(res, [('-l', None), ('-k', '*'), ('+b', 'bad!*@*')])
+
+    def testModeSet(self):
+        modes = utils.ModeSet({('n', None), ('l', '50')})
+        modes.update([('b', '*!*@a'), ('b', '*!*@b')])
+        self.assertEqual(modes, {('n', None), ('l', '50'), ('b', '*!*@a'), ('b', '*!*@b')})
+        self.assertEqual(modes.getArgs('b'), {'*!*@a', '*!*@b'})
+        self.assertEqual(modes.getArgs('n'), set())
+        modes.discard(('b', '*!*@a'))
+        self.assertEqual(modes.getArgs('b'), {'*!*@b'})
+        modes.clearMode('b')
+        self.assertEqual(modes.getArgs('b'), set())
+        self.assertEqual(modes, {('n', None), ('l', '50')})
+        # The index is kept when copying.
+        self.assertEqual(modes.copy().getArgs('l'), {'50'})
+        modes -= {('l', '50')}
+        self.assertEqual(modes.args, {})
+
+    def testApplyModes(self):
+        c = self.irc.channels.getOrCreate('#test')
+        utils.applyModes(self.irc, '#test', [('+l', '50'), ('+b', '*!*@a'), ('+b', '*!*@b'),
+                                             ('+k', 'key')])
+        utils.applyModes(self.irc, '#test', [('+l', '30'), ('-b', '*!*@a'), ('-k', None)])
+        self.assertEqual(c.modes, {('n', None), ('t', None), ('l', '30'), ('b', '*!*@b')})
+        self.assertEqual(c.modes.getArgs('l'), {'30'})
+
+    def testParseModesUnsetKey(self):
+        # "-k *" unsets the key without knowing it; parseModes() fills it in.
+        utils.applyModes(self.irc, '#test', [('+k', 'secret'), ('+b', '*!*@a')])
+        self.assertEqual(utils.parseModes(self.irc, '#test', ['-k', '*']), [('-k', 'secret')])
+        # Without a key set, the "*" is kept as is.
+        self.assertEqual(utils.parseModes(self.irc, '#other', ['-k', '*']), [('-k', '*')])
+
+    def testApplyModesUnknownChannel(self):
+        # Modes set on a channel we haven't seen yet aren't lost.
+        self.assertNotIn('#new', self.irc.channels)
+        utils.applyModes(self.irc, '#new', [('+m', None)])
+        self.assertIn(('m', None), self.irc.channels['#new'].modes)
+
+        self.irc.proto.updateTS('#other', 1000)
+        self.assertEqual(self.irc.channels['#other'].ts, 1000)
+
+    def testApplyModesUndo(self):
+        c = self.irc.channels.getOrCreate('#test')
+        u = self.irc.pseudoclient.uid
+        utils.applyModes(self.irc, '#test', [('+l', '50'), ('+k', 'oldkey'), ('+b', '*!*@a')])
+        before = set(c.modes)
+        undo = utils.applyModes(self.irc, '#test', [('+l', '30'), ('-k', 'oldkey'), ('+m', None),
+                                                    ('+n', None), ('-b', '*!*@a'), ('+o', u),
+                                                    ('-v', u)])
+        # Modes that were already (un)set aren't in the undo record.
+        self.assertEqual(undo, [('-o', u), ('+b', '*!*@a'), ('-m', None), ('+k', 'oldkey'),
+                                ('+l', '50')])
+        utils.applyModes(self.irc, '#test', undo)
+        self.assertEqual(c.modes, before)
+        self.assertFalse(c.hasStatus(u, 'op'))
+
+        # Replacing a key undoes to the old key.
+        undo = utils.applyModes(self.irc, '#test', [('-l', None), ('+k', 'newkey')])
+        self.assertEqual(undo, [('+k', 'oldkey'), ('+l', '50')])
+
+    def testChannelStatus(self):
+        c = self.irc.channels.getOrCreate('#test')
+        utils.applyModes(self.irc, '#test', [('+o', '9PYAAAAAA'), ('+v', '9PYAAAAAA'),
+                                             ('+v', 'GLolol')])
+        self.assertEqual(c.getPrefixModes('9PYAAAAAA'), ['op', 'voice'])
+        self.assertTrue(c.hasStatus('GLolol', 'voice'))
+        self.assertFalse(c.hasStatus('GLolol', 'op'))
+        # The older prefixmodes API still works.
+        self.assertEqual(c.prefixmodes['voices'], {'9PYAAAAAA', 'GLolol'})
+        self.assertIn('9PYAAAAAA', c.prefixmodes['ops'])
+        self.assertEqual(len(c.prefixmodes['halfops']), 0)
+
+        utils.applyModes(self.irc, '#test', [('-v', 'GLolol')])
+        self.assertNotIn('GLolol', c.status)
+        c.removeuser('9PYAAAAAA')
+        self.assertEqual(c.getPrefixModes('9PYAAAAAA'), [])
+        self.assertEqual(c.status, {})
+
+    def testChannelMapping(self):
+        channels = self.irc.channels
+        phantoms = channels.phantoms
+        # Looking up unknown channels doesn't create them.
+        self.assertEqual(channels['#unknown'].users, set())
+        self.assertNotIn('#unknown', channels)
+        self.assertEqual(channels.phantoms, phantoms + 1)
+
+        c = channels.getOrCreate('#new')
+        self.assertIs(channels.getOrCreate('#new'), c)
+        self.assertIs(channels['#new'], c)
+        self.assertEqual(channels.phantoms, phantoms + 1)
+
+        channels.getOrCreate('#permanent').modes.add(('P', None))
+        self.irc.cmodes['permanent'] = 'P'
+        channels.getOrCreate('#used').users.add(self.irc.pseudoclient.uid)
+        self.assertFalse(channels.removeIfEmpty('#used'))
+        self.assertEqual(channels.sweep(), 1)
+        self.assertNotIn('#new', channels)
+        self.assertIn('#permanent', channels)
+        self.assertIn('#used', channels)
+        self.assertEqual(channels.swept, 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,128 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socket
+import threading
+import unittest
+import zlib
+
+import classes
+import conf
+from tests_common import RecordingProto
+
+class ZiplinkIrc(classes.Irc):
+    def connect(self):
+        # Connections are made by the test itself.
+        pass
+
+class CompressingPeer():
+    """Stand-in uplink that compresses everything it sends, and decompresses
+    everything it receives."""
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.compressor = zlib.compressobj()
+        self.decompressor = zlib.decompressobj()
+        self.received = b''
+
+    def accept(self):
+        self.socket, _ = self.listener.accept()
+        self.socket.settimeout(5)
+
+    def send(self, data):
+        self.socket.sendall(self.compressor.compress(data) +
+                            self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def readLines(self, count):
+        """Reads from the socket until <count> lines have been received."""
+        while self.received.count(b'\n') < count:
+            self.received += self.decompressor.decompress(self.socket.recv(65536))
+        return self.received.splitlines()
+
+    def close(self):
+        self.socket.close()
+        self.listener.close()
+
+class TestZiplinks(unittest.TestCase):
+    def setUp(self):
+        self.peer = CompressingPeer()
+        serverdata = dict(conf.testconf['servers']['unittest'], ip='127.0.0.1',
+                          port=self.peer.port, ziplinks=True)
+        config = dict(conf.testconf, servers={'unittest': serverdata})
+        self.irc = ZiplinkIrc('unittest', RecordingProto, config)
+
+        # Connect, and start a writer thread as Irc.connect() would.
+        accepter = threading.Thread(target=self.peer.accept)
+        accepter.start()
+        self.assertTrue(self.irc._connect())
+        accepter.join()
+        self.writer = threading.Thread(target=self.irc._writeLoop,
+                                       args=(self.irc.sendq, self.irc.socket))
+        self.writer.start()
+
+    def tearDown(self):
+        self.irc._disconnect()
+        self.writer.join()
+        self.peer.close()
+
+    def testSend(self):
+        lines = self.peer.readLines(2)
+        self.assertEqual(lines[:2], [b'CAPAB START 1202',
+                                     b'SERVER pylink.unittest abcd 0 9PY :PyLink'])
+        text = ':9PYAAAAAA PRIVMSG #test :' + 'hello world ' * 50
+        for x in range(100):
+            self.irc.send(text)
+        lines = self.peer.readLines(len(lines) + 100)
+        self.assertEqual(lines[-100:], [text.encode('utf-8')] * 100)
+        self.assertLess(self.irc.ziplink.sendRatio(), 0.5)
+
+    def testReceive(self):
+        lines = [':70MAAAAAA PRIVMSG #test :line %s' % x for x in range(200)]
+        data = ''.join(line + '\r\n' for line in lines).encode('utf-8')
+        # Split the compressed stream at an awkward point.
+        self.peer.send(data[:1001])
+        self.peer.send(data[1001:])
+        while len(self.irc.proto.handled) < 200:
+            self.assertTrue(self.irc._readData())
+        self.assertEqual([data for data, thread in self.irc.proto.handled], lines)
+        self.assertEqual(self.irc.ziplink.bytes_in, len(data))
+        self.assertLess(self.irc.ziplink.recvRatio(), 0.5)
+
+    def testCorruptData(self):
+        self.peer.socket.sendall(b'this is not zlib data\n')
+        self.assertRaises(classes.ProtocolError, self.irc._readData)
+
+class TestZlibLink(unittest.TestCase):
+    def testLargeOutput(self):
+        # Data that decompresses to more than max_chunk_size at once should
+        # be given back in pieces.
+        link = classes.ZlibLink()
+        link.max_chunk_size = 1000
+        data = zlib.compress(b'a' * 5000)
+        chunks = list(link.decompress(data))
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+        self.assertEqual(b''.join(chunks), b'a' * 5000)
+
+    def testLargeBurst(self):
+        # A multi-megabyte burst, compressed and read in large pieces, must not
+        # overflow the line framer's buffer.
+        lines = [':70M UID 70MAAA%04d 1429934638 user%s 0::1 hidden-%s.IP user 0::1 '
+                 '1429934638 +iwx +ACGKNOQXacfgklnoqvx :Some real name' % (n, n, n)
+                 for n in range(40000)]
+        data = ''.join(line + '\r\n' for line in lines).encode('utf-8')
+        self.assertGreater(len(data), 4 * classes.LineFramer().max_buffer_length)
+        compressed = zlib.compress(data)
+
+        link = classes.ZlibLink()
+        framer = classes.LineFramer()
+        received = []
+        for pos in range(0, len(compressed), 262144):
+            for chunk in link.decompress(compressed[pos:pos+262144]):
+                received += framer.feed(chunk)
+        self.assertEqual(received, lines)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,38 @@
 import sys
 import os
 sys.path += [os.getcwd(), os.path.join(os.getcwd(), 'protocols')]
+import threading
 import unittest
 
 import world
 import classes
+import utils
 
 world.started.set()
 
+class RecordingProto(classes.FakeProto):
+    """
+    Fake protocol module that records the lines it handles, along with the
+    thread that handled each one. Handling (non-keepalive) lines can be
+    stalled, like a slow hook would, by clearing the blocker event.
+    """
+    def __init__(self, irc):
+        super().__init__(irc)
+        self.handled = []
+        self.blocker = threading.Event()
+        self.blocker.set()
+
+    def connect(self):
+        self.irc.send('CAPAB START 1202')
+        self.irc.send('SERVER pylink.unittest abcd 0 9PY :PyLink')
+
+    def handle_events(self, data):
+        if not classes.isKeepalive(data):
+            self.blocker.wait()
+        self.handled.append((data, threading.current_thread()))
+
+RecordingProto.Class = RecordingProto
+
 class PluginTestCase(unittest.TestCase):
     def setUp(self):
         self.irc = classes.FakeIRC('unittest', world.testing)
@@ -54,6 +79,7 @@ class CommonProtoTestCase(PluginTestCase):
     def testNickClient(self):
         self.proto.nickClient(self.u, 'NotPyLink')
         self.assertEqual('NotPyLink', self.irc.users[self.u].nick)
+        self.assertEqual(utils.nickToUid(self.irc, 'notpylink'), self.u)
 
     def testPartClient(self):
         u = self.u
@@ -69,12 +95,18 @@ class CommonProtoTestCase(PluginTestCase):
         self.assertNotIn(u, self.irc.channels['#channel'].users)
         self.assertNotIn(u, self.irc.users)
         self.assertNotIn(u, self.irc.servers[self.irc.sid].users)
+        self.assertIsNone(utils.clientToServer(self.irc, u))
+        self.assertIsNone(utils.isInternalClient(self.irc, u))
+        # Channels the user wasn't in are left alone.
+        self.assertIn('#pylink', self.irc.channels)
 
     def testSpawnClient(self):
         u = self.proto.spawnClient('testuser3', 'moo', 'hello.world').uid
         # Check the server index and the user index
         self.assertIn(u, self.irc.servers[self.irc.sid].users)
         self.assertIn(u, self.irc.users)
+        self.assertEqual(utils.clientToServer(self.irc, u), self.irc.sid)
+        self.assertEqual(utils.isInternalClient(self.irc, u), self.irc.sid)
         # Raise ValueError when trying to spawn a client on a server that's not ours
         self.assertRaises(ValueError, self.proto.spawnClient, 'abcd', 'user', 'dummy.user.net', server='44A')
         # Unfilled args should get placeholder fields and not error.
@@ -86,6 +118,8 @@ class CommonProtoTestCase(PluginTestCase):
         # We're spawning clients on the right server, hopefully...
         self.assertIn(u.uid, self.irc.servers['34Q'].users)
         self.assertNotIn(u.uid, self.irc.servers[self.irc.sid].users)
+        self.assertEqual(utils.clientToServer(self.irc, u.uid), '34Q')
+        self.assertEqual(utils.isInternalClient(self.irc, u.uid), '34Q')
 
     def testSpawnServer(self):
         # Incorrect SID length
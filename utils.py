@@ -125,28 +125,91 @@ def add_hook(func, command):
     world.hooks[command].append(func)
     return func
 
+class Casemapping():
+    """
+    Case folding rules for one of the casemappings used by IRC servers
+    (rfc1459, strict-rfc1459, or ascii), compiled into a str.translate() table.
+
+    Each network gets its own instance (see getCasemapping()), which keeps a
+    bounded cache of recently folded text such as busy channel names.
+    """
+    # Characters folded together with each other, besides A-Z and a-z.
+    # Note: the folded forms used here are []\^, which is what PyLink has
+    # always used (e.g. for channel names stored in relay's database).
+    _extra = {'rfc1459': ('{}|~', '[]\\^'),
+              'strict-rfc1459': ('{}|', '[]\\'),
+              'ascii': ('', '')}
+    _tables = {name: str.maketrans(string.ascii_uppercase + chars,
+                                   string.ascii_lowercase + folded)
+               for name, (chars, folded) in _extra.items()}
+    # bytes.translate() is much faster than str.translate(), so the same
+    # tables are also kept in bytes form for (the usual case of) ASCII text.
+    _bytes_tables = {name: bytes.maketrans((string.ascii_uppercase + chars).encode(),
+                                           (string.ascii_lowercase + folded).encode())
+                     for name, (chars, folded) in _extra.items()}
+
+    # Maximum number of cached strings; the cache is emptied when it fills up.
+    cache_size = 4096
+
+    def __init__(self, name):
+        if name not in self._tables:
+            raise ValueError('Unknown casemapping %r' % name)
+        self.name = name
+        self.table = self._tables[name]
+        self.bytes_table = self._bytes_tables[name]
+        self.cache = {}
+
+    def fold(self, text):
+        """Returns the case-folded form of text, without using the cache."""
+        try:
+            data = text.encode('ascii')
+        except UnicodeEncodeError:
+            # Non-ASCII letters aren't covered by the table.
+            return text.translate(self.table).lower()
+        return data.translate(self.bytes_table).decode('ascii')
+
+    def lower(self, text):
+        """Returns the case-folded form of text, using the cache."""
+        folded = self.cache.get(text)
+        if folded is not None:
+            return folded
+        folded = self.fold(text)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[text] = folded
+        return folded
+
+    def __repr__(self):
+        return "<Casemapping %r (%s cached)>" % (self.name, len(self.cache))
+
+casemappings = tuple(Casemapping._tables)
+
+def getCasemapping(irc):
+    """Returns the Casemapping object for the IRC object, (re)creating it if
+    its protocol module's casemapping has changed."""
+    casemap = irc.casemap
+    if casemap is None or casemap.name != irc.proto.casemapping:
+        log.debug('(%s) Using casemapping %r', irc.name, irc.proto.casemapping)
+        casemap = irc.casemap = Casemapping(irc.proto.casemapping)
+        # Nicks that were indexed using the old casemapping need to be redone.
+        irc.users.reindex()
+    return casemap
+
 def toLower(irc, text):
     """Returns a lowercase representation of text based on the IRC object's
-    casemapping (rfc1459 or ascii)."""
-    if irc.proto.casemapping == 'rfc1459':
-        text = text.replace('{', '[')
-        text = text.replace('}', ']')
-        text = text.replace('|', '\\')
-        text = text.replace('~', '^')
-    return text.lower()
+    casemapping (rfc1459, strict-rfc1459, or ascii)."""
+    casemap = irc.casemap
+    if casemap is None or casemap.name != irc.proto.casemapping:
+        casemap = getCasemapping(irc)
+    return casemap.lower(text)
 
 def nickToUid(irc, nick):
     """Returns the UID of a user named nick, if present."""
-    nick = toLower(irc, nick)
-    for k, v in irc.users.copy().items():
-        if toLower(irc, v.nick) == nick:
-            return k
+    return irc.users.nickToUid(nick)
 
 def clientToServer(irc, numeric):
     """Finds the SID of the server a user is on."""
-    for server in irc.servers:
-        if numeric in irc.servers[server].users:
-            return server
+    return irc.client_servers.get(numeric)
 
 _nickregex = r'^[A-Za-z\|\\_\[\]\{\}\^\`][A-Z0-9a-z\-\|\\_\[\]\{\}\^\`]*$'
 def isNick(s, nicklen=None):
@@ -174,6 +237,174 @@ def isHostmask(text):
     # Band-aid patch here to prevent bad bans set by Janus forwarding people into invalid channels.
     return hostmaskRe.match(text) and '#' not in text
 
+class ModeSet(set):
+    """
+    Set of (mode char, argument) pairs, used for channel and user modes
+    (IrcChannel.modes and IrcUser.modes).
+
+    Besides being a regular set, this keeps an index of the arguments set for
+    each mode char (e.g. every ban mask for 'b', or the limit for 'l'), so that
+    applyModes() and reverseModes() don't have to scan the entire mode list
+    for every change. Simple flags (modes with no argument) aren't indexed,
+    since they're found by a plain membership test.
+    """
+    __slots__ = ('args',)
+
+    def __init__(self, modes=()):
+        super().__init__()
+        # Mode char -> set of arguments, for modes with arguments.
+        self.args = {}
+        self.update(modes)
+
+    def add(self, mode):
+        super().add(mode)
+        char, arg = mode
+        if arg is not None:
+            try:
+                self.args[char].add(arg)
+            except KeyError:
+                self.args[char] = {arg}
+
+    def discard(self, mode):
+        if mode not in self:
+            return
+        super().discard(mode)
+        char, arg = mode
+        if arg is not None:
+            args = self.args[char]
+            args.discard(arg)
+            if not args:
+                del self.args[char]
+
+    def remove(self, mode):
+        if mode not in self:
+            raise KeyError(mode)
+        self.discard(mode)
+
+    def pop(self):
+        mode = super().pop()
+        super().add(mode)
+        self.discard(mode)
+        return mode
+
+    def clear(self):
+        super().clear()
+        self.args.clear()
+
+    def update(self, *others):
+        for modes in others:
+            for mode in modes:
+                self.add(mode)
+
+    def difference_update(self, *others):
+        for modes in others:
+            for mode in modes:
+                self.discard(mode)
+
+    def _reindex(self):
+        self.args.clear()
+        for char, arg in self:
+            if arg is not None:
+                self.args.setdefault(char, set()).add(arg)
+
+    def intersection_update(self, *others):
+        super().intersection_update(*others)
+        self._reindex()
+
+    def symmetric_difference_update(self, other):
+        super().symmetric_difference_update(other)
+        self._reindex()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def copy(self):
+        new = ModeSet()
+        set.update(new, self)
+        new.args = {char: args.copy() for char, args in self.args.items()}
+        return new
+
+    def getArgs(self, char):
+        """Returns the set of arguments set for the given mode char. This
+        should not be changed by the caller."""
+        return self.args.get(char, frozenset())
+
+    def clearMode(self, char):
+        """Removes every entry of the given mode char, with or without an
+        argument, and returns a list of the entries removed."""
+        removed = [(char, arg) for arg in self.args.pop(char, ())]
+        for mode in removed:
+            set.discard(self, mode)
+        if (char, None) in self:
+            set.discard(self, (char, None))
+            removed.append((char, None))
+        return removed
+
+class ModeTable():
+    """
+    Lookup table for a network's channel or user modes, compiled from
+    irc.cmodes/irc.umodes (and irc.prefixmodes, for channels) by
+    compileModeTables().
+    """
+    __slots__ = ('types', 'chars', 'names', 'statusnames')
+
+    def __init__(self, supported_modes, prefixmodes=()):
+        # Mode char -> mode type: 'A', 'B', 'C', 'D' (see parseModes()), or
+        # 'prefix' for prefix modes such as +o. If a char is listed under more
+        # than one type, the one parseModes() has always checked first wins.
+        self.types = {}
+        for modetype in ('D', 'C'):
+            self.types.update(dict.fromkeys(supported_modes.get('*' + modetype, ''), modetype))
+        self.types.update(dict.fromkeys(prefixmodes, 'prefix'))
+        for modetype in ('B', 'A'):
+            self.types.update(dict.fromkeys(supported_modes.get('*' + modetype, ''), modetype))
+
+        # Named mode -> mode char, and the reverse.
+        self.chars = {name: char for name, char in supported_modes.items()
+                      if not name.startswith('*')}
+        self.names = {}
+        for name, char in self.chars.items():
+            self.names.setdefault(char, name)
+
+        # Mode char -> prefix mode name, for the prefix modes PyLink tracks in
+        # IrcChannel.status.
+        self.statusnames = {self.chars[name]: name for name in
+                            ('owner', 'admin', 'op', 'halfop', 'voice')
+                            if name in self.chars and prefixmodes}
+
+def compileModeTables(irc):
+    """
+    Compiles the channel and user mode lookup tables for the given network.
+
+    Protocol modules call this once mode negotiation with the uplink is done.
+    Anything that changes irc.cmodes, irc.umodes, or irc.prefixmodes after
+    that should call it again.
+    """
+    irc.cmodetable = ModeTable(irc.cmodes, irc.prefixmodes)
+    irc.umodetable = ModeTable(irc.umodes)
+    log.debug('(%s) Compiled mode tables: %s channel modes, %s user modes', irc.name,
+              len(irc.cmodetable.types), len(irc.umodetable.types))
+
+def getModeTable(irc, usermodes=False):
+    """Returns the user or channel ModeTable for the given network, compiling
+    the tables first if needed."""
+    if irc.cmodetable is None:
+        compileModeTables(irc)
+    return irc.umodetable if usermodes else irc.cmodetable
+
 def parseModes(irc, target, args):
     """Parses a modestring list into a list of (mode, argument) tuples.
     ['+mitl-o', '3', 'person'] => [('+m', None), ('+i', None), ('+t', None), ('+l', '3'), ('-o', 'person')]
@@ -189,15 +420,14 @@ def parseModes(irc, target, args):
     modestring = args[0]
     args = args[1:]
     if usermodes:
-        log.debug('(%s) Using irc.umodes for this query: %s', irc.name, irc.umodes)
         assert target in irc.users, "Unknown user %r." % target
-        supported_modes = irc.umodes
         oldmodes = irc.users[target].modes
     else:
-        log.debug('(%s) Using irc.cmodes for this query: %s', irc.name, irc.cmodes)
-        assert target in irc.channels, "Unknown channel %r." % target
-        supported_modes = irc.cmodes
+        # Unknown channels are parsed against the modes of a new channel.
         oldmodes = irc.channels[target].modes
+    if not isinstance(oldmodes, ModeSet):
+        oldmodes = ModeSet(oldmodes)
+    types = getModeTable(irc, usermodes).types
     res = []
     for mode in modestring:
         if mode in '+-':
@@ -206,26 +436,24 @@ def parseModes(irc, target, args):
             if not prefix:
                 prefix = '+'
             arg = None
-            log.debug('Current mode: %s%s; args left: %s', prefix, mode, args)
+            modetype = types.get(mode)
             try:
-                if mode in (supported_modes['*A'] + supported_modes['*B']):
+                if modetype in ('A', 'B'):
                     # Must have parameter.
-                    log.debug('Mode %s: This mode must have parameter.', mode)
                     arg = args.pop(0)
-                    if prefix == '-' and mode in supported_modes['*B'] and arg == '*':
+                    if prefix == '-' and modetype == 'B' and arg == '*':
                         # Charybdis allows unsetting +k without actually
                         # knowing the key by faking the argument when unsetting
                         # as a single "*".
                         # We'd need to know the real argument of +k for us to
                         # be able to unset the mode.
-                        oldargs = [m[1] for m in oldmodes if m[0] == mode]
+                        oldargs = oldmodes.getArgs(mode)
                         if oldargs:
                             # Set the arg to the old one on the channel.
-                            arg = oldargs[0]
+                            arg = next(iter(oldargs))
                             log.debug("Mode %s: coersing argument of '*' to %r.", mode, arg)
-                elif mode in irc.prefixmodes and not usermodes:
+                elif modetype == 'prefix':
                     # We're setting a prefix mode on someone (e.g. +o user1)
-                    log.debug('Mode %s: This mode is a prefix mode.', mode)
                     arg = args.pop(0)
                     # Convert nicks to UIDs implicitly; most IRCds will want
                     # this already.
@@ -235,9 +463,8 @@ def parseModes(irc, target, args):
                                   'target doesn\'t seem to exist!', irc.name,
                                   mode, arg)
                         continue
-                elif prefix == '+' and mode in supported_modes['*C']:
+                elif prefix == '+' and modetype == 'C':
                     # Only has parameter when setting.
-                    log.debug('Mode %s: Only has parameter when setting.', mode)
                     arg = args.pop(0)
             except IndexError:
                 log.warning('(%s/%s) Error while parsing mode %r: mode requires an '
@@ -250,73 +477,98 @@ def parseModes(irc, target, args):
 def applyModes(irc, target, changedmodes):
     """Takes a list of parsed IRC modes, and applies them on the given target.
 
-    The target can be either a channel or a user; this is handled automatically."""
+    The target can be either a channel or a user; this is handled automatically.
+
+    Returns an undo record: a list of modes in parseModes() format that
+    reverts exactly what was changed, e.g. +l 30 on a channel that was +l 50
+    gives [('+l', '50')]. Modes that didn't change anything (such as setting
+    a mode that's already set) are left out."""
     usermodes = not isChannel(target)
     log.debug('(%s) Using usermodes for this query? %s', irc.name, usermodes)
     if usermodes:
-        old_modelist = irc.users[target].modes
-        supported_modes = irc.umodes
+        obj = irc.users[target]
     else:
-        old_modelist = irc.channels[target].modes
-        supported_modes = irc.cmodes
-    modelist = set(old_modelist)
+        # Look the channel up with getOrCreate(), so that modes set on a
+        # channel we haven't seen yet aren't lost.
+        obj = irc.channels.getOrCreate(target)
+    modelist = obj.modes
+    if not isinstance(modelist, ModeSet):
+        modelist = obj.modes = ModeSet(modelist)
+
+    def writable():
+        """Returns the mode set to change in place. A channel's mode set may be
+        shared with a snapshot of it, so it's copied first if needed; this is
+        only done once something actually changes."""
+        if not usermodes:
+            obj.unshareModes()
+        return obj.modes
+    table = getModeTable(irc, usermodes)
     log.debug('(%s) Applying modes %r on %s (initial modelist: %s)', irc.name, changedmodes, target, modelist)
+    undo = []
     for mode in changedmodes:
         # Chop off the +/- part that parseModes gives; it's meaningless for a mode list.
         try:
             real_mode = (mode[0][1], mode[1])
         except IndexError:
             real_mode = mode
+        char, arg = real_mode
         if not usermodes:
-            pmode = ''
-            for m in ('owner', 'admin', 'op', 'halfop', 'voice'):
-                if m in irc.cmodes and real_mode[0] == irc.cmodes[m]:
-                    pmode = m+'s'
+            pmode = table.statusnames.get(char)
             if pmode:
-                pmodelist = irc.channels[target].prefixmodes[pmode]
-                log.debug('(%s) Initial prefixmodes list: %s', irc.name, irc.channels[target].prefixmodes)
-                if mode[0][0] == '+':
-                    pmodelist.add(mode[1])
-                else:
-                    pmodelist.discard(mode[1])
-                irc.channels[target].prefixmodes[pmode] = pmodelist
-                log.debug('(%s) Final prefixmodes list: %s', irc.name, irc.channels[target].prefixmodes)
-            if real_mode[0] in irc.prefixmodes:
+                adding = mode[0][0] == '+'
+                if obj.hasStatus(arg, pmode) != adding:
+                    obj.setStatus(arg, pmode, adding)
+                    undo.append((_flip(mode[0]), arg))
+                log.debug('(%s) Final prefix modes for %s on %s: %s', irc.name, arg,
+                          target, obj.getPrefixModes(arg))
+            if table.types.get(char) == 'prefix':
                 # Ignore other prefix modes such as InspIRCd's +Yy
                 log.debug('(%s) Not adding mode %s to IrcChannel.modes because '
                           'it\'s a prefix mode we don\'t care about.', irc.name, str(mode))
                 continue
         if mode[0][0] == '+':
             # We're adding a mode
-            existing = [m for m in modelist if m[0] == real_mode[0] and m[1] != real_mode[1]]
-            if existing and real_mode[1] and real_mode[0] not in irc.cmodes['*A']:
+            existing = []
+            if arg and table.types.get(char) != 'A':
                 # The mode we're setting takes a parameter, but is not a list mode (like +beI).
                 # Therefore, only one version of it can exist at a time, and we must remove
                 # any old modepairs using the same letter. Otherwise, we'll get duplicates when,
                 # for example, someone sets mode "+l 30" on a channel already set "+l 25".
-                log.debug('(%s) Old modes for mode %r exist on %s, removing them: %s',
-                          irc.name, real_mode, target, str(existing))
-                [modelist.discard(oldmode) for oldmode in existing]
-            modelist.add(real_mode)
+                existing = [(char, oldarg) for oldarg in modelist.getArgs(char) if oldarg != arg]
+                if (char, None) in modelist:
+                    existing.append((char, None))
+                if existing:
+                    log.debug('(%s) Old modes for mode %r exist on %s, removing them: %s',
+                              irc.name, real_mode, target, str(existing))
+                    modelist = writable()
+                    modelist.difference_update(existing)
+                    # Undoing this means putting the old value back.
+                    undo.extend(('+%s' % char, oldarg) for _, oldarg in existing)
+            if real_mode not in modelist:
+                modelist = writable()
+                modelist.add(real_mode)
+                if not existing:
+                    # C-type modes (e.g. +l) don't take an argument when unsetting.
+                    undo.append(('-%s' % char, None if table.types.get(char) == 'C' else arg))
             log.debug('(%s) Adding mode %r on %s', irc.name, real_mode, target)
         else:
             log.debug('(%s) Removing mode %r on %s', irc.name, real_mode, target)
             # We're removing a mode
-            if real_mode[1] is None:
+            if arg is None:
                 # We're removing a mode that only takes arguments when setting.
                 # Remove all mode entries that use the same letter as the one
                 # we're unsetting.
-                for oldmode in modelist.copy():
-                    if oldmode[0] == real_mode[0]:
-                        modelist.discard(oldmode)
-            else:
+                if modelist.getArgs(char) or (char, None) in modelist:
+                    modelist = writable()
+                    undo.extend(('+%s' % char, oldarg) for _, oldarg in modelist.clearMode(char))
+            elif real_mode in modelist:
                 # Swap the - for a + and then remove it from the list.
+                modelist = writable()
                 modelist.discard(real_mode)
+                undo.append(('+%s' % char, arg))
     log.debug('(%s) Final modelist: %s', irc.name, modelist)
-    if usermodes:
-        irc.users[target].modes = modelist
-    else:
-        irc.channels[target].modes = modelist
+    undo.reverse()
+    return undo
 
 def joinModes(modes):
     """Takes a list of (mode, arg) tuples in parseModes() format, and
@@ -387,18 +639,22 @@ def reverseModes(irc, target, modes, oldobj=None):
     # Get the current mode list first.
     if isChannel(target):
         c = oldobj or irc.channels[target]
-        oldmodes = c.modes.copy()
-        possible_modes = irc.cmodes.copy()
-        # For channels, this also includes the list of prefix modes.
-        possible_modes['*A'] += ''.join(irc.prefixmodes)
-        for name, userlist in c.prefixmodes.items():
-            try:
-                oldmodes.update([(irc.cmodes[name[:-1]], u) for u in userlist])
-            except KeyError:
-                continue
+        oldmodes = c.modes
+        table = getModeTable(irc)
     else:
         oldmodes = irc.users[target].modes
-        possible_modes = irc.umodes
+        table = getModeTable(irc, usermodes=True)
+    if not isinstance(oldmodes, ModeSet):
+        oldmodes = ModeSet(oldmodes)
+    types = table.types
+    # Prefix modes are looked up in the channel's status map.
+    prefixnames = table.statusnames
+
+    def isSet(mchar, arg):
+        if mchar in prefixnames:
+            return c.hasStatus(arg, prefixnames[mchar])
+        return (mchar, arg) in oldmodes
+
     newmodes = []
     log.debug('(%s) reverseModes: old/current mode list for %s is: %s', irc.name,
                target, oldmodes)
@@ -409,27 +665,28 @@ def reverseModes(irc, target, modes, oldobj=None):
         # C = Mode that changes a setting and only has a parameter when set.
         # D = Mode that changes a setting and never has a parameter.
         mchar = char[-1]
-        if mchar in possible_modes['*B'] + possible_modes['*C']:
+        modetype = types.get(mchar)
+        if modetype in ('B', 'C'):
             # We need to find the current mode list, so we can reset arguments
             # for modes that have arguments. For example, setting +l 30 on a channel
             # that had +l 50 set should give "+l 30", not "-l".
-            oldarg = [m for m in oldmodes if m[0] == mchar]
-            if oldarg:  # Old mode argument for this mode existed, use that.
-                oldarg = oldarg[0]
-                mpair = ('+%s' % oldarg[0], oldarg[1])
+            oldargs = oldmodes.getArgs(mchar)
+            if oldargs or (mchar, None) in oldmodes:
+                # Old mode argument for this mode existed, use that.
+                mpair = ('+%s' % mchar, next(iter(oldargs), None))
             else:  # Not found, flip the mode then.
                 # Mode takes no arguments when unsetting.
-                if mchar in possible_modes['*C'] and char[0] != '-':
+                if modetype == 'C' and char[0] != '-':
                     arg = None
                 mpair = (_flip(char), arg)
         else:
             mpair = (_flip(char), arg)
-        if char[0] != '-' and (mchar, arg) in oldmodes:
+        if char[0] != '-' and isSet(mchar, arg):
             # Mode is already set.
             log.debug("(%s) reverseModes: skipping reversing '%s %s' with %s since we're "
                       "setting a mode that's already set.", irc.name, char, arg, mpair)
             continue
-        elif char[0] == '-' and (mchar, arg) not in oldmodes and mchar in possible_modes['*A']:
+        elif char[0] == '-' and not isSet(mchar, arg) and modetype in ('A', 'prefix'):
             # We're unsetting a prefixmode that was never set - don't set it in response!
             # Charybdis lacks verification for this server-side.
             log.debug("(%s) reverseModes: skipping reversing '%s %s' with %s since it "
@@ -449,9 +706,8 @@ def isInternalClient(irc, numeric):
     Checks whether the given numeric is a PyLink Client,
     returning the SID of the server it's on if so.
     """
-    for sid in irc.servers:
-        if irc.servers[sid].internal and numeric in irc.servers[sid].users:
-            return sid
+    if numeric in irc.internal_clients:
+        return irc.client_servers.get(numeric)
 
 def isInternalServer(irc, sid):
     """Returns whether the given SID is an internal PyLink server."""
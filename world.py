@@ -16,11 +16,18 @@ global commands, hooks
 commands = defaultdict(list)
 hooks = defaultdict(list)
 networkobjects = {}
-schedulers = {}
 plugins = {}
 whois_handlers = []
 started = threading.Event()
 
+# Shared scheduler for timed and repeating tasks (see scheduler.py). This is
+# set when the scheduler module is first imported.
+scheduler = None
+
+# Shared connection coordinator (see reconnect.py). This is set when the
+# reconnect module is first imported.
+coordinator = None
+
 plugins_folder = os.path.join(os.getcwd(), 'plugins')
 protocols_folder = os.path.join(os.getcwd(), 'protocols')
 